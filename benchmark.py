@@ -0,0 +1,779 @@
+'''Throughput benchmarks for the ftp.py client.
+
+Every benchmark starts the bundled run_ftp_server.py (pyftpdlib) on a free
+loopback port, serving a temporary directory, and talks to it with ftp.FTP.
+
+    python benchmark.py segmented --size 256 --segments 1 4 8
+    python benchmark.py concurrent --files 500 --file-size 4096
+    python benchmark.py pipeline --commands 10000
+    python benchmark.py latency --rtt 0 10 50 --size 64
+    python benchmark.py compression --rtt 20 --inflight 64 --size 32
+    python benchmark.py smallfiles --files 2000 --file-size 2048 --rtt 0 2
+    python benchmark.py download --size 256
+    python benchmark.py digest --digest sha256 --rtt 2 --inflight 256
+    python benchmark.py ascii --size 64
+    python benchmark.py walk --depth 4 --fanout 4 --rtt 2
+    python benchmark.py delta --size 256 --changed 4 --rtt 10
+
+The latency benchmark puts a delaying TCP proxy between client and
+server (or, with --netem, delays the loopback device with tc netem, which
+needs root and the sch_netem module).
+'''
+import io
+import os
+import sys
+import time
+import random
+import shutil
+import queue
+import socket
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+import ftp
+
+
+HERE     = os.path.dirname(os.path.abspath(__file__))
+USER     = 'username'
+PASSWD   = 'password'
+MiB      = 2**20
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+@contextmanager
+def local_server(root, max_cons=512):
+    '''Run run_ftp_server.py serving `root`, yield its port.'''
+    port = free_port()
+    cmd = [sys.executable, os.path.join(HERE, 'run_ftp_server.py'),
+           '-u', USER, '-p', PASSWD, '-r', root, '-P', str(port),
+           '--max-cons', str(max_cons)]
+    proc = subprocess.Popen(cmd, cwd=HERE, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.DEVNULL)
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                break
+            except OSError:
+                if proc.poll() is not None or time.monotonic() > deadline:
+                    raise RuntimeError('run_ftp_server.py did not start')
+                time.sleep(0.05)
+        yield port
+    finally:
+        proc.terminate()
+        proc.wait()
+
+def connect(port):
+    client = ftp.FTP()
+    client.connect('127.0.0.1', port)
+    client.login(USER, PASSWD)
+    return client
+
+def make_file(path, size):
+    with open(path, 'wb') as fp:
+        chunk = os.urandom(MiB)
+        for _ in range(size // MiB):
+            fp.write(chunk)
+        fp.write(chunk[:size % MiB])
+
+def report(label, n_bytes, elapsed):
+    print(f'{label:<24}{n_bytes / MiB:>10.1f} MiB{elapsed:>10.3f} s'
+          f'{n_bytes / MiB / elapsed:>12.1f} MiB/s')
+
+
+
+
+def bench_segmented(args):
+    with tempfile.TemporaryDirectory() as root:
+        size = args.size * MiB
+        make_file(os.path.join(root, 'blob'), size)
+        target = os.path.join(root, 'blob.out')
+        with local_server(root) as port:
+            client = connect(port)
+            for segments in args.segments:
+                best = None
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    client.retrsegmented('blob', target, segments=segments)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                report(f'segments={segments}', size, best)
+            client.quit()
+
+
+
+
+def bench_concurrent(args):
+    names = [f'small{i}' for i in range(args.files)]
+
+    def fetch_blocking(port, name):
+        client = connect(port)
+        chunks = []
+        client.retrbinary(f'RETR {name}', chunks.append)
+        client.quit()
+        return sum(map(len, chunks))
+
+    async def fetch_async(port, name):
+        client = ftp.AsyncFTP()
+        await client.connect('127.0.0.1', port)
+        await client.login(USER, PASSWD)
+        chunks = []
+        await client.retrbinary(f'RETR {name}', chunks.append)
+        await client.quit()
+        return sum(map(len, chunks))
+
+    async def fetch_all_async(port):
+        return await asyncio.gather(*(fetch_async(port, n) for n in names))
+
+    with tempfile.TemporaryDirectory() as root:
+        payload = os.urandom(args.file_size)
+        for name in names:
+            with open(os.path.join(root, name), 'wb') as fp:
+                fp.write(payload)
+        # Every session holds a control connection plus a data connection.
+        with local_server(root, max_cons=4 * args.files) as port:
+            start = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=args.files) as pool:
+                total = sum(pool.map(lambda n: fetch_blocking(port, n), names))
+            elapsed = time.perf_counter() - start
+            report(f'threads+FTP', total, elapsed)
+            print(f'{"":<24}{args.files / elapsed:>10.1f} files/s')
+
+            start = time.perf_counter()
+            total = sum(asyncio.run(fetch_all_async(port)))
+            elapsed = time.perf_counter() - start
+            report(f'AsyncFTP', total, elapsed)
+            print(f'{"":<24}{args.files / elapsed:>10.1f} files/s')
+
+
+
+
+def bench_pipeline(args):
+    names = [f'junk{i}' for i in range(args.commands)]
+
+    def populate(root):
+        for name in names:
+            open(os.path.join(root, name), 'wb').close()
+
+    with tempfile.TemporaryDirectory() as root:
+        with local_server(root) as port:
+            client = connect(port)
+
+            populate(root)
+            start = time.perf_counter()
+            for name in names:
+                client.delete(name)
+            report_rate('DELE one by one', len(names), time.perf_counter() - start)
+
+            populate(root)
+            start = time.perf_counter()
+            with client.pipeline(window=args.window) as p:
+                for name in names:
+                    p.delete(name)
+            elapsed = time.perf_counter() - start
+            assert all(r.ok for r in p.results)
+            report_rate(f'DELE pipelined ({args.window})', len(names), elapsed)
+            client.quit()
+
+def report_rate(label, n, elapsed):
+    print(f'{label:<24}{n:>10} cmds{elapsed:>10.3f} s{n / elapsed:>12.1f} cmds/s')
+
+
+
+
+class DelayProxy:
+    '''TCP proxy that holds every chunk for `delay` seconds each way.
+
+    Control connections are relayed to the server and 227 replies are
+    rewritten to point at a fresh relay for the data connection, so data
+    is delayed too. About `inflight` bytes wait in each direction, which
+    caps the emulated link at inflight / delay bytes per second. The proxy
+    terminates TCP, so it adds latency to every exchange but cannot make
+    the client's own receive window the bottleneck the way netem can.
+    '''
+    def __init__(self, port, delay, inflight=8 * MiB):
+        self.upstream = ('127.0.0.1', port)
+        self.delay = delay
+        self.inflight = inflight
+        self.listener = self._listen()
+        self.port = self.listener.getsockname()[1]
+        self._spawn(self._serve, self.listener, self._control)
+
+    def close(self):
+        self.listener.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _listen(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        sock.listen(64)
+        return sock
+
+    def _spawn(self, target, *args):
+        threading.Thread(target=target, args=args, daemon=True).start()
+
+    def _serve(self, listener, handle, once=False):
+        while True:
+            try:
+                client, _ = listener.accept()
+            except OSError:
+                return
+            try:
+                handle(client)
+            except OSError:
+                # e.g. a prefetched data connection the server dropped
+                client.close()
+            if once:
+                listener.close()
+                return
+
+    def _control(self, client):
+        server = socket.create_connection(self.upstream)
+        self._link(client, server, rewrite=self._rewrite227)
+
+    def _data(self, address):
+        listener = self._listen()
+        self._spawn(self._serve, listener,
+                    lambda client: self._link(client, socket.create_connection(address)),
+                    True)
+        return listener.getsockname()[1]
+
+    def _rewrite227(self, line):
+        if line.startswith(b'227 '):
+            host, port = ftp.parse227(line.decode('latin-1'))
+            port = self._data((host, port))
+            line = b'227 Entering passive mode (127,0,0,1,%d,%d).\r\n' % divmod(port, 256)
+        return line
+
+    def _link(self, client, server, rewrite=None):
+        # Relayed writes must not wait for ACKs: only `delay` is wanted.
+        for sock in (client, server):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # Both sockets close once both directions have seen EOF.
+        left = [2]
+        lock = threading.Lock()
+
+        def done():
+            with lock:
+                left[0] -= 1
+                if not left[0]:
+                    client.close()
+                    server.close()
+
+        self._relay(client, server, done)
+        self._relay(server, client, done, rewrite)
+
+    def _relay(self, src, dst, done, rewrite=None):
+        # The reader stamps every chunk with its release time, the writer
+        # sleeps until then. The bounded queue is the emulated link.
+        chunk = 64 * 1024
+        pending = queue.Queue(maxsize=max(1, self.inflight // chunk))
+
+        def reader():
+            buf = b''
+            while True:
+                try:
+                    data = src.recv(chunk)
+                except OSError:
+                    data = b''
+                if rewrite is not None and data:
+                    buf += data
+                    *lines, buf = buf.split(b'\n')
+                    data = b''.join(rewrite(line + b'\n') for line in lines)
+                    if not data:
+                        continue
+                pending.put((time.monotonic() + self.delay, data))
+                if not data:
+                    return
+
+        def writer():
+            try:
+                while True:
+                    due, data = pending.get()
+                    wait = due - time.monotonic()
+                    if wait > 0:
+                        time.sleep(wait)
+                    if not data:
+                        dst.shutdown(socket.SHUT_WR)
+                        break
+                    dst.sendall(data)
+            except OSError:
+                pass
+            done()
+
+        self._spawn(reader)
+        self._spawn(writer)
+
+@contextmanager
+def netem(delay):
+    '''Delay every packet on the loopback device by `delay` seconds.'''
+    cmd = ['tc', 'qdisc', 'add', 'dev', 'lo', 'root', 'netem', 'delay',
+           f'{delay * 1000:.1f}ms']
+    subprocess.run(cmd, check=True)
+    try:
+        yield
+    finally:
+        subprocess.run(['tc', 'qdisc', 'del', 'dev', 'lo', 'root'], check=True)
+
+def bench_latency(args):
+    size = args.size * MiB
+    modes = [
+        ('RETR 8K blocks', False, lambda c: c.retrbinary('RETR blob', sink)),
+        ('RETR adaptive', True, lambda c: c.retrbinary('RETR blob', sink)),
+        ('STOR fixed', False, lambda c: store(c)),
+        ('STOR adaptive', True, lambda c: store(c)),
+    ]
+
+    def sink(data):
+        pass
+
+    def store(client):
+        with open(source, 'rb') as fp:
+            client.storbinary('STOR blob.up', fp)
+
+    with tempfile.TemporaryDirectory() as root:
+        source = os.path.join(root, 'blob')
+        make_file(source, size)
+        with local_server(root) as port:
+            for rtt in args.rtt:
+                delay = rtt / 1000 / 2  # one way
+                if args.netem:
+                    emulation, target = netem(delay), port
+                else:
+                    emulation = DelayProxy(port, delay)
+                    target = emulation.port
+                with emulation:
+                    for label, adaptive, transfer in modes:
+                        client = connect(target)
+                        client.adaptive = adaptive
+                        best = None
+                        for _ in range(args.repeat):
+                            start = time.perf_counter()
+                            transfer(client)
+                            elapsed = time.perf_counter() - start
+                            best = elapsed if best is None else min(best, elapsed)
+                        client.quit()
+                        report(f'rtt={rtt}ms {label}', size, best)
+
+
+
+
+def bench_compression(args):
+    size = args.size * MiB
+    # A small in-flight window turns the proxy into a slow link, on
+    # which fewer bytes on the wire is what counts.
+    delay = args.rtt / 1000 / 2
+    inflight = args.inflight * 1024
+
+    def sink(data):
+        pass
+
+    with tempfile.TemporaryDirectory() as root:
+        payloads = {'text': os.path.join(root, 'export.csv'),
+                    'random': os.path.join(root, 'blob')}
+        with open(payloads['text'], 'wb') as fp:
+            row = 0
+            while fp.tell() < size:
+                fp.write(b'%d,2024-01-%02d,customer-%d,%d.%02d,EUR,ok\r\n'
+                         % (row, row % 28 + 1, row % 5000, row % 997, row % 100))
+                row += 1
+        make_file(payloads['random'], size)
+        with local_server(root) as port, \
+                DelayProxy(port, delay, inflight=inflight) as proxy:
+            for kind, path in payloads.items():
+                name = os.path.basename(path)
+                for mode in ('S', 'Z'):
+                    client = connect(proxy.port)
+                    client.set_mode(mode, args.level)
+                    start = time.perf_counter()
+                    client.retrbinary('RETR ' + name, sink)
+                    elapsed = time.perf_counter() - start
+                    report(f'RETR {kind} MODE {mode}', os.path.getsize(path), elapsed)
+                    with open(path, 'rb') as fp:
+                        start = time.perf_counter()
+                        client.storbinary('STOR up', fp)
+                        elapsed = time.perf_counter() - start
+                    report(f'STOR {kind} MODE {mode}', os.path.getsize(path), elapsed)
+                    client.quit()
+
+
+
+
+def bench_smallfiles(args):
+    names = [f'small{i}' for i in range(args.files)]
+    payload = os.urandom(args.file_size)
+
+    def sink(data):
+        pass
+
+    def retr(client):
+        for name in names:
+            client.retrbinary('RETR ' + name, sink)
+
+    def stor(client):
+        for name in names:
+            client.storbinary('STOR ' + name, io.BytesIO(payload))
+
+    # Prefetching only overlaps the data connection setup of downloads.
+    runs = [('RETR MODE S', retr, 'S', False),
+            ('RETR prefetch', retr, 'S', True),
+            ('RETR MODE B', retr, 'B', False),
+            ('STOR MODE S', stor, 'S', False),
+            ('STOR MODE B', stor, 'B', False)]
+
+    with tempfile.TemporaryDirectory() as root:
+        for name in names:
+            with open(os.path.join(root, name), 'wb') as fp:
+                fp.write(payload)
+        with local_server(root) as port:
+            for rtt in args.rtt:
+                # Without a delay talk to the server directly: the proxy's
+                # own per-connection overhead would dominate.
+                proxy = DelayProxy(port, rtt / 1000 / 2) if rtt else None
+                for label, transfer, mode, prefetch in runs:
+                    client = connect(proxy.port if proxy else port)
+                    client.set_mode(mode)
+                    client.prefetch = prefetch
+                    start = time.perf_counter()
+                    transfer(client)
+                    elapsed = time.perf_counter() - start
+                    client.quit()
+                    print(f'{f"rtt={rtt:g}ms {label}":<24}'
+                          f'{args.files:>10} files{elapsed:>10.3f} s'
+                          f'{args.files / elapsed:>12.1f} files/s')
+                if proxy:
+                    proxy.close()
+
+
+
+
+def bench_download(args):
+    def into(client, target, size):
+        with open(target, 'wb') as fp:
+            client.retrinto('RETR blob', fp)
+
+    def mapped(client, target, size):
+        client.retrfile('RETR blob', target, size, flush_every=None)
+
+    def synced(client, target, size):
+        client.retrfile('RETR blob', target, size)
+
+    def unknown(client, target, size):
+        client.retrfile('RETR blob', target)
+
+    runs = [('retrinto + write', into),
+            ('retrfile mmap', mapped),
+            ('retrfile mmap + msync', synced),
+            ('retrfile, no size', unknown)]
+
+    with tempfile.TemporaryDirectory() as root:
+        size = args.size * MiB
+        make_file(os.path.join(root, 'blob'), size)
+        target = os.path.join(args.dir or root, 'blob.out')
+        with local_server(root) as port:
+            client = connect(port)
+            for label, download in runs:
+                best = None
+                for _ in range(args.repeat):
+                    if os.path.exists(target):
+                        os.remove(target)
+                    start = time.perf_counter()
+                    download(client, target, size)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                report(label, size, best)
+            client.quit()
+        os.remove(target)
+
+
+
+
+def bench_digest(args):
+    def rehash(path):
+        h = ftp.new_hash(args.digest)
+        with open(path, 'rb') as fp:
+            while chunk := fp.read(MiB):
+                h.update(chunk)
+        return h.hexdigest()
+
+    def retr_then_hash(client, source, target):
+        client.retrfile('RETR blob', target, size)
+        return rehash(target)
+
+    def retr_hashing(client, source, target):
+        return client.retrfile('RETR blob', target, size, digest=args.digest).digest
+
+    def stor_then_hash(client, source, target):
+        with open(source, 'rb') as fp:
+            client.storbinary('STOR up', fp)
+        return rehash(source)
+
+    def stor_hashing(client, source, target):
+        with open(source, 'rb') as fp:
+            return client.storbinary('STOR up', fp, digest=args.digest).digest
+
+    runs = [('RETR, then hash', retr_then_hash),
+            ('RETR, hashing', retr_hashing),
+            ('STOR, then hash', stor_then_hash),
+            ('STOR, hashing', stor_hashing)]
+
+    with tempfile.TemporaryDirectory() as root:
+        size = args.size * MiB
+        source = os.path.join(root, 'blob')
+        make_file(source, size)
+        target = os.path.join(root, 'blob.out')
+        # Hashing can only hide behind the transfer when something else,
+        # here a slow link, is the limit.
+        with local_server(root) as port, \
+                DelayProxy(port, args.rtt / 1000 / 2,
+                           inflight=args.inflight * 1024) as proxy:
+            client = connect(proxy.port)
+            digests = set()
+            for label, transfer in runs:
+                best = None
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    digests.add(transfer(client, source, target))
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                report(f'{label}', size, best)
+            client.quit()
+        assert len(digests) == 1, digests
+
+
+
+
+def bench_ascii(args):
+    count = [0]
+
+    def line(text):
+        count[0] += 1
+
+    def batch(lines):
+        count[0] += len(lines)
+
+    def retr_lines(client, path):
+        client.retrlines('RETR export.csv', line)
+
+    def retr_batch(client, path):
+        client.retrlines('RETR export.csv', batch, batch=True)
+
+    def stor_lines(client, path):
+        with open(path, 'rb') as fp:
+            client.storlines('STOR up.csv', fp, callback=line)
+
+    def stor_blocks(client, path):
+        with open(path, 'rb') as fp:
+            client.storlines('STOR up.csv', fp)
+
+    runs = [('RETR per line', retr_lines),
+            ('RETR batch', retr_batch),
+            ('STOR per line', stor_lines),
+            ('STOR blocks', stor_blocks)]
+
+    with tempfile.TemporaryDirectory() as root:
+        path = os.path.join(root, 'export.csv')
+        size = args.size * MiB
+        with open(path, 'wb') as fp:
+            row = 0
+            while fp.tell() < size:
+                fp.write(b'%d,2024-01-%02d,customer-%d,%d.%02d,EUR,ok\n'
+                         % (row, row % 28 + 1, row % 5000, row % 997, row % 100))
+                row += 1
+        size = os.path.getsize(path)
+        with local_server(root) as port:
+            client = connect(port)
+            for label, transfer in runs:
+                best = None
+                for _ in range(args.repeat):
+                    start = time.perf_counter()
+                    transfer(client, path)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                report(label, size, best)
+            client.quit()
+
+
+
+
+def bench_walk(args):
+    def recurse(client, path):
+        # what scripts did before walk(): one directory after another
+        n = 1
+        for entry in list(client.mlsd(path, ['type', 'size', 'modify'])):
+            if entry.type == 'dir':
+                n += recurse(client, f'{path}/{entry.name}')
+        return n
+
+    def walk(workers):
+        return lambda client, path: sum(1 for _ in client.walk(path, workers=workers))
+
+    runs = [('MLSD recursion', recurse)]
+    runs += [(f'walk, {n} session{"s" * (n > 1)}', walk(n)) for n in args.workers]
+
+    def populate(path, depth):
+        open(os.path.join(path, 'file'), 'wb').close()
+        if depth:
+            for i in range(args.fanout):
+                os.mkdir(os.path.join(path, f'dir{i}'))
+                populate(os.path.join(path, f'dir{i}'), depth - 1)
+
+    with tempfile.TemporaryDirectory() as root:
+        populate(root, args.depth)
+        with local_server(root) as port, \
+                DelayProxy(port, args.rtt / 1000 / 2) as proxy:
+            client = connect(proxy.port)
+            for label, crawl in runs:
+                start = time.perf_counter()
+                n = crawl(client, '/')
+                elapsed = time.perf_counter() - start
+                print(f'{label:<24}{n:>10} dirs{elapsed:>10.3f} s'
+                      f'{n / elapsed:>12.1f} dirs/s')
+            client.quit()
+
+
+
+
+def bench_delta(args):
+    def stor(client, local):
+        with open(local, 'rb') as fp:
+            client.storbinary('STOR blob', fp)
+        return size
+
+    def store_delta(client, local):
+        return client.store_delta(local, 'blob').sent
+
+    runs = [('STOR, whole file', stor), ('store_delta()', store_delta)]
+
+    with tempfile.TemporaryDirectory() as root, \
+            tempfile.TemporaryDirectory() as workdir:
+        size = args.size * MiB
+        original = os.path.join(workdir, 'blob.orig')
+        make_file(original, size)
+        # the new version differs in --changed scattered MiB
+        local = os.path.join(workdir, 'blob')
+        shutil.copyfile(original, local)
+        with open(local, 'r+b') as fp:
+            for offset in random.sample(range(args.size), args.changed):
+                fp.seek(offset * MiB)
+                fp.write(os.urandom(MiB))
+        with local_server(root) as port, \
+                DelayProxy(port, args.rtt / 1000 / 2,
+                           inflight=args.inflight * 1024) as proxy:
+            client = connect(proxy.port)
+            for label, upload in runs:
+                best = None
+                for _ in range(args.repeat):
+                    shutil.copyfile(original, os.path.join(root, 'blob'))
+                    start = time.perf_counter()
+                    sent = upload(client, local)
+                    elapsed = time.perf_counter() - start
+                    best = elapsed if best is None else min(best, elapsed)
+                print(f'{label:<24}{sent / MiB:>10.1f} MiB sent{best:>10.3f} s'
+                      f'{size / MiB / best:>12.1f} MiB/s')
+            client.quit()
+
+
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='ftp.py client benchmarks')
+    sub = parser.add_subparsers(dest='benchmark', required=True)
+
+    p = sub.add_parser('segmented', help='retrsegmented() vs. segment count')
+    p.add_argument('--size', type=int, default=256, help='file size in MiB')
+    p.add_argument('--segments', type=int, nargs='+', default=[1, 4, 8])
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_segmented)
+
+    p = sub.add_parser('concurrent', help='threads+FTP vs. AsyncFTP, many small files')
+    p.add_argument('--files', type=int, default=500)
+    p.add_argument('--file-size', type=int, default=4096, help='bytes per file')
+    p.set_defaults(func=bench_concurrent)
+
+    p = sub.add_parser('pipeline', help='DELE with and without pipelining')
+    p.add_argument('--commands', type=int, default=10000)
+    p.add_argument('--window', type=int, default=ftp.PIPELINE_WINDOW)
+    p.set_defaults(func=bench_pipeline)
+
+    p = sub.add_parser('latency', help='fixed vs. adaptive transfers over an emulated RTT')
+    p.add_argument('--rtt', type=float, nargs='+', default=[0, 10, 50],
+                   help='round trip times in ms')
+    p.add_argument('--size', type=int, default=64, help='file size in MiB')
+    p.add_argument('--repeat', type=int, default=2)
+    p.add_argument('--netem', action='store_true',
+                   help='delay the loopback device with tc netem instead of a proxy')
+    p.set_defaults(func=bench_latency)
+
+    p = sub.add_parser('compression', help='MODE S vs. MODE Z over a slow link')
+    p.add_argument('--rtt', type=float, default=20, help='round trip time in ms')
+    p.add_argument('--inflight', type=int, default=64,
+                   help='KiB the proxy holds in flight each way')
+    p.add_argument('--size', type=int, default=32, help='payload size in MiB')
+    p.add_argument('--level', type=int, default=ftp.ZLIB_LEVEL,
+                   help='zlib compression level, 0-9')
+    p.set_defaults(func=bench_compression)
+
+    p = sub.add_parser('smallfiles', help='stream, prefetch and block mode, one file after another')
+    p.add_argument('--files', type=int, default=2000)
+    p.add_argument('--file-size', type=int, default=2048, help='bytes per file')
+    p.add_argument('--rtt', type=float, nargs='+', default=[0, 2],
+                   help='round trip times in ms')
+    p.set_defaults(func=bench_smallfiles)
+
+    p = sub.add_parser('download', help='retrinto() vs. the mapped retrfile()')
+    p.add_argument('--size', type=int, default=256, help='file size in MiB')
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--dir', help='where the downloads go (default: next to the source)')
+    p.set_defaults(func=bench_download)
+
+    p = sub.add_parser('digest', help='hashing during vs. after a transfer')
+    p.add_argument('--rtt', type=float, default=2, help='round trip time in ms')
+    p.add_argument('--inflight', type=int, default=256,
+                   help='KiB the proxy keeps in flight per direction')
+    p.add_argument('--size', type=int, default=64, help='file size in MiB')
+    p.add_argument('--repeat', type=int, default=3)
+    p.add_argument('--digest', default='sha256', help="'sha256', 'md5', 'crc32', ...")
+    p.set_defaults(func=bench_digest)
+
+    p = sub.add_parser('ascii', help='retrlines()/storlines() per line vs. in blocks')
+    p.add_argument('--size', type=int, default=64, help='CSV size in MiB')
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_ascii)
+
+    p = sub.add_parser('walk', help='recursive MLSD on one session vs. walk()')
+    p.add_argument('--depth', type=int, default=4, help='levels below the root')
+    p.add_argument('--fanout', type=int, default=4, help='subdirectories per directory')
+    p.add_argument('--rtt', type=float, default=2, help='round trip time in ms')
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 8])
+    p.set_defaults(func=bench_walk)
+
+    p = sub.add_parser('delta', help='STOR vs. store_delta() of a slightly changed file')
+    p.add_argument('--size', type=int, default=256, help='file size in MiB')
+    p.add_argument('--changed', type=int, default=4, help='MiB that differ')
+    p.add_argument('--rtt', type=float, default=10, help='round trip time in ms')
+    p.add_argument('--inflight', type=int, default=64,
+                   help='KiB the proxy keeps in flight per direction')
+    p.add_argument('--repeat', type=int, default=3)
+    p.set_defaults(func=bench_delta)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+if __name__ == '__main__':
+    main()
@@ -1,11 +1,33 @@
+import io
 import os
 import sys
-import select
+import errno
+import time
+import json
+import stat
+import itertools
+import glob
+import fnmatch
+import calendar
+import posixpath
+import functools
+import collections
+import heapq
+import random
+import queue
+import hashlib
 import socket
+import select
+import mmap
+import struct
+import zlib
+import asyncio
+import argparse
+import urllib.parse
+import threading
 from socket import _GLOBAL_DEFAULT_TIMEOUT
 from pathlib import Path
-
-from tqdm import tqdm
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
 
 
 
@@ -14,6 +36,30 @@ CRLF        = '\r\n'
 B_CRLF      = b'\r\n'
 FTP_PORT    = 21
 MAXLINE     = 8192
+MIN_SEGMENT = 2**20  # smallest byte range worth its own data connection
+MAX_BLOCKSIZE = 2**22  # upper bound for adaptive receive buffers
+MAX_SOCKBUF = 2**25  # upper bound for tuned SO_RCVBUF / SO_SNDBUF
+PROGRESS_INTERVAL = 0.2  # seconds between progress hook calls
+SEND_BLOCKSIZE = 2**20  # read size when an upload cannot use sendfile
+SENDFILE_CHUNK = 2**24  # bytes per sendfile call between progress updates
+KEEPALIVE_INTERVAL = 30  # idle seconds on the control channel before a NOOP
+PIPELINE_WINDOW = 64  # pipelined commands written per batch
+CACHE_TTL = 30  # seconds a cached listing or size stays valid
+CACHE_MAXSIZE = 1024  # cached listings and sizes per MetadataCache
+JOURNAL_SUFFIX = '.ftpjournal'  # sidecar checkpoint of resumable downloads
+CHECKPOINT_BYTES = 2**24  # bytes between fsync + journal updates
+MMAP_FLUSH  = 2**24  # bytes between ranged msyncs, see FTP.retrfile()
+DIGEST_QUEUE = 16  # chunks a transfer may queue ahead of its hashing thread
+ASCII_BLOCKSIZE = 2**18  # bytes per block of a batched ASCII transfer
+DELTA_BLOCKSIZE = 2**20  # bytes per block compared by FTP.store_delta()
+RETRIES     = 5    # attempts a queued transfer gets after the first one
+BACKOFF     = 1.0  # seconds before the first retry, doubled for each next
+MAX_BACKOFF = 60.0  # cap for the delay between retries
+ZLIB_LEVEL  = 6    # MODE Z compression level of uploads
+BLOCK_MAXSIZE = 65535  # data bytes per MODE B block
+BLOCK_EOF   = 64   # MODE B descriptor bit: last block of the file
+BLOCK_RESTART = 16  # MODE B descriptor bit: the block is a restart marker
+_BLOCK_HEADER = struct.Struct('!BH')  # MODE B descriptor and byte count
 _227_re = None
 _150_re = None
 
@@ -35,10 +81,19 @@ class error_reply(Error):   pass          # unexpected [123]xx reply
 class error_temp(Error):    pass          # 4xx errors
 class error_perm(Error):    pass          # 5xx errors
 class error_proto(Error):   pass          # response does not begin with [1-5]
-all_errors = {Error, IOError, EOFError}
+all_errors = (Error, IOError, EOFError)
+
 
 
 
+def _locked(method):
+    '''Run a method while holding the session's control channel lock.'''
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
 
 class FTP:
     def __init__(self, host=None, user=None, passwd=None, acct=None,
@@ -53,6 +108,29 @@ class FTP:
         self.source_address = source_address
         self.encoding       = 'latin-1'  # Extended ASCII
         self.timeout        = timeout
+        self.user           = ''
+        self.passwd         = ''
+        self.acct           = ''
+        self.keepalive      = None   # KeepAlive scheduler watching us
+        self.tcp_keepalive  = None   # TCP_KEEPIDLE seconds for our sockets
+        self._lock          = threading.RLock()
+        self._last_io       = time.monotonic()
+        self._transferring  = False  # a transfer's final reply is pending
+        self.cache          = None   # MetadataCache, see enable_cache()
+        self._cwd           = None   # remote working directory, if known
+        self.adaptive       = False  # tune blocks and buffers to the link
+        self.rtt            = None   # smoothed PASV/EPSV round trip, seconds
+        self.rate           = None   # bytes/s of the last adaptive transfer
+        self.progress_interval = PROGRESS_INTERVAL
+        self._meter         = None   # _Meter of the running transfer
+        self.mode           = 'S'    # transfer mode, 'S', 'B' or 'Z'
+        self.zlib_level     = ZLIB_LEVEL
+        self._block_sock    = None   # data connection kept open by MODE B
+        self.prefetch       = False  # open the next data connection early
+        self._prefetched    = None   # data socket opened by prefetch
+        self._pasv_pending  = False  # prefetch PASV/EPSV reply not read yet
+        self.epsv           = False  # EPSV on IPv4 too, see use_epsv_all()
+        self._mlst_facts    = None   # facts last selected with OPTS MLST
 
         if host:
             self.connect(host)
@@ -62,10 +140,12 @@ class FTP:
     def putline(self, cmd):
         cmd = cmd + CRLF
         self.sock.sendall(cmd.encode(self.encoding))
+        self._last_io = time.monotonic()
 
     # RFC-959 Page 35
     def getline(self):
         line = self.file.readline()
+        self._last_io = time.monotonic()
         if not line:
             raise EOFError
         if line[-2:] == CRLF:
@@ -90,6 +170,8 @@ class FTP:
         resp = self.getmultiline()
         self.lastresp = resp[:3]
         c = resp[:1]
+        if c != '1':
+            self._transferring = False
         if c in {'1','2','3'}:
             return resp
         if c == '4':
@@ -102,13 +184,20 @@ class FTP:
         # https://stackoverflow.com/questions/15170503/checking-a-python-ftp-connection
         self.voidcmd('NOOP')
 
+    @_locked
     def sendcmd(self, cmd):
+        start = time.monotonic()
         self.putline(cmd)
-        return self.getresp()
+        # A pending PASV reply comes first: both were in flight together.
+        self._collect_prefetch()
+        resp = self.getresp()
+        if self._meter is not None:
+            self._meter.command(cmd, start)
+        return resp
 
+    @_locked
     def voidcmd(self, cmd):
-        self.putline(cmd)
-        resp = self.getresp()
+        resp = self.sendcmd(cmd)
         if resp[:1] != '2':
             raise error_reply(resp)
         return resp
@@ -133,8 +222,23 @@ class FTP:
         if resp[0] == '3': resp = self.sendcmd('PASS ' + passwd)
         if resp[0] == '3': resp = self.sendcmd('ACCT ' + acct)
         if resp[0] != '2': raise error_reply(resp)
+        self.user, self.passwd, self.acct = user, passwd, acct
         return resp
 
+    def clone(self):
+        '''Open another session to the same server, logged in as the same
+        user and placed in the same remote working directory.
+        '''
+        other = FTP(timeout=self.timeout, source_address=self.source_address)
+        other.passiveserver = self.passiveserver
+        other.encoding = self.encoding
+        other.connect(self.host, self.port)
+        other.login(self.user, self.passwd, self.acct)
+        other.cwd(self.pwd())
+        if self.mode != 'S':
+            other.set_mode(self.mode, self.zlib_level)
+        return other
+
     def connect(self, host=None, port=None, timeout=None, source_address=None):
         # Override presets
         if host is not None:            self.host = host
@@ -148,13 +252,15 @@ class FTP:
         # Convenience function: socket -> bind -> connect
         self.sock = socket.create_connection(
             host_addr, timeout=self.timeout, source_address=self.source_address)
-        # self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if self.tcp_keepalive:
+            set_tcp_keepalive(self.sock, self.tcp_keepalive)
 
         # necessary
         self.af = self.sock.family
 
         # file-like interface for socket reading
         self.file = self.sock.makefile(mode='r', encoding=self.encoding)
+        self._mlst_facts = None
         self.welcome = self.getresp()
         return self.welcome
 
@@ -212,16 +318,224 @@ class FTP:
             sock.settimeout(self.timeout)
         return sock
 
+    def feat(self):
+        '''Return the set of features listed by FEAT, upper-cased.'''
+        try:
+            resp = self.sendcmd('FEAT')
+        except error_perm:
+            return set()
+        if resp[:3] != '211':
+            return set()
+        return {line.strip().upper() for line in resp.split('\n')[1:-1]}
+
+    @_locked
+    def set_mode(self, mode, level=None):
+        '''Switch the transfer mode to 'S' (stream), 'B' (block) or 'Z'
+        (deflate).
+
+        In MODE B one data connection carries file after file, which
+        saves a PASV round trip and a TCP connect per transfer. MODE Z is
+        only requested when FEAT lists it; `level` is the compression
+        level of uploads and, through OPTS MODE Z LEVEL, of downloads.
+        Returns True if the mode is in effect.
+        '''
+        mode = mode.upper()
+        if mode == 'Z':
+            if 'MODE Z' not in self.feat():
+                return False
+            if level is not None:
+                self.zlib_level = level
+        try:
+            self.voidcmd('MODE ' + mode)
+        except error_perm:
+            if mode == 'S':
+                raise
+            return False
+        self._close_block_sock()
+        self.mode = mode
+        if mode == 'Z' and level is not None:
+            try:
+                self.voidcmd('OPTS MODE Z LEVEL %d' % level)
+            except error_perm:
+                pass  # the server keeps its own level
+        return True
+
+    def use_epsv_all(self):
+        '''Send EPSV ALL: from now on only EPSV opens data connections,
+        on IPv4 too. Its reply carries just a port, so no address has to
+        be parsed, and NAT rewriting of PASV replies can't get in the way.
+        '''
+        resp = self.voidcmd('EPSV ALL')
+        self.epsv = True
+        return resp
+
+    def _pasv_cmd(self):
+        if self.af == socket.AF_INET and not self.epsv:
+            return 'PASV'
+        return 'EPSV'
+
+    def _parse_pasv(self, resp):
+        if resp[:3] == '227':
+            return parse227(resp)
+        return parse229(resp, self.sock.getpeername())
+
     def makepasv(self):
-        if self.af == socket.AF_INET:
-            host, port = parse227(self.sendcmd('PASV'))
-        else:
-            host, port = parse229(self.sendcmd('EPSV'), self.sock.getpeername())
+        start = time.monotonic()
+        resp = self.sendcmd(self._pasv_cmd())
+        host, port = self._parse_pasv(resp)
+        self._sample_rtt(time.monotonic() - start)
         return host, port
 
+    def _retr_done(self):
+        '''Read the final reply of a download whose data connection has
+        seen EOF.
+
+        With `prefetch` set the PASV/EPSV of the next transfer is written
+        first. The server closed the data connection before it queued its
+        reply, so the two replies arrive in order. The PASV reply is only
+        read after the next command has been written, so the two round
+        trips overlap, and so does whatever the caller does in between.
+        The next data connection starts connecting as soon as the reply
+        is read; ntransfercmd() sends its command without waiting for the
+        connect to finish.
+        '''
+        if self.prefetch and self.passiveserver and self.mode == 'S' \
+                and self._prefetched is None and not self._pasv_pending:
+            # The next command follows before the PASV is acknowledged;
+            # without this Nagle holds it back for a round trip.
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.putline(self._pasv_cmd())
+            self._pasv_pending = True
+        return self.voidresp()
+
+    def _collect_prefetch(self):
+        '''Read a pending prefetch PASV/EPSV reply, before anything else
+        is sent or read.
+        '''
+        if self._pasv_pending:
+            self._pasv_pending = False
+            self._prefetch()
+
+    def _prefetch(self):
+        try:
+            host, port = self._parse_pasv(self.getresp())
+        except Error:
+            return
+        sock = socket.socket(self.af, socket.SOCK_STREAM)
+        try:
+            if self.source_address:
+                sock.bind(self.source_address)
+            sock.setblocking(False)
+            err = sock.connect_ex((host, port))
+        except OSError:
+            sock.close()
+            return
+        if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK):
+            sock.close()
+            return
+        self._prefetched = sock
+
+    def _drop_prefetched(self):
+        if self._prefetched is not None:
+            self._prefetched.close()
+            self._prefetched = None
+
+    def _take_prefetched(self):
+        '''The prefetched data connection, if it is still usable.'''
+        sock, self._prefetched = self._prefetched, None
+        if sock is None:
+            return None
+        readable, writable, _ = select.select([sock], [sock], [], 0)
+        # Readable while idle: the server closed it, after a timeout for
+        # instance. A failed connect shows up the same way.
+        if readable or (writable and
+                        sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)):
+            sock.close()
+            return None
+        return sock
+
+    def _finish_connect(self, sock):
+        timeout = self.timeout
+        if timeout is _GLOBAL_DEFAULT_TIMEOUT:
+            timeout = socket.getdefaulttimeout()
+        _, writable, _ = select.select([], [sock], [], timeout)
+        err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR) \
+            if writable else errno.ETIMEDOUT
+        if err:
+            raise OSError(err, os.strerror(err))
+        sock.settimeout(timeout)
+
+    def _sample_rtt(self, rtt):
+        # Smoothed like TCP's SRTT (RFC 6298): one PASV is a noisy sample.
+        if self.rtt is None:
+            self.rtt = rtt
+        else:
+            self.rtt += (rtt - self.rtt) / 8
+
+    def _tuner(self, conn, opt, blocksize, max_blocksize=MAX_BLOCKSIZE):
+        '''A _Tuner for `conn` when the session is adaptive, else None.'''
+        if not self.adaptive:
+            return None
+        return _Tuner(conn, opt, self.rtt, blocksize, max_blocksize, self.rate)
+
+    def _metered(self, progress=None, digest=None):
+        '''A _Meter that times this session's next transfer and hashes
+        it with the `digest` algorithm, if one is given.'''
+        return _Meter(self, progress, self.progress_interval, digest)
+
+    def _tuned(self, tuner):
+        if tuner is not None and tuner.rate:
+            self.rate = tuner.rate
+
+    def _close_block_sock(self):
+        if self._block_sock is not None:
+            self._block_sock.close()
+            self._block_sock = None
+
+    def _reuse_block_sock(self):
+        '''The MODE B data connection if the next transfer can use it.'''
+        sock = self._block_sock
+        if sock is None:
+            return None
+        if sock.fileno() != -1:
+            # Between transfers nothing may arrive: readable means the
+            # server closed it, after its idle timeout for instance.
+            readable, _, _ = select.select([sock], [], [], 0)
+            if not readable:
+                return sock
+        self._close_block_sock()
+        return None
+
+    @_locked
     def ntransfercmd(self, cmd, rest=None):
         size = None
-        if self.passiveserver:
+        self._collect_prefetch()
+        reused = self._reuse_block_sock() if self.mode == 'B' else None
+        conn = reused or self._take_prefetched()
+        if conn is not None:
+            try:
+                if rest is not None:
+                    self.sendcmd("REST %s" % rest)
+                resp = self.sendcmd(cmd)
+                if resp[0] == '2':
+                    resp = self.getresp()
+                if resp[0] != '1':
+                    raise error_reply(resp)
+            except Error:
+                if conn is not reused:
+                    self._prefetched = conn  # still good for the next one
+                raise
+            except:
+                if conn is not reused:
+                    conn.close()
+                raise
+            if conn is not reused:
+                try:
+                    self._finish_connect(conn)
+                except:
+                    conn.close()
+                    raise
+        elif self.passiveserver:
             host, port = self.makepasv()
             conn = socket.create_connection((host, port), self.timeout,
                                             source_address=self.source_address)
@@ -248,8 +562,21 @@ class FTP:
                 conn, __ = sock.accept()
                 if self.timeout is not _GLOBAL_DEFAULT_TIMEOUT:
                     conn.settimeout(self.timeout)
+        # Until the final reply arrives the keepalive must stay quiet.
+        self._transferring = True
+        if self.tcp_keepalive:
+            set_tcp_keepalive(conn, self.tcp_keepalive)
         if resp[:3] == '150':
             size = parse150(resp)
+        sending = cmd.split(None, 1)[0].upper() in ('STOR', 'APPE', 'STOU')
+        if self.mode == 'Z':
+            conn = _DeflateSocket(conn, sending, self.zlib_level)
+        elif self.mode == 'B':
+            if conn is not self._block_sock:
+                # the 3 byte EOF block must not wait for an ACK
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                self._block_sock = conn
+            conn = _BlockSocket(conn, sending)
         return conn, size
 
     def transfercmd(self, cmd, rest=None):
@@ -258,72 +585,859 @@ class FTP:
 
 
 
-    def retrlines(self, cmd, callback=None):
+    @_locked
+    def retrlines(self, cmd, callback=None, progress=None, batch=False,
+                  blocksize=ASCII_BLOCKSIZE):
+        '''Retrieve data in ASCII mode, passing every line without its
+        line ending to `callback` (print by default).
+
+        The data is read in blocks of `blocksize` bytes and split into
+        lines a block at a time, see _LineSplitter. With `batch` the
+        callback gets the list of lines completed by each block instead
+        of one call per line. Returns TransferStats.
+        '''
         if callback is None:
             callback = print
-        resp = self.sendcmd('TYPE A')
-        # num_lines = sum(1 for l in open('ftp.py', 'r'))
-        with self.transfercmd(cmd) as conn, \
-                 conn.makefile('r', encoding=self.encoding) as fp:
-            # import time
-            # for i in tqdm(range(num_lines + 1)):
-            while True:
-                # time.sleep(0.02)
-                line = fp.readline(self.maxline + 1)
-                if len(line) > self.maxline:
-                    raise Error("got more than %d bytes" % self.maxline)
-                if not line:
-                    break
-                if line[-2:] == CRLF:
-                    line = line[:-2]
-                elif line[-1:] == '\n':
-                    line = line[:-1]
-                callback(line);
-                # self.send_noop();
-        return self.voidresp()
+        received = 0
+        splitter = _LineSplitter(self.encoding, self.maxline)
+        with self._metered(progress) as meter:
+            resp = self.sendcmd('TYPE A')
+            with self.transfercmd(cmd) as conn:
+                while True:
+                    data = conn.recv(blocksize)
+                    lines = splitter.feed(data) if data else splitter.close()
+                    if lines:
+                        if batch:
+                            callback(lines)
+                        else:
+                            for line in lines:
+                                callback(line)
+                    if not data:
+                        break
+                    received += len(data)
+                    meter(received)
+            return meter.done(self._retr_done())
 
-    def storlines(self, cmd, fp, callback=None):
-        self.voidcmd('TYPE A')  # type ASCII (text)
-        with self.transfercmd(cmd) as conn:
-            while True:
-                buf = fp.readline(self.maxline + 1)
-                if not buf:
-                    break
-                if buf[-2:] != B_CRLF:
-                    if buf[-1] in B_CRLF: buf = buf[:-1]
-                    buf = buf + B_CRLF
-                conn.sendall(buf)
-                if callback:
-                    callback(buf)
+    @_locked
+    def storlines(self, cmd, fp, callback=None, progress=None, batch=False,
+                  blocksize=ASCII_BLOCKSIZE):
+        '''Store the lines of the binary file `fp` in ASCII mode, each
+        one ending in CR LF.
 
+        Unless a per-line `callback` is given, `fp` is read in blocks of
+        `blocksize` bytes and LF is turned into CR LF on the whole block
+        with bytes.replace; a CR LF split between two blocks stays one
+        line ending. With `batch` the callback gets every translated
+        block. Without it, it is called with every line, read one at a
+        time. Returns TransferStats.
+        '''
+        self._invalidate(_cmd_path(cmd))
+        with self._metered(progress) as meter:
+            self.voidcmd('TYPE A')  # type ASCII (text)
+            with self.transfercmd(cmd) as conn:
+                if callback is not None and not batch:
+                    self._storlines(conn, fp, callback, meter)
+                else:
+                    _sendlines(conn, fp, blocksize, callback, meter)
+            return meter.done(self.voidresp())
 
-        return self.voidresp()
+    def _storlines(self, conn, fp, callback, meter):
+        sent = 0
+        while True:
+            buf = fp.readline(self.maxline + 1)
+            if not buf:
+                break
+            if buf[-2:] != B_CRLF:
+                if buf[-1] in B_CRLF: buf = buf[:-1]
+                buf = buf + B_CRLF
+            conn.sendall(buf)
+            sent += len(buf)
+            meter(sent)
+            callback(buf)
+        return sent
 
-    def retrbinary(self, cmd, callback, n_block, blocksize=8192, rest=None):
-        self.voidcmd('TYPE I')  # type Image (binary)
-        with self.transfercmd(cmd, rest) as conn:
-            for i in tqdm(range(n_block)):
-                data = conn.recv(blocksize)
-                if not data:
-                    break
-                callback(data)
-                if (i + 1) % 5 == 0:
-                    self.send_noop()
-        return self.voidresp()
+    @_locked
+    def retrbinary(self, cmd, callback, n_block=None, blocksize=8192,
+                   rest=None, progress=None, digest=None):
+        '''Retrieve data in binary mode, passing every block to `callback`.
 
-    def storbinary(self, cmd, fp, n_block, blocksize=8192, callback=None, rest=None):
-        self.voidcmd('TYPE I')
-        with self.transfercmd(cmd, rest) as conn:
-            for i in tqdm(range(n_block + 1)):
-                buf = fp.read(blocksize)
-                if not buf:
-                    break
-                conn.sendall(buf)
-                if callback:
-                    callback(buf)
-                if (i + 1) % 5 == 0:
-                    self.send_noop()
-        return self.voidresp()
+        The transfer runs until the server closes the data connection.
+        `progress` is called with the byte count at most every
+        `progress_interval` seconds; without it a tqdm bar is shown when
+        `n_block` is given. On an adaptive session the block size grows
+        with the measured bandwidth-delay product. With a `digest`
+        algorithm ('sha256', 'md5', 'crc32', ...) the data is hashed on a
+        worker thread as it arrives. Returns TransferStats, whose `digest`
+        holds the hex digest.
+        '''
+        bar = None
+        if progress is None and n_block is not None:
+            bar = progress_bar(n_block * blocksize)
+            progress = lambda n: bar.update(n - bar.n)
+        received = 0
+        try:
+            with self._metered(progress, digest) as meter:
+                self.voidcmd('TYPE I')  # type Image (binary)
+                with self.transfercmd(cmd, rest) as conn:
+                    # recv() allocates a fresh bytes object of the full block
+                    # size every call, so stay well below MAX_BLOCKSIZE here.
+                    tuner = self._tuner(conn, socket.SO_RCVBUF, blocksize, 2**20)
+                    while True:
+                        data = conn.recv(blocksize)
+                        if not data:
+                            break
+                        callback(data)
+                        if meter.hash:
+                            meter.hash.update(data)
+                        received += len(data)
+                        meter(received)
+                        if tuner:
+                            blocksize = tuner.update(len(data))
+                self._tuned(tuner)
+                return meter.done(self._retr_done())
+        finally:
+            if bar is not None:
+                bar.close()
+
+    @_locked
+    def storbinary(self, cmd, fp, n_block=None, blocksize=None, callback=None,
+                   rest=None, progress=None, digest=None):
+        '''Store a file in binary mode.
+
+        Without a per-block `callback` regular files are sent with
+        sendfile(), so the kernel moves the bytes, and other sources go
+        through one large reusable buffer. `progress` is called with the
+        byte count at most every `progress_interval` seconds. With a
+        `callback` every block of `blocksize` bytes is read into Python
+        and passed to it; a tqdm bar sized by `n_block` is shown when there
+        is no `progress`. When `rest` is given a seekable `fp` is
+        positioned at that offset too. With a `digest` algorithm what is
+        sent is hashed on a worker thread, as in retrbinary(); after
+        sendfile() the hash reads the file back, from the page cache.
+        Returns TransferStats.
+        '''
+        if rest is not None and _seekable(fp):
+            fp.seek(rest)
+        self._invalidate(_cmd_path(cmd))
+        if callback is None:
+            with self._metered(progress, digest) as meter:
+                self.voidcmd('TYPE I')
+                with self.transfercmd(cmd, rest) as conn:
+                    tuner = self._tuner(conn, socket.SO_SNDBUF,
+                                        blocksize or SEND_BLOCKSIZE)
+                    _sendfrom(conn, fp, blocksize or SEND_BLOCKSIZE, meter,
+                              tuner=tuner, digest=meter.hash)
+                self._tuned(tuner)
+                return meter.done(self.voidresp())
+        blocksize = blocksize or 8192
+        bar = None
+        if progress is None and n_block is not None:
+            bar = progress_bar(n_block * blocksize)
+            progress = lambda n: bar.update(n - bar.n)
+        sent = 0
+        try:
+            with self._metered(progress, digest) as meter:
+                self.voidcmd('TYPE I')
+                with self.transfercmd(cmd, rest) as conn:
+                    tuner = self._tuner(conn, socket.SO_SNDBUF, blocksize)
+                    while True:
+                        buf = fp.read(blocksize)
+                        if not buf:
+                            break
+                        conn.sendall(buf)
+                        if meter.hash:
+                            meter.hash.update(buf)
+                        sent += len(buf)
+                        meter(sent)
+                        callback(buf)
+                        if tuner:
+                            blocksize = tuner.update(len(buf))
+                self._tuned(tuner)
+                return meter.done(self.voidresp())
+        finally:
+            if bar is not None:
+                bar.close()
+
+    @_locked
+    def retrinto(self, cmd, sink, rest=None, blocksize=65536,
+                 max_blocksize=MAX_BLOCKSIZE, progress=None, digest=None):
+        '''High-throughput variant of retrbinary.
+
+        Data is received with recv_into into one reusable buffer and
+        handed to `sink` as memoryview slices that are only valid during
+        the call. `sink` is a file descriptor, an object with a write()
+        method or a plain callable. The buffer doubles, up to
+        `max_blocksize`, whenever a single recv fills it; an adaptive
+        session also grows SO_RCVBUF toward the bandwidth-delay product.
+        `progress` is called with the byte count at most every
+        `progress_interval` seconds and once more when the transfer ends.
+        `digest` hashes the data as in retrbinary(). Returns TransferStats.
+        '''
+        if isinstance(sink, int):
+            write = _fd_writer(sink)
+        else:
+            write = getattr(sink, 'write', sink)
+        received = 0
+        buf = bytearray(blocksize)
+        view = memoryview(buf)
+        with self._metered(progress, digest) as meter:
+            self.voidcmd('TYPE I')
+            with self.transfercmd(cmd, rest) as conn:
+                tuner = self._tuner(conn, socket.SO_RCVBUF, blocksize, max_blocksize)
+                while True:
+                    n = conn.recv_into(view)
+                    if not n:
+                        break
+                    write(view[:n])
+                    if meter.hash:
+                        meter.hash.update(bytes(view[:n]))
+                    received += n
+                    meter(received)
+                    if tuner:
+                        tuner.update(n)
+                    if n == len(buf) and n < max_blocksize:
+                        buf = bytearray(min(2 * n, max_blocksize))
+                        view = memoryview(buf)
+            self._tuned(tuner)
+            return meter.done(self._retr_done())
+
+    @_locked
+    def retrfile(self, cmd, local_path, size=None, rest=None,
+                 blocksize=MAX_BLOCKSIZE, flush_every=MMAP_FLUSH, progress=None,
+                 digest=None):
+        '''Download into the file at `local_path`, from offset `rest` on.
+
+        The file is created if needed and cut at `rest` (at 0 without
+        one). `size` is the full remote size, from SIZE say; without it
+        the size in the 150 reply is used, unless `rest` is given. When
+        the size is known the rest of the file is preallocated with
+        posix_fallocate, mapped, and received with recv_into straight
+        into the mapping, up to `blocksize` bytes at a time. Every
+        `flush_every` bytes the range written since the last flush is
+        msync'ed; msync waits for the disk, so this bounds dirty memory
+        at a price in throughput. None leaves flushing to the kernel.
+        Unknown sizes, empty files and filesystems that can't map files
+        fall back to recv_into + write, as do bytes beyond the expected
+        size. The file ends where the data did. `digest` hashes the data
+        as in retrbinary(), reading it back from the page cache. Returns
+        TransferStats.
+        '''
+        start = rest or 0
+        received = 0
+        fd = os.open(local_path, os.O_RDWR | os.O_CREAT | getattr(os, 'O_BINARY', 0),
+                     0o666)
+        try:
+            os.ftruncate(fd, start)
+            with self._metered(progress, digest) as meter:
+                self.voidcmd('TYPE I')
+                conn, announced = self.ntransfercmd(cmd, rest)
+                with conn:
+                    tuner = self._tuner(conn, socket.SO_RCVBUF, blocksize, blocksize)
+                    if size is None and rest is None:
+                        size = announced
+                    mapped = None
+                    if size is not None and size > start:
+                        mapped = _MappedFile.create(fd, start, size, flush_every)
+                    eof = False
+                    if mapped is not None:
+                        with mapped:
+                            while mapped.left:
+                                n = mapped.recv_from(conn, blocksize)
+                                if not n:
+                                    eof = True
+                                    break
+                                if meter.hash:
+                                    meter.hash.update_file(fd, start + received, n)
+                                received += n
+                                meter(received)
+                                if tuner:
+                                    tuner.update(n)
+                    if not eof:
+                        os.lseek(fd, start + received, os.SEEK_SET)
+                        write = _fd_writer(fd)
+                        buf = bytearray(min(blocksize, 65536))
+                        view = memoryview(buf)
+                        while True:
+                            n = conn.recv_into(view)
+                            if not n:
+                                break
+                            write(view[:n])
+                            if meter.hash:
+                                meter.hash.update_file(fd, start + received, n)
+                            received += n
+                            meter(received)
+                            if tuner:
+                                tuner.update(n)
+                            if n == len(buf) and n < blocksize:
+                                buf = bytearray(min(2 * n, blocksize))
+                                view = memoryview(buf)
+                self._tuned(tuner)
+                return meter.done(self._retr_done())
+        finally:
+            try:
+                # drops whatever was preallocated but never received
+                os.ftruncate(fd, start + received)
+            finally:
+                os.close(fd)
+
+    def retrsegmented(self, filename, local_path, segments=4, blocksize=65536):
+        '''Download a remote file over several data connections at once.
+
+        The file is split into contiguous byte ranges, one per segment.
+        Every range is fetched by its own logged-in session with
+        REST + RETR and written straight into a preallocated local file
+        at its offset. An empty file, or one SIZE can't tell the size
+        of, comes with one plain RETR. Returns TransferStats for the
+        whole file, timed from SIZE to the last final reply.
+        '''
+        started = time.monotonic()
+        size = self.size(filename)
+        if not size:
+            with open(local_path, 'wb') as fp:
+                return self.retrinto(f'RETR {filename}', fp)
+        with open(local_path, 'wb') as fp:
+            if hasattr(os, 'posix_fallocate'):
+                os.posix_fallocate(fp.fileno(), 0, size)
+            else:
+                fp.truncate(size)
+
+        segments = max(1, min(segments, size // MIN_SEGMENT))
+        step = -(-size // segments)  # ceiling division
+        ranges = [(start, min(start + step, size)) for start in range(0, size, step)]
+
+        sessions = [self]
+        try:
+            sessions += [self.clone() for _ in ranges[1:]]
+            with ThreadPoolExecutor(max_workers=len(ranges)) as pool:
+                jobs = [pool.submit(session._retrrange, filename, local_path,
+                                    start, end, blocksize)
+                        for session, (start, end) in zip(sessions, ranges)]
+                parts = [job.result() for job in jobs]
+        finally:
+            for session in sessions[1:]:
+                try:
+                    session.quit()
+                except all_errors:
+                    session.close()
+        written = sum(part.bytes for part in parts)
+        if written != size:
+            raise Error(f'{filename}: got {written} of {size} bytes')
+        return _merge_stats(parts, started)
+
+    @_locked
+    def _retrrange(self, filename, local_path, start, end, blocksize):
+        '''Fetch bytes [start, end) of a remote file into the same range of
+        an existing local file, then drop the data connection. Returns
+        TransferStats.
+        '''
+        with self._metered() as meter:
+            self.voidcmd('TYPE I')
+            remaining = end - start
+            buf = bytearray(blocksize)
+            view = memoryview(buf)
+            with open(local_path, 'r+b') as fp:
+                fp.seek(start)
+                with self.transfercmd(f'RETR {filename}', rest=start) as conn:
+                    while remaining:
+                        n = conn.recv_into(view, min(blocksize, remaining))
+                        if not n:
+                            break
+                        fp.write(view[:n])
+                        remaining -= n
+                        meter(end - start - remaining)
+            # Closing the data connection before EOF makes the server abort
+            # the rest of the file, answering 426 instead of 226.
+            try:
+                resp = self.voidresp()
+            except error_temp as e:
+                resp = str(e)
+            return meter.done(resp)
+
+    def store_resumable(self, local, remote, chunk_size=None, appe=False,
+                        progress=None):
+        '''Upload `local` to `remote`, continuing an interrupted upload.
+
+        The remote SIZE says how much already arrived; the rest follows
+        with REST + STOR, or with APPE when `appe` is set. A remote file
+        larger than the local one is uploaded again from scratch. With a
+        `chunk_size` the rest is sent as a series of REST + STOR transfers
+        of that many bytes, each one completed (226) before the next, so a
+        dropped link loses at most one chunk; just call again to go on.
+        Returns TransferStats for what was sent, so the upload resumed
+        `bytes` before the end of `local`.
+        '''
+        started = time.monotonic()
+        local_size = os.path.getsize(local)
+        try:
+            offset = self.size(remote) or 0
+        except error_perm:  # not there yet
+            offset = 0
+        if offset > local_size:
+            offset = 0
+        report = progress and (lambda n: progress(offset + n))
+        parts = []
+        with open(local, 'rb') as fp:
+            if chunk_size is None and offset < local_size:
+                if appe and offset:
+                    fp.seek(offset)
+                    parts.append(self.storbinary(f'APPE {remote}', fp,
+                                                 progress=report))
+                else:
+                    parts.append(self.storbinary(f'STOR {remote}', fp,
+                                                 rest=offset or None,
+                                                 progress=report))
+            elif offset == 0 and local_size == 0:
+                parts.append(self.storbinary(f'STOR {remote}', fp))
+            else:
+                while offset < local_size:
+                    count = min(chunk_size, local_size - offset)
+                    parts.append(self._storrange(remote, fp, offset, count, appe))
+                    offset += count
+                    if progress:
+                        progress(offset)
+        return _merge_stats(parts, started)
+
+    @_locked
+    def _storrange(self, remote, fp, offset, count, appe=False):
+        '''Store `count` bytes of `fp` at `offset` of the remote file.'''
+        self._invalidate(remote)
+        fp.seek(offset)
+        if appe and offset:
+            cmd, rest = f'APPE {remote}', None
+        else:
+            cmd, rest = f'STOR {remote}', offset or None
+        with self._metered() as meter:
+            self.voidcmd('TYPE I')
+            with self.transfercmd(cmd, rest) as conn:
+                sent = _sendfrom(conn, fp, SEND_BLOCKSIZE, meter, count=count)
+            if sent != count:
+                raise Error(f'{remote}: sent {sent} of {count} bytes')
+            return meter.done(self.voidresp())
+
+    def block_hashes(self, path, blocksize):
+        '''SHA-256 hex digests of every `blocksize` block of the remote
+        file `path` and of the whole file, from the pyftpdlib extension
+        SITE BLKHASH. Returns (size, block digests, whole-file digest).
+        '''
+        resp = self.sendcmd(f'SITE BLKHASH {blocksize} {path}')
+        lines = resp.split('\n')
+        try:
+            algorithm, reply_blocksize, size = lines[0][4:].split()
+            if (resp[:4] != '213-' or algorithm != 'SHA-256' or
+                    int(reply_blocksize) != blocksize):
+                raise ValueError
+        except ValueError:
+            raise error_reply(resp)
+        return int(size), [line.strip() for line in lines[1:-1]], lines[-1][4:].strip()
+
+    def store_delta(self, local, remote, blocksize=DELTA_BLOCKSIZE,
+                    progress=None):
+        '''Upload `local` over `remote`, sending only the blocks that
+        changed, rsync style.
+
+        The remote file's block hashes (see block_hashes()) are fetched
+        while the local file is hashed. Runs of blocks that differ, and
+        whatever lies past the remote end, are then sent with REST +
+        STOR after OPTS STOR INPLACE ON, which has the server write into
+        the file instead of truncating it; the option is turned off
+        again afterwards. At the end the remote whole-file hash has to
+        match the local one. If it doesn't, the file is stored in full.
+        A remote file that is missing or larger than `local` (STOR can't
+        make a file shorter in place) is stored in full too, and so is
+        any file on a server without OPTS STOR INPLACE or SITE BLKHASH,
+        unchecked in the latter case. `progress` gets the bytes sent so
+        far. Returns a DeltaResult with the (offset, count) ranges sent.
+        '''
+        size = os.path.getsize(local)
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            local_hashes = executor.submit(_block_hashes, local, blocksize)
+            try:
+                remote_size, remote_blocks, remote_whole = self.block_hashes(remote, blocksize)
+            except error_perm as e:
+                code = str(e)[:3]
+                if code in ('500', '502', '504'):  # no SITE BLKHASH
+                    remote_size = None
+                elif code == '550':  # not there yet
+                    remote_size, remote_blocks, remote_whole = -1, [], None
+                else:
+                    raise
+            blocks, whole = local_hashes.result()
+
+        in_place = remote_size is not None and 0 <= remote_size <= size
+        if in_place:
+            if remote_size == size and remote_whole == whole:
+                return DeltaResult(size, 0, [])
+            try:
+                self.voidcmd('OPTS STOR INPLACE ON')
+            except error_perm:  # every STOR would truncate
+                in_place = False
+        if in_place:
+            ranges = _changed_ranges(blocks, remote_blocks, blocksize, size)
+        else:
+            ranges = [(0, size)]
+        sent = 0
+        with open(local, 'rb') as fp:
+            try:
+                for offset, count in ranges:
+                    self._storrange(remote, fp, offset, count)
+                    sent += count
+                    if progress:
+                        progress(sent)
+            finally:
+                if in_place:
+                    # never leave a pooled session overwriting in place
+                    try:
+                        self.voidcmd('OPTS STOR INPLACE OFF')
+                    except all_errors:
+                        self.close()
+            if remote_size is None:  # nothing to check with
+                return DeltaResult(size, sent, ranges)
+            verified = self.block_hashes(remote, blocksize)[::2] == (size, whole)
+            if not verified and in_place:
+                self._storrange(remote, fp, 0, size)
+                sent, ranges = sent + size, [(0, size)]
+                if progress:
+                    progress(sent)
+                verified = self.block_hashes(remote, blocksize)[::2] == (size, whole)
+        if not verified:
+            raise Error(f'{remote}: hash differs from {local} after upload')
+        return DeltaResult(size, sent, ranges)
+
+    def download_resumable(self, remote, local, checkpoint=CHECKPOINT_BYTES,
+                           progress=None):
+        '''Crash-safe download of `remote` to `local` that resumes with REST.
+
+        A JSON journal next to the local file (local + JOURNAL_SUFFIX)
+        records the remote path, size and MDTM time and the offset up to
+        which the local file is known to be on disk. Data is written
+        through one buffered file; every `checkpoint` bytes, and when the
+        transfer fails, the file is fsync'ed before the journal moves
+        forward. A later call resumes from the journaled offset, or starts
+        over when the remote size or mtime changed in between or there is
+        no journal; on a server without MDTM only the size is compared.
+        The journal is removed once the file is complete.
+        '''
+        size = self._size(remote)  # a cached size may be stale
+        try:
+            mtime = self.mdtm(remote)
+        except error_perm:
+            mtime = None
+        journal = local + JOURNAL_SUFFIX
+        state = {'remote': remote, 'size': size, 'mtime': mtime, 'offset': 0}
+        keys = ('remote', 'size') if mtime is None else ('remote', 'size', 'mtime')
+
+        offset, changed = 0, False
+        try:
+            with open(journal) as fp:
+                saved = json.load(fp)
+        except (OSError, ValueError):
+            saved = None
+        if saved is not None and os.path.exists(local):
+            if all(saved.get(k) == state[k] for k in keys):
+                offset = min(saved.get('offset', 0), os.path.getsize(local))
+            else:
+                changed = True
+
+        def commit(fp, written):
+            fp.flush()
+            os.fsync(fp.fileno())
+            state['offset'] = written
+            _write_journal(journal, state)
+
+        mode = 'r+b' if offset else 'wb'
+        with open(local, mode, buffering=SEND_BLOCKSIZE) as fp:
+            fp.truncate(offset)
+            fp.seek(offset)
+            commit(fp, offset)
+            done = [offset, offset + checkpoint]  # bytes on disk, next commit
+
+            def write(data):
+                fp.write(data)
+                done[0] += len(data)
+                if done[0] >= done[1]:
+                    commit(fp, done[0])
+                    done[1] = done[0] + checkpoint
+
+            try:
+                if offset < size:
+                    self.retrinto(f'RETR {remote}', write, rest=offset or None,
+                                  progress=progress and (lambda n: progress(offset + n)))
+            finally:
+                commit(fp, done[0])
+        if done[0] != size:
+            raise Error(f'{remote}: got {done[0]} of {size} bytes')
+        os.remove(journal)
+        return DownloadResult(size, offset, changed)
+
+    def mirror(self, remote, local, workers=4, pool=None):
+        '''Mirror the remote directory tree `remote` into `local`.
+
+        Directories are listed with MLSD and a file is downloaded only
+        when it is missing locally or its size or modification time
+        differs; downloaded files get the remote mtime. Listings and
+        downloads run concurrently on up to `workers` sessions taken from
+        `pool` (a private FTPPool when None). Files are fetched into a
+        `.part` file that replaces the target once complete. Returns a
+        MirrorResult; per-file failures are collected, not raised.
+        '''
+        remote = posixpath.join(self.pwd(), remote)
+        own_pool = pool is None
+        if own_pool:
+            pool = FTPPool(max_size=workers, timeout=self.timeout,
+                           source_address=self.source_address)
+        key = self._pool_key()
+        result = MirrorResult([], [], [])
+
+        def listdir(remote_dir, local_dir):
+            os.makedirs(local_dir, exist_ok=True)
+            with pool.session(*key) as session:
+                entries = list(session.mlsd(remote_dir, ['type', 'size', 'modify']))
+            jobs = []
+            for entry in entries:
+                remote_path = posixpath.join(remote_dir, entry.name)
+                local_path = os.path.join(local_dir, entry.name)
+                if entry.type == 'dir':
+                    jobs.append((listdir, remote_path, local_path))
+                elif entry.type == 'file':
+                    if _up_to_date(local_path, entry.size, entry.modify):
+                        result.skipped.append(remote_path)
+                    else:
+                        jobs.append((download, remote_path, local_path,
+                                     entry.size, entry.modify))
+            return jobs
+
+        def download(remote_path, local_path, size, mtime):
+            partial = local_path + '.part'
+            with pool.session(*key) as session:
+                session.retrfile(f'RETR {remote_path}', partial, size)
+            os.replace(partial, local_path)
+            if mtime is not None:
+                os.utime(local_path, (mtime, mtime))
+            result.downloaded.append(remote_path)
+            return []
+
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                pending = {executor.submit(listdir, remote, local): remote}
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for job in done:
+                        path = pending.pop(job)
+                        try:
+                            follow_ups = job.result()
+                        except all_errors as e:
+                            result.failed.append((path, e))
+                            continue
+                        for func, *args in follow_ups:
+                            pending[executor.submit(func, *args)] = args[0]
+        finally:
+            if own_pool:
+                pool.close()
+        return result
+
+    def walk(self, top='', workers=4, pool=None, maxdepth=None, filter=None,
+             onerror=None, facts=('type', 'size', 'modify')):
+        '''Yield (dirpath, dirs, files) for every directory of the remote
+        tree under `top`, like os.walk(); dirs and files are lists of
+        MLSDEntry.
+
+        The tree is crawled breadth first with MLSD, listing up to
+        `workers` directories at once on sessions from `pool` (a private
+        FTPPool when None), fewer when the pool has fewer sessions to
+        spare. Directories come out as their listings complete.
+        Subdirectories are queued only once their parent has been
+        yielded, so removing entries from `dirs` prunes the walk.
+        Besides the paths still to visit, at most `workers` listings are
+        held. `maxdepth` limits how far below `top` to go (0 lists `top`
+        only). An entry for which `filter(dirpath, entry)` is false is
+        left out, and a directory left out is not entered. Directories
+        that can't be listed are skipped after `onerror(dirpath, error)`
+        is called, if given.
+        '''
+        top = posixpath.normpath(posixpath.join(self.pwd(), top))
+        own_pool = pool is None
+        if own_pool:
+            pool = FTPPool(max_size=workers, timeout=self.timeout,
+                           source_address=self.source_address)
+        key = self._pool_key()
+        # Sessions stay checked out for the whole walk: taking one from
+        # the pool for every directory would cost a NOOP round trip each.
+        # When a small or shared pool has none to spare, the workers take
+        # turns on those the walk already holds. A session that broke
+        # leaves None in `idle`, so that a new one takes its place.
+        idle = queue.SimpleQueue()
+        held = []
+
+        def checkout():
+            try:
+                session = idle.get_nowait()
+            except queue.Empty:
+                session = None
+                if held:
+                    try:
+                        session = pool.acquire(*key, timeout=0)
+                    except error_temp:
+                        session = idle.get()
+                    else:
+                        held.append(session)
+                        return session
+            if session is None:
+                session = pool.acquire(*key)
+                held.append(session)
+            return session
+
+        def listdir(path):
+            session = checkout()
+            try:
+                entries = list(session.mlsd(path, facts))
+            except (error_temp, error_perm):
+                idle.put(session)
+                raise
+            except:
+                held.remove(session)
+                pool.release(session, broken=True)
+                idle.put(None)
+                raise
+            idle.put(session)
+            return entries
+
+        frontier = collections.deque([(top, 0)])
+        pending = {}
+        try:
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                while frontier or pending:
+                    while frontier and len(pending) < workers:
+                        path, depth = frontier.popleft()
+                        pending[executor.submit(listdir, path)] = (path, depth)
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for job in done:
+                        path, depth = pending.pop(job)
+                        try:
+                            entries = job.result()
+                        except all_errors as e:
+                            if onerror is not None:
+                                onerror(path, e)
+                            continue
+                        dirs, files = [], []
+                        for entry in entries:
+                            if entry.type in ('cdir', 'pdir'):
+                                continue
+                            if filter is not None and not filter(path, entry):
+                                continue
+                            (dirs if entry.type == 'dir' else files).append(entry)
+                        yield path, dirs, files
+                        if maxdepth is None or depth < maxdepth:
+                            frontier.extend((posixpath.join(path, entry.name), depth + 1)
+                                            for entry in dirs)
+        finally:
+            while not idle.empty():
+                session = idle.get()
+                if session is not None:
+                    pool.release(session)
+            if own_pool:
+                pool.close()
+
+    def glob(self, pattern):
+        '''Remote paths matching the shell `pattern`, expanded with MLSD.
+
+        Any path component may hold wildcards; the last one only matches
+        files. As with shell globbing, wildcards do not match a leading
+        dot, and a pattern without wildcards is returned as is.
+        '''
+        paths = ['/' if pattern.startswith('/') else '']
+        parts = [part for part in pattern.split('/') if part]
+        for i, part in enumerate(parts):
+            last = i == len(parts) - 1
+            if not _has_magic(part):
+                paths = [posixpath.join(base, part) for base in paths]
+                continue
+            matches = []
+            for base in paths:
+                for entry in self.mlsd(base, ['type']):
+                    if entry.type != ('file' if last else 'dir'):
+                        continue
+                    if entry.name.startswith('.') and not part.startswith('.'):
+                        continue
+                    if fnmatch.fnmatchcase(entry.name, part):
+                        matches.append(posixpath.join(base, entry.name))
+            paths = sorted(matches)
+        return paths
+
+    def mget(self, patterns, local_dir='.', workers=4, pool=None):
+        '''Download every remote file matching the shell `patterns` into
+        `local_dir`, on up to `workers` sessions from `pool`.
+
+        Files arrive in a `.part` file that replaces the target once
+        complete. Returns a BatchResult of (remote path, TransferStats)
+        and (remote path or pattern, error) pairs; a pattern that matches
+        nothing is a failure.
+        '''
+        cwd = self.pwd()
+        jobs, unmatched = [], []
+        for pattern in patterns:
+            paths = self.glob(posixpath.join(cwd, pattern))
+            if not paths:
+                unmatched.append((pattern, Error(f'{pattern}: no match')))
+            for path in paths:
+                local_path = os.path.join(local_dir, posixpath.basename(path))
+                jobs.append((path, functools.partial(_fetch, remote_path=path,
+                                                     local_path=local_path)))
+        result = self._batch(jobs, workers, pool)
+        result.failed.extend(unmatched)
+        return result
+
+    def mput(self, patterns, remote_dir='', workers=4, pool=None):
+        '''Upload every local file matching the shell `patterns` into
+        `remote_dir`, on up to `workers` sessions from `pool`.
+
+        Returns a BatchResult like mget().
+        '''
+        remote_dir = posixpath.join(self.pwd(), remote_dir)
+        jobs, unmatched = [], []
+        for pattern in patterns:
+            paths = sorted(p for p in glob.glob(pattern) if os.path.isfile(p))
+            if not paths:
+                unmatched.append((pattern, Error(f'{pattern}: no match')))
+            for path in paths:
+                remote_path = posixpath.join(remote_dir, os.path.basename(path))
+                jobs.append((path, functools.partial(_send, local_path=path,
+                                                     remote_path=remote_path)))
+        result = self._batch(jobs, workers, pool)
+        result.failed.extend(unmatched)
+        return result
+
+    def _batch(self, jobs, workers, pool=None):
+        '''Run (name, func(session)) `jobs` on up to `workers` sessions
+        taken from `pool` (a private FTPPool when None). Returns a
+        BatchResult in job order.
+        '''
+        own_pool = pool is None
+        if own_pool:
+            pool = FTPPool(max_size=workers, timeout=self.timeout,
+                           source_address=self.source_address)
+        key = self._pool_key()
+        result = BatchResult([], [])
+
+        def run(func):
+            with pool.session(*key) as session:
+                return func(session)
+
+        try:
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+                futures = [(name, executor.submit(run, func)) for name, func in jobs]
+                for name, future in futures:
+                    try:
+                        result.done.append((name, future.result()))
+                    except all_errors as e:
+                        result.failed.append((name, e))
+        finally:
+            if own_pool:
+                pool.close()
+        return result
+
+    def _pool_key(self):
+        '''FTPPool.session() arguments for sessions like this one.'''
+        return (self.host, self.port, self.user, self.passwd, self.acct)
 
 
 
@@ -333,7 +1447,8 @@ class FTP:
         '''Return current working directory
         '''
         resp = self.voidcmd('PWD')
-        return parse257(resp)
+        self._cwd = parse257(resp)
+        return self._cwd
 
     def dir(self, *args):
         callback = None
@@ -351,24 +1466,66 @@ class FTP:
         self.retrlines(cmd, files.append)
         return files
 
-    def mlsd(self, path="", facts=[]):
-        if facts:
-            self.sendcmd("OPTS MLST " + ";".join(facts) + ";")
-        if path:
-            cmd = "MLSD %s" % path
-        else:
-            cmd = "MLSD"
-        lines = []
-        self.retrlines(cmd, lines.append)
-        for line in lines:
-            facts_found, _, name = line.rstrip(CRLF).partition(' ')
-            entry = {}
-            for fact in facts_found[:-1].split(";"):
-                key, _, value = fact.partition("=")
-                entry[key.lower()] = value
-            yield (name, entry)
+    def mlsd(self, path="", facts=[], stream=False):
+        '''Yield an MLSDEntry per line of an MLSD listing.
+
+        Entries are parsed while the listing arrives on the data
+        connection. With a cache enabled the listing is materialized and
+        stored, unless `stream` asks for the bounded-memory path.
+        '''
+        if self.cache is None or stream:
+            yield from self._mlsd(path, facts)
+            return
+        key = ('mlsd', self._abspath(path), tuple(facts))
+        entries = self.cache.get(key)
+        if entries is None:
+            entries = list(self._mlsd(path, facts))
+            self.cache.put(key, entries)
+        yield from entries
+
+    def _mlsd(self, path, facts):
+        with self._lock:
+            # the server keeps the facts for the rest of the session
+            if facts and tuple(facts) != self._mlst_facts:
+                self.sendcmd("OPTS MLST " + ";".join(facts) + ";")
+                self._mlst_facts = tuple(facts)
+            if path:
+                cmd = "MLSD %s" % path
+            else:
+                cmd = "MLSD"
+            self.voidcmd('TYPE A')
+            complete = False
+            try:
+                with self.transfercmd(cmd) as conn, conn.makefile('rb') as fp:
+                    while True:
+                        line = fp.readline(self.maxline + 1)
+                        if len(line) > self.maxline:
+                            raise Error("got more than %d bytes" % self.maxline)
+                        if not line:
+                            break
+                        yield parse_mlsd_line(line.decode(self.encoding))
+                complete = True
+            finally:
+                if complete:
+                    self._retr_done()
+                elif self._transferring:
+                    # abandoned or failed mid-listing: collect the 226/426
+                    try:
+                        self.getresp()
+                    except (error_temp, error_perm):
+                        pass
 
     def size(self, filename):
+        if self.cache is not None:
+            key = ('size', self._abspath(filename))
+            size = self.cache.get(key)
+            if size is None:
+                size = self._size(filename)
+                self.cache.put(key, size)
+            return size
+        return self._size(filename)
+
+    def _size(self, filename):
         self.voidcmd('TYPE I')
         # The SIZE command is defined in RFC-3659
         resp = self.sendcmd('SIZE ' + filename)
@@ -376,10 +1533,36 @@ class FTP:
             s = resp[3:].strip()
             return int(s)
 
+    def mdtm(self, filename):
+        '''Return the modification time of a remote file as a timestamp.'''
+        # The MDTM command is defined in RFC-3659
+        resp = self.voidcmd('MDTM ' + filename)
+        return parse_mlsd_time(resp[3:].strip())
+
+    def enable_cache(self, ttl=CACHE_TTL, maxsize=CACHE_MAXSIZE, cache=None):
+        '''Cache MLSD listings and file sizes by absolute remote path.
+
+        Entries expire after `ttl` seconds and at most `maxsize` are kept,
+        least recently used first out. mkd, rmd, delete, rename and the
+        store methods invalidate what they change. Pass `cache` to share
+        one MetadataCache between sessions on the same server.
+        '''
+        self.cache = cache or MetadataCache(ttl, maxsize)
+
+    def _abspath(self, path):
+        if self._cwd is None:
+            self.pwd()
+        return posixpath.normpath(posixpath.join(self._cwd, path))
+
+    def _invalidate(self, path):
+        if self.cache is not None:
+            self.cache.invalidate(self._abspath(path))
+
 
 
 
     def cwd(self, dirname):
+        self._cwd = None
         if dirname == '..':
             try:
                 return self.voidcmd('CDUP')
@@ -391,35 +1574,82 @@ class FTP:
         return self.voidcmd(cmd)  # expect 2xx response
 
     def rename(self, fromname, toname):
+        self._invalidate(fromname)
+        self._invalidate(toname)
         resp = self.sendcmd('RNFR ' + fromname)
         if resp[0] != '3':
             raise error_reply(resp)
         return self.voidcmd('RNTO ' + toname)
 
     def mkd(self, dirname):
+        self._invalidate(dirname)
         resp = self.voidcmd('MKD ' + dirname)
         if not resp.startswith('257'):
             return ''
         return parse257(resp)
 
     def rmd(self, dirname):
+        self._invalidate(dirname)
         return self.voidcmd('RMD ' + dirname)
 
     def delete(self, filename):
+        self._invalidate(filename)
         resp = self.sendcmd('DELE ' + filename)
         if resp[:3] in {'250', '200'}:
             return resp
         else:
             raise error_reply(resp)
 
+    def pipeline(self, window=PIPELINE_WINDOW):
+        '''Return a Pipeline batching commands on this session.
+
+            with ftp.pipeline() as p:
+                for name in names:
+                    p.delete(name)
+            failed = [r for r in p.results if not r.ok]
+        '''
+        return Pipeline(self, window)
+
+    def start_keepalive(self, interval=KEEPALIVE_INTERVAL, tcp_idle=None,
+                        scheduler=None):
+        '''Keep the session alive while nobody uses it.
+
+        A background KeepAlive scheduler (a private one unless `scheduler`
+        is given) sends NOOP whenever the control channel has been idle
+        for `interval` seconds, and never while a transfer is waiting for
+        its final reply. `tcp_idle` additionally enables SO_KEEPALIVE with
+        that TCP_KEEPIDLE on the control socket and every data socket.
+        '''
+        if tcp_idle:
+            self.tcp_keepalive = tcp_idle
+            if self.sock is not None:
+                set_tcp_keepalive(self.sock, tcp_idle)
+        self.stop_keepalive()
+        self.keepalive = scheduler or KeepAlive(interval)
+        self.keepalive.watch(self)
+
+    def stop_keepalive(self):
+        if self.keepalive is not None:
+            self.keepalive.unwatch(self)
+            self.keepalive = None
+
     def quit(self):
         resp = self.voidcmd('QUIT')
+        self.close()
+        return resp
+
+    def close(self):
+        '''Close the control connection without sending QUIT.'''
+        self.stop_keepalive()
+        self._close_block_sock()
+        self._drop_prefetched()
+        self._pasv_pending = False
         if self.file:
             self.file.close()
-            self.sock.close()
             self.file = None
+        if self.sock:
+            self.sock.close()
             self.sock = None
-        return resp
 
 
 
@@ -436,108 +1666,1925 @@ class FTP:
         else:
             return '{:>6} GiB'.format(n_byte // GB)
 
-    def pretty_mlsd(self, path='', short=False):
-        file_list = self.mlsd(path=path, facts=["type", "size", "perm"])
+    def pretty_mlsd(self, path='', short=False, stream=False):
+        file_list = self.mlsd(path=path, facts=["type", "size", "perm"], stream=stream)
         for f in file_list:
-            if f[0].startswith('.'):
+            if f.name.startswith('.'):
                 continue
             if not short:
-                print("{:<12}\t\t".format(f[1].get('perm', '---------')), end='')
-                print(f"{self.format_size_(f[1].get('size', -1))}\t\t", end='')
-            if f[1].get('type', 'none') == 'dir':
-                print(f'{BOLD}{f[0]}{ENDC}')
+                print("{:<12}\t\t".format(f.perm or '---------'), end='')
+                print(f"{self.format_size_(f.get('size', -1))}\t\t", end='')
+            if f.type == 'dir':
+                print(f'{BOLD}{f.name}{ENDC}')
             else:
-                print(f'{f[0]}')
+                print(f'{f.name}')
 
 
 
 
 
-def parse150(resp):
-    if resp[:3] != '150':
-        raise error_reply(resp)
-    global _150_re
-    if _150_re is None:
-        import re
-        _150_re = re.compile(
-            r"150 .* \((\d+) bytes\)", re.IGNORECASE | re.ASCII)
-    m = _150_re.match(resp)
-    if not m:
-        return None
-    return int(m.group(1))
+MirrorResult = collections.namedtuple('MirrorResult', 'downloaded skipped failed')
+BatchResult = collections.namedtuple('BatchResult', 'done failed')
+DownloadResult = collections.namedtuple('DownloadResult', 'size resumed_from remote_changed')
+DeltaResult = collections.namedtuple('DeltaResult', 'size sent ranges')
 
-def parse227(resp):
-    if resp[:3] != '227':
-        raise error_reply(resp)
-    global _227_re
-    if _227_re is None:
-        import re
-        _227_re = re.compile(r'(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)', re.ASCII)
-    m = _227_re.search(resp)
-    if not m:
-        raise error_proto(resp)
-    numbers = m.groups()
-    host = '.'.join(numbers[:4])
-    port = (int(numbers[4]) << 8) + int(numbers[5])
-    return host, port
+def _write_journal(path, state):
+    '''Atomically replace the journal at `path` with `state`.'''
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as fp:
+        json.dump(state, fp)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tmp, path)
 
-def parse229(resp, peer):
-    if resp[:3] != '229':
-        raise error_reply(resp)
-    left = resp.find('(')
-    if left < 0: raise error_proto(resp)
-    right = resp.find(')', left + 1)
-    if right < 0:
-        raise error_proto(resp)
-    if resp[left + 1] != resp[right - 1]:
-        raise error_proto(resp)
-    parts = resp[left + 1:right].split(resp[left+1])
-    if len(parts) != 5:
-        raise error_proto(resp)
-    host = peer[0]
-    port = int(parts[3])
-    return host, port
+def _up_to_date(local_path, size, mtime):
+    try:
+        st = os.stat(local_path)
+    except OSError:
+        return False
+    return st.st_size == size and (mtime is None or int(st.st_mtime) == int(mtime))
 
-def parse257(resp):
-    if resp[:3] != '257':
-        raise error_reply(resp)
-    if resp[3:5] != ' "':
-        return '' # Not compliant to RFC 959, but UNIX ftpd does this
-    dirname = ''
-    i = 5
-    n = len(resp)
-    while i < n:
-        c = resp[i]
-        i = i+1
-        if c == '"':
-            if i >= n or resp[i] != '"':
+def _block_hashes(path, blocksize):
+    '''SHA-256 hex digests of each `blocksize` block of the local file
+    `path` and of the whole file, as SITE BLKHASH reports them.'''
+    blocks, whole = [], hashlib.sha256()
+    with open(path, 'rb') as fp:
+        while True:
+            block = fp.read(blocksize)
+            if not block and blocks:
                 break
-            i = i+1
-        dirname = dirname + c
-    return dirname
+            blocks.append(hashlib.sha256(block).hexdigest())
+            whole.update(block)
+            if len(block) < blocksize:
+                break
+    return blocks, whole.hexdigest()
 
+def _changed_ranges(local, remote, blocksize, size):
+    '''(offset, count) ranges of a `size` byte file whose blocks have
+    digests `local` but `remote` on the other side; adjacent changed
+    blocks are merged.'''
+    ranges = []
+    for i, digest in enumerate(local):
+        if i < len(remote) and remote[i] == digest:
+            continue
+        start = i * blocksize
+        end = min(start + blocksize, size)
+        if ranges and ranges[-1][0] + ranges[-1][1] == start:
+            ranges[-1] = (ranges[-1][0], end - ranges[-1][0])
+        elif end > start:
+            ranges.append((start, end - start))
+    return ranges
 
+def _has_magic(part):
+    return any(c in part for c in '*?[')
 
+def _fetch(session, remote_path, local_path):
+    partial = local_path + '.part'
+    stats = session.retrfile(f'RETR {remote_path}', partial)
+    os.replace(partial, local_path)
+    return stats
 
-def print_warning(warning):
-    print(f'{BOLD}{WARNING}{ITALIC}[ERROR] {warning}{ENDC}')
+def _send(session, local_path, remote_path):
+    with open(local_path, 'rb') as fp:
+        return session.storbinary(f'STOR {remote_path}', fp)
 
-def print_info(info, end=None):
-    if end is not None:
-        print(f'{BOLD}{ITALIC}[INFO]  {info}{ENDC}', end=end)
-    else:
-        print(f'{BOLD}{ITALIC}[INFO]  {info}{ENDC}')
+def fxp_copy(src, dst, path, dst_path=None):
+    '''Copy `path` on the server of session `src` to `dst_path` (`path`
+    by default) on the server of session `dst`, server to server (FXP).
 
-def timeout_input(prompt, timeout=10):
-    try:
-        if prompt:
-            print(prompt)
-        i, __, __ = select.select([sys.stdin], [], [], timeout)
-        return sys.stdin.readline().strip() if i else None
-    except:
-        raise
-    finally:
-        print(ENDC, end='')
+    `dst` is put in passive mode and `src` sent PORT, or EPRT over IPv6,
+    with the address `dst` gave, so the data goes straight from one
+    server to the other and never through the client. `src` has to be
+    allowed to connect to an address other than the client's, and `dst`
+    to accept a data connection from one: with pyftpdlib, set
+    `permit_foreign_addresses` on both. Both sessions must be in stream
+    mode. Returns the TransferStats of `dst`, with the byte count that
+    SIZE on `src` reported.
+    '''
+    if src.mode != 'S' or dst.mode != 'S':
+        raise Error('FXP needs both sessions in stream mode')
+    dst_path = dst_path or path
+    with src._lock, dst._lock:
+        dst._invalidate(dst_path)
+        with dst._metered() as meter:
+            size = src.size(path)  # also TYPE I, and a 550 before anything starts
+            dst.voidcmd('TYPE I')
+            host, port = dst.makepasv()
+            if src.af == socket.AF_INET and ':' not in host:
+                src.sendport(host, port)
+            else:
+                src.sendeprt(host, port)
+            # Some servers answer STOR only once the data connection is
+            # up, so its reply is read after RETR has been accepted.
+            dst.putline(f'STOR {dst_path}')
+            try:
+                resp = src.sendcmd(f'RETR {path}')
+                if resp[0] != '1':
+                    raise error_reply(resp)
+            except Error:
+                _fxp_abort(dst)
+                raise
+            try:
+                resp = dst.getresp()
+                if resp[0] != '1':
+                    raise error_reply(resp)
+            except Error:
+                _fxp_abort(src)
+                raise
+            src._transferring = dst._transferring = True
+            meter(0)
+            _fxp_done(src)
+            resp = _fxp_done(dst)
+            meter(size or 0)
+            return meter.done(resp)
+
+def _fxp_abort(session):
+    '''ABOR the half of a server to server transfer that is still
+    running or waiting.
+
+    Depending on how far the transfer got, the ABOR reply follows a
+    1xx, a 226 or a 426, so a NOOP goes after it and every reply up to
+    the NOOP's 200 is read.'''
+    try:
+        session.putline('ABOR')
+        session.putline('NOOP')
+        for _ in range(5):
+            if session.getmultiline()[:3] == '200':
+                break
+        else:
+            raise error_proto('no reply to NOOP after ABOR')
+    except all_errors:
+        session.close()
+    session._transferring = False
+
+def _fxp_done(session):
+    '''The final reply of a server to server transfer. The control
+    connection stays quiet for as long as the copy runs, so it is read
+    without the session timeout.'''
+    timeout = session.sock.gettimeout()
+    session.sock.settimeout(None)
+    try:
+        return session.voidresp()
+    finally:
+        session.sock.settimeout(timeout)
+
+def fxp_batch(src, dst, patterns, dst_dir='', workers=1):
+    '''Copy every file on the server of `src` matching the shell
+    `patterns` into `dst_dir` on the server of `dst`, with fxp_copy().
+
+    With `workers` above 1 that many copies run at once, each on its
+    own pair of sessions; the extra pairs are clones of `src` and `dst`,
+    closed again at the end. Returns a BatchResult like FTP.mget().
+    '''
+    src_cwd, dst_dir = src.pwd(), posixpath.join(dst.pwd(), dst_dir)
+    jobs, unmatched = [], []
+    for pattern in patterns:
+        paths = src.glob(posixpath.join(src_cwd, pattern))
+        if not paths:
+            unmatched.append((pattern, Error(f'{pattern}: no match')))
+        for path in paths:
+            jobs.append((path, posixpath.join(dst_dir, posixpath.basename(path))))
+    result = BatchResult([], [])
+    if not jobs:
+        result.failed.extend(unmatched)
+        return result
+
+    pairs = queue.SimpleQueue()
+    pairs.put((src, dst))
+    clones = []
+
+    def copy(path, target):
+        pair = pairs.get()
+        try:
+            return fxp_copy(*pair, path, target)
+        finally:
+            pairs.put(pair)
+
+    try:
+        for _ in range(min(workers, len(jobs)) - 1):
+            clones.append((src.clone(), dst.clone()))
+            pairs.put(clones[-1])
+        with ThreadPoolExecutor(max_workers=len(clones) + 1) as executor:
+            futures = [(path, executor.submit(copy, path, target))
+                       for path, target in jobs]
+            for path, future in futures:
+                try:
+                    result.done.append((path, future.result()))
+                except all_errors as e:
+                    result.failed.append((path, e))
+    finally:
+        for pair in clones:
+            for session in pair:
+                _shutdown(session)
+    result.failed.extend(unmatched)
+    return result
+
+
+
+
+class MLSDEntry:
+    '''One parsed MLSD entry.
+
+    The common facts are attributes with parsed values: size as int,
+    modify as a POSIX timestamp. Any other facts go to the `extra` dict,
+    which is None when there are none. For code written against
+    (name, facts) tuples an entry unpacks as (name, entry), and
+    get()/[]/in look facts up by name.
+    '''
+    __slots__ = ('name', 'type', 'size', 'modify', 'perm', 'unique', 'extra')
+
+    def __init__(self, name, type=None, size=None, modify=None, perm=None,
+                 unique=None, extra=None):
+        self.name   = name
+        self.type   = type
+        self.size   = size
+        self.modify = modify
+        self.perm   = perm
+        self.unique = unique
+        self.extra  = extra
+
+    def get(self, fact, default=None):
+        if fact in _MLSD_ATTRS:
+            value = getattr(self, fact)
+        else:
+            value = self.extra.get(fact) if self.extra else None
+        return default if value is None else value
+
+    def __getitem__(self, fact):
+        value = self.get(fact)
+        if value is None:
+            raise KeyError(fact)
+        return value
+
+    def __contains__(self, fact):
+        return self.get(fact) is not None
+
+    def __iter__(self):
+        return iter((self.name, self))
+
+    def __repr__(self):
+        return (f'<MLSDEntry {self.name!r} type={self.type} size={self.size} '
+                f'modify={self.modify}>')
+
+_MLSD_ATTRS = frozenset(MLSDEntry.__slots__) - {'name', 'extra'}
+
+
+
+
+class MetadataCache:
+    '''Thread-safe LRU cache of remote listings and sizes with a TTL.
+
+    Keys are tuples whose second item is a normalized absolute remote
+    path, e.g. ('size', '/pub/a.iso') or ('mlsd', '/pub', ('type',)).
+    '''
+    def __init__(self, ttl=CACHE_TTL, maxsize=CACHE_MAXSIZE):
+        self.ttl     = ttl
+        self.maxsize = maxsize
+        self._data   = collections.OrderedDict()  # key -> (expires, value)
+        self._lock   = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return None
+            if item[0] < time.monotonic():
+                del self._data[key]
+                return None
+            self._data.move_to_end(key)
+            return item[1]
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def invalidate(self, path):
+        '''Forget `path`, everything below it and the listing of its parent.'''
+        parent = posixpath.dirname(path)
+        prefix = path.rstrip('/') + '/'
+        with self._lock:
+            stale = [key for key in self._data
+                     if key[1] == path or key[1].startswith(prefix)
+                     or (key[0] == 'mlsd' and key[1] == parent)]
+            for key in stale:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+_WRITE_VERBS = {'STOR', 'STOU', 'APPE', 'DELE', 'MKD', 'XMKD', 'RMD', 'XRMD',
+                'RNFR', 'RNTO'}
+
+def _cmd_path(cmd):
+    '''The argument of a command such as 'STOR name'.'''
+    return cmd.partition(' ')[2]
+
+
+
+
+class PipelineResult:
+    '''Outcome of one pipelined command: the reply, or the error it caused.'''
+    __slots__ = ('cmd', 'expect', 'parse', 'resp', 'error', 'value')
+
+    def __init__(self, cmd, expect='2', parse=None):
+        self.cmd    = cmd
+        self.expect = expect
+        self.parse  = parse
+        self.resp   = None
+        self.error  = None
+        self.value  = None
+
+    @property
+    def ok(self):
+        return self.resp is not None and self.error is None
+
+    def __repr__(self):
+        return f'<PipelineResult {self.cmd!r}: {self.error or self.resp!r}>'
+
+
+class Pipeline:
+    '''Pipelined control commands on one session.
+
+    Commands are written back-to-back in batches of `window` and their
+    replies, multi-line ones included, are matched up in order, so a batch
+    costs one round trip instead of one per command. A 4xx/5xx reply or an
+    unexpected code is recorded on that command's PipelineResult and the
+    batch goes on. Use it as a context manager: the session lock is held
+    throughout and leaving the block reads all outstanding replies.
+    '''
+    def __init__(self, ftp, window=PIPELINE_WINDOW):
+        self.ftp        = ftp
+        self.window     = window
+        self.results    = []
+        self._unsent    = []
+        self._inflight  = collections.deque()
+        self._binary    = False
+
+    def send(self, cmd, expect='2', parse=None):
+        '''Queue `cmd`; its reply must start with one of `expect`.'''
+        verb, _, path = cmd.partition(' ')
+        if verb.upper() in _WRITE_VERBS:
+            self.ftp._invalidate(path)
+        result = PipelineResult(cmd, expect, parse)
+        self.results.append(result)
+        self._unsent.append(result)
+        if len(self._unsent) >= self.window:
+            self._write()
+            # keep at most two windows in flight
+            while len(self._inflight) > self.window:
+                self._read()
+        return result
+
+    def flush(self):
+        '''Write queued commands and wait for every outstanding reply.'''
+        self._write()
+        while self._inflight:
+            self._read()
+        return self.results
+
+    def delete(self, filename):
+        return self.send('DELE ' + filename)
+
+    def mkd(self, dirname):
+        return self.send('MKD ' + dirname, parse=parse257)
+
+    def rmd(self, dirname):
+        return self.send('RMD ' + dirname)
+
+    def size(self, filename):
+        if not self._binary:  # SIZE is refused in ASCII mode
+            self.send('TYPE I')
+            self._binary = True
+        return self.send('SIZE ' + filename, parse=lambda r: int(r[3:].strip()))
+
+    def mdtm(self, filename):
+        return self.send('MDTM ' + filename, parse=lambda r: r[3:].strip())
+
+    def rename(self, fromname, toname):
+        '''Queue RNFR + RNTO; returns the RNTO result.'''
+        self.send('RNFR ' + fromname, expect='3')
+        return self.send('RNTO ' + toname)
+
+    def _write(self):
+        if not self._unsent:
+            return
+        data = ''.join(r.cmd + CRLF for r in self._unsent)
+        self.ftp._collect_prefetch()
+        self.ftp.sock.sendall(data.encode(self.ftp.encoding))
+        self.ftp._last_io = time.monotonic()
+        self._inflight.extend(self._unsent)
+        self._unsent = []
+
+    def _read(self):
+        result = self._inflight.popleft()
+        try:
+            result.resp = self.ftp.getresp()
+            if result.resp[:1] not in result.expect:
+                raise error_reply(result.resp)
+            if result.parse is not None:
+                result.value = result.parse(result.resp)
+        except (error_reply, error_temp, error_perm) as e:
+            result.error = e
+
+    def __enter__(self):
+        self.ftp._lock.acquire()
+        if self.ftp.cache is not None:
+            self.ftp._abspath('')  # learn the cwd before replies queue up
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.ftp._lock.release()
+
+
+
+
+class KeepAlive:
+    '''Background scheduler sending NOOP on idle control connections.
+
+    One daemon thread serves every watched session. A session is due
+    once its control channel has seen no traffic for `interval` seconds.
+    Sessions that are running a command, or whose transfer has not yet
+    received its final reply, are skipped, so a NOOP reply can never be
+    mistaken for the 226 of a transfer.
+    '''
+    def __init__(self, interval=KEEPALIVE_INTERVAL):
+        self.interval   = interval
+        self._sessions  = set()
+        self._cond      = threading.Condition()
+        self._thread    = None
+
+    def watch(self, session):
+        with self._cond:
+            self._sessions.add(session)
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='ftp-keepalive', daemon=True)
+                self._thread.start()
+            self._cond.notify()
+
+    def unwatch(self, session):
+        with self._cond:
+            self._sessions.discard(session)
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                if not self._sessions:
+                    self._thread = None
+                    return
+                sessions = list(self._sessions)
+            wake_at = time.monotonic() + self.interval
+            for session in sessions:
+                due = session._last_io + self.interval
+                if due <= time.monotonic():
+                    self._ping(session)
+                    due = time.monotonic() + self.interval
+                wake_at = min(wake_at, due)
+            with self._cond:
+                self._cond.wait(max(0.0, wake_at - time.monotonic()))
+
+    def _ping(self, session):
+        if not session._lock.acquire(blocking=False):
+            return  # busy running a command or transfer
+        try:
+            if session._transferring or session.sock is None:
+                return
+            if time.monotonic() - session._last_io >= self.interval:
+                session.send_noop()
+                # An idle data connection would time out on the server,
+                # taking the whole session with it.
+                session._drop_prefetched()
+        except all_errors:
+            self.unwatch(session)
+        finally:
+            session._lock.release()
+
+def set_tcp_keepalive(sock, idle, interval=None, count=3):
+    '''Enable TCP keepalive probes after `idle` seconds of silence.'''
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    if hasattr(socket, 'TCP_KEEPIDLE'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, idle)
+    elif hasattr(socket, 'TCP_KEEPALIVE'):  # macOS
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPALIVE, idle)
+    if hasattr(socket, 'TCP_KEEPINTVL'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL,
+                        interval or max(1, idle // 3))
+    if hasattr(socket, 'TCP_KEEPCNT'):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, count)
+
+
+
+
+class TransferStats(str):
+    '''The final reply of a transfer, carrying what was measured.
+
+    It is the reply string itself, so code that inspects the reply keeps
+    working. Times are in seconds, rates in bytes per second.
+
+        bytes       payload bytes moved over the data connection
+        elapsed     wall time from the first command to the final reply
+        ttfb        time from the first command to the first data byte,
+                    None when no data moved
+        pasv        PASV/EPSV round trip, None in active mode
+        commands    (verb, seconds) for every control command, in order
+        average     bytes / elapsed
+        peak        best rate over any progress interval
+        digest      hex digest of the data when one was asked for, else None
+    '''
+    def __new__(cls, resp, bytes=0, elapsed=0.0, ttfb=None, commands=(),
+                peak=0.0, digest=None):
+        self = super().__new__(cls, resp)
+        self.digest = digest
+        self.bytes = bytes
+        self.elapsed = elapsed
+        self.ttfb = ttfb
+        self.commands = list(commands)
+        self.pasv = next((t for verb, t in self.commands
+                          if verb in ('PASV', 'EPSV')), None)
+        self.average = bytes / elapsed if elapsed > 0 else 0.0
+        self.peak = max(peak, self.average)
+        return self
+
+    def summary(self):
+        ttfb = '-' if self.ttfb is None else f'{self.ttfb * 1000:.1f} ms'
+        return (f'{self.bytes} bytes in {self.elapsed:.3f} s, '
+                f'avg {self.average / 2**20:.1f} MiB/s, '
+                f'peak {self.peak / 2**20:.1f} MiB/s, ttfb {ttfb}')
+
+def _merge_stats(parts, started):
+    '''One TransferStats for the TransferStats `parts` of a file moved
+    in pieces, timed from `started` (time.monotonic()) on. It carries
+    the last part's reply, or none when nothing had to move.'''
+    ttfbs = [part.ttfb for part in parts if part.ttfb is not None]
+    return TransferStats(parts[-1] if parts else '',
+                         sum(part.bytes for part in parts),
+                         time.monotonic() - started, min(ttfbs, default=None),
+                         [command for part in parts for command in part.commands],
+                         max((part.peak for part in parts), default=0.0))
+
+class _Meter:
+    '''Measure one transfer and forward its byte count to `hook` at most
+    once per `interval` seconds.
+
+    While entered it is the session's `_meter`, so every control command
+    sent in the meantime is timed. With a `digest` algorithm the transfer
+    feeds its data to `hash`, a _Digester. done() turns the final reply
+    into TransferStats.
+    '''
+    def __init__(self, session, hook=None, interval=PROGRESS_INTERVAL,
+                 digest=None):
+        self.session = session
+        self.hash = _Digester(digest) if digest else None
+        self.hook = hook
+        self.interval = interval
+        self.commands = []
+        self.bytes = 0
+        self.first = None
+        self.peak = 0.0
+        self.start = self.mark = time.monotonic()
+        self.marked = 0
+
+    def __enter__(self):
+        self.session._meter = self
+        return self
+
+    def __exit__(self, *exc_info):
+        self.session._meter = None
+        if self.hash:
+            self.hash.close()
+
+    def command(self, cmd, start):
+        self.commands.append((cmd.split(' ', 1)[0].upper(),
+                              time.monotonic() - start))
+
+    def __call__(self, n_bytes):
+        now = time.monotonic()
+        if self.first is None:
+            self.first = self.mark = now
+        self.bytes = n_bytes
+        if now - self.mark >= self.interval:
+            if now > self.mark:  # with a zero interval the clock may not move
+                self.peak = max(self.peak, (n_bytes - self.marked) / (now - self.mark))
+            self.mark, self.marked = now, n_bytes
+            if self.hook:
+                self.hook(n_bytes)
+
+    def done(self, resp):
+        digest = self.hash.hexdigest() if self.hash else None
+        end = time.monotonic()
+        if self.hook:
+            self.hook(self.bytes)
+        if not self.peak and self.first is not None and end > self.first:
+            self.peak = self.bytes / (end - self.first)
+        ttfb = None if self.first is None else self.first - self.start
+        return TransferStats(resp, self.bytes, end - self.start, ttfb,
+                             self.commands, self.peak, digest)
+
+class _LineSplitter:
+    '''Split ASCII data that arrives in arbitrary blocks into lines.
+
+    CR LF, LF and a lone CR all end a line, as with the universal
+    newlines of a text file. Line endings are translated on a whole
+    block with bytes.replace, and only complete lines are decoded. A CR
+    that ends a block is held back until the next block shows whether
+    an LF follows. Only the unfinished line carried from one block to
+    the next is held to `maxline`.
+    '''
+    def __init__(self, encoding, maxline=MAXLINE):
+        self.encoding = encoding
+        self.maxline = maxline
+        self._tail = b''   # unfinished last line
+        self._cr = False   # the last block ended in CR
+
+    def feed(self, data):
+        '''The lines completed by `data`, as a list of str.'''
+        if self._cr:
+            data = b'\r' + data
+        self._cr = data[-1:] == b'\r'
+        if self._cr:
+            data = data[:-1]
+        data = data.replace(B_CRLF, b'\n').replace(b'\r', b'\n')
+        end = data.rfind(b'\n')
+        if end < 0:
+            self._tail += data
+            lines = []
+        else:
+            lines = (self._tail + data[:end]).decode(self.encoding).split('\n')
+            self._tail = data[end + 1:]
+        if len(self._tail) > self.maxline:
+            raise Error("got more than %d bytes" % self.maxline)
+        return lines
+
+    def close(self):
+        '''The last line, if the data did not end with a line ending.'''
+        tail, self._tail = self._tail, b''
+        if tail or self._cr:
+            self._cr = False
+            return [tail.decode(self.encoding)]
+        return []
+
+class _CRC32:
+    '''zlib.crc32 behind the hashlib interface.'''
+    name = 'crc32'
+    digest_size = 4
+
+    def __init__(self):
+        self._crc = 0
+
+    def update(self, data):
+        self._crc = zlib.crc32(data, self._crc)
+
+    def digest(self):
+        return self._crc.to_bytes(4, 'big')
+
+    def hexdigest(self):
+        return '%08x' % self._crc
+
+def new_hash(name):
+    '''A hashlib object for `name`: 'crc32' or any hashlib algorithm.'''
+    if name.lower() == 'crc32':
+        return _CRC32()
+    return hashlib.new(name)
+
+class _Digester:
+    '''Hash the data of one transfer on a worker thread.
+
+    update() queues a chunk, which must not change afterwards;
+    update_file() queues a byte range of a file to be read back with
+    pread, for data that never passed through Python (sendfile) or is
+    already on its way to disk. At most DIGEST_QUEUE chunks wait: if the
+    hash falls behind, the transfer waits for it instead of buffering
+    without bound. hashlib and zlib drop the GIL for large chunks, so
+    hashing and socket I/O overlap.
+    '''
+    def __init__(self, name):
+        self._hash = new_hash(name)
+        self._queue = queue.Queue(DIGEST_QUEUE)
+        self._error = None
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def update(self, data):
+        self._queue.put(data)
+
+    def update_file(self, fd, offset, count):
+        self._queue.put((fd, offset, count))
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            if self._error is not None:
+                continue  # keep draining so the transfer never blocks
+            try:
+                if isinstance(item, tuple):
+                    fd, offset, count = item
+                    while count > 0:
+                        data = os.pread(fd, min(count, 2**20), offset)
+                        if not data:
+                            raise Error('file shrank while being hashed')
+                        self._hash.update(data)
+                        offset += len(data)
+                        count -= len(data)
+                else:
+                    self._hash.update(item)
+            except Exception as e:
+                self._error = e
+
+    def close(self):
+        if self._thread.is_alive():
+            self._queue.put(None)
+            self._thread.join()
+
+    def hexdigest(self):
+        '''Wait for the queued data and return the digest in hex.'''
+        self.close()
+        if self._error is not None:
+            raise self._error
+        return self._hash.hexdigest()
+
+class _Tuner:
+    '''Grow a data connection's block size and socket buffer toward the
+    bandwidth-delay product of the link.
+
+    The rate is re-measured once per round trip. While the socket buffer
+    is what limits the window, the measured rate times the RTT equals the
+    buffer, so asking for twice the product doubles it every round trip,
+    much like slow start, until the link and not the buffer is the limit.
+    A rate remembered from the session's previous transfer sizes the
+    buffer from the start.
+    '''
+    def __init__(self, conn, opt, rtt, blocksize, max_blocksize=MAX_BLOCKSIZE,
+                 rate=None):
+        self.conn = conn
+        self.opt = opt
+        self.rtt = rtt or 0.001
+        self.blocksize = blocksize
+        self.max_blocksize = max(blocksize, max_blocksize)
+        self.capped = False
+        self.start = self.mark = time.monotonic()
+        self.bytes = self.marked = 0
+        if rate:
+            self._resize(rate)
+
+    @property
+    def rate(self):
+        '''Average bytes per second since the transfer started.'''
+        elapsed = time.monotonic() - self.start
+        return self.bytes / elapsed if elapsed > 0 else None
+
+    def update(self, n):
+        '''Account for `n` more bytes; returns the block size to use next.'''
+        self.bytes += n
+        now = time.monotonic()
+        if now - self.mark >= self.rtt:
+            self._resize((self.bytes - self.marked) / (now - self.mark))
+            self.mark, self.marked = now, self.bytes
+        return self.blocksize
+
+    def _resize(self, rate):
+        bdp = int(rate * self.rtt)
+        want = min(2 * bdp, MAX_SOCKBUF)
+        # Setting the buffer turns off the kernel's own autotuning, so only
+        # ever grow it past what the kernel already chose.
+        if not self.capped and want > self.conn.getsockopt(socket.SOL_SOCKET, self.opt):
+            try:
+                self.conn.setsockopt(socket.SOL_SOCKET, self.opt, want)
+            except OSError:
+                self.capped = True
+            else:
+                # Linux silently caps it at net.core.[rw]mem_max.
+                self.capped = self.conn.getsockopt(socket.SOL_SOCKET, self.opt) < want
+        while self.blocksize < min(bdp, self.max_blocksize):
+            self.blocksize = min(2 * self.blocksize, self.max_blocksize)
+
+def _seekable(fp):
+    try:
+        return fp.seekable()
+    except (AttributeError, ValueError):
+        return False
+
+def _regular_file(fp):
+    try:
+        return stat.S_ISREG(os.fstat(fp.fileno()).st_mode)
+    except (AttributeError, OSError, ValueError):  # io.UnsupportedOperation
+        return False
+
+def _sendlines(conn, fp, blocksize, callback=None, progress=None):
+    '''Send the binary file `fp` over `conn` in blocks of `blocksize`
+    bytes, with every line ending in CR LF. A CR LF split between two
+    blocks stays one line ending. `callback` gets every translated
+    block. Returns the number of bytes sent.
+    '''
+    sent = 0
+    cr = b''           # CR that ended the last block
+    open_line = False  # the last block ended inside a line
+    while True:
+        data = fp.read(blocksize)
+        if not data:
+            break
+        data = cr + data
+        cr = data[-1:] if data[-1:] == b'\r' else b''
+        if cr:
+            data = data[:-1]
+        if not data:
+            continue
+        open_line = data[-1:] != b'\n'
+        data = data.replace(B_CRLF, b'\n').replace(b'\n', B_CRLF)
+        conn.sendall(data)
+        sent += len(data)
+        if progress:
+            progress(sent)
+        if callback:
+            callback(data)
+    # the last line ends in CR LF too
+    if cr or open_line:
+        conn.sendall(B_CRLF)
+        sent += 2
+        if progress:
+            progress(sent)
+        if callback:
+            callback(B_CRLF)
+    return sent
+
+def _sendfrom(conn, fp, blocksize, progress=None, count=None, tuner=None,
+              digest=None):
+    '''Send `fp` from its current position to EOF, or at most `count`
+    bytes, over `conn`. `progress` is called with the byte count after
+    every chunk; a `tuner` sees every chunk and sets the size of the next
+    one; a `digest` _Digester is fed what was sent. Returns the number of
+    bytes sent.
+    '''
+    sent = 0
+    if progress:
+        progress(0)  # the data connection is ready: first byte goes now
+    if _regular_file(fp) and 'b' in getattr(fp, 'mode', 'b'):
+        offset = fp.tell()
+        remaining = os.fstat(fp.fileno()).st_size - offset
+        if count is not None:
+            remaining = min(remaining, count)
+        while remaining > 0:
+            # socket.sendfile uses os.sendfile where available, copes with
+            # socket timeouts and leaves fp positioned after the last byte.
+            step = tuner.blocksize if tuner else SENDFILE_CHUNK
+            n = conn.sendfile(fp, offset, min(remaining, step))
+            if not n:
+                break
+            if digest:
+                digest.update_file(fp.fileno(), offset, n)
+            offset += n
+            remaining -= n
+            sent += n
+            if progress:
+                progress(sent)
+            if tuner:
+                tuner.update(n)
+        return sent
+    buf = bytearray(blocksize)
+    view = memoryview(buf)
+    readinto = getattr(fp, 'readinto', None)
+    while count is None or sent < count:
+        want = blocksize if count is None else min(blocksize, count - sent)
+        if readinto is not None:
+            n = readinto(view[:want])
+            data = view[:n]
+        else:
+            data = fp.read(want)
+            n = len(data)
+        if not n:
+            break
+        conn.sendall(data)
+        if digest:
+            digest.update(bytes(data))
+        sent += n
+        if progress:
+            progress(sent)
+        if tuner:
+            blocksize = tuner.update(n)
+            if blocksize > len(buf):
+                buf = bytearray(blocksize)
+                view = memoryview(buf)
+    return sent
+
+class _DataSocket:
+    '''Base of the data connections that transform what goes over the
+    wire: MODE Z and MODE B. Wraps a connected socket.
+
+    Only the socket methods the transfer methods use are provided;
+    subclasses implement sendall, recv_into and close. Socket options
+    are passed through to the real socket.
+    '''
+    def __init__(self, sock, sending):
+        self.sock = sock
+        self._sending = sending
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        if exc_type is not None:
+            self._broken()
+        self.close()
+
+    def _broken(self):
+        # A stream cut short must make the server fail the transfer.
+        self._sending = False
+
+    def sendfile(self, fp, offset=0, count=None):
+        # The kernel cannot transform the data: read it through Python.
+        fp.seek(offset)
+        sent = 0
+        while count is None or sent < count:
+            want = SEND_BLOCKSIZE if count is None else min(SEND_BLOCKSIZE, count - sent)
+            data = fp.read(want)
+            if not data:
+                break
+            self.sendall(data)
+            sent += len(data)
+        return sent
+
+    def recv(self, bufsize):
+        buf = bytearray(bufsize)
+        return bytes(buf[:self.recv_into(buf)])
+
+    def makefile(self, mode='r', encoding=None, **kwargs):
+        fp = io.BufferedReader(_DataReader(self))
+        if 'b' in mode:
+            return fp
+        return io.TextIOWrapper(fp, encoding=encoding, newline=kwargs.get('newline'))
+
+class _DataReader(io.RawIOBase):
+    def __init__(self, conn):
+        self.conn = conn
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        return self.conn.recv_into(buffer)
+
+class _DeflateSocket(_DataSocket):
+    '''A MODE Z data connection: compresses what is sent or decompresses
+    what is received, as one zlib stream.
+
+    Uploads whose first block barely compresses go out in stored blocks.
+    Closing an upload connection finishes the stream first.
+    '''
+    def __init__(self, sock, sending, level=ZLIB_LEVEL):
+        super().__init__(sock, sending)
+        self.level = level
+        self._deflater = None
+        self._inflater = None if sending else zlib.decompressobj()
+        self._pending = b''
+
+    def sendall(self, data):
+        if self._deflater is None:
+            sample = bytes(data[:65536])
+            level = self.level
+            if len(sample) >= 4096 and \
+                    len(zlib.compress(sample, 1)) > len(sample) * 0.95:
+                level = 0  # already compressed
+            self._deflater = zlib.compressobj(level)
+        data = self._deflater.compress(data)
+        if data:
+            self.sock.sendall(data)
+
+    def recv_into(self, buffer, nbytes=0):
+        view = memoryview(buffer).cast('B')
+        nbytes = nbytes or len(view)
+        while not self._pending:
+            if self._inflater.eof:
+                return 0
+            tail = self._inflater.unconsumed_tail
+            data = tail or self.sock.recv(max(nbytes, 65536))
+            if not data:
+                if not self._inflater.eof:
+                    raise Error('compressed data connection closed early')
+                return 0
+            try:
+                self._pending = self._inflater.decompress(data, nbytes)
+            except zlib.error as err:
+                raise Error('invalid compressed data: %s' % err)
+        n = min(nbytes, len(self._pending))
+        view[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def close(self):
+        try:
+            if self._sending:
+                self._sending = False
+                if self._deflater is None:
+                    self._deflater = zlib.compressobj(self.level)
+                self.sock.sendall(self._deflater.flush())
+        finally:
+            self.sock.close()
+
+class _BlockSocket(_DataSocket):
+    '''One file over a MODE B data connection (RFC 959, 3.4.2).
+
+    Data goes in blocks of at most 65535 bytes behind a 3 byte header;
+    the end of file is a block marked EOF, so closing this object leaves
+    the real socket open for the next transfer. Only a transfer that
+    ends early closes it.
+    '''
+    def __init__(self, sock, sending):
+        super().__init__(sock, sending)
+        self._left = 0      # data bytes left in the current block
+        self._desc = 0      # descriptor of the current block
+        self._eof = False
+
+    def _broken(self):
+        super()._broken()
+        self.sock.close()
+
+    def sendall(self, data):
+        data = memoryview(data).cast('B')
+        for i in range(0, len(data), BLOCK_MAXSIZE):
+            chunk = data[i:i + BLOCK_MAXSIZE]
+            self.sock.sendall(_BLOCK_HEADER.pack(0, len(chunk)) + chunk)
+
+    def _recv_exactly(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.sock.recv(n - len(data))
+            if not chunk:
+                raise Error('data connection closed inside a block')
+            data += chunk
+        return data
+
+    def _next_block(self):
+        self._desc, self._left = _BLOCK_HEADER.unpack(self._recv_exactly(3))
+        if self._desc & BLOCK_RESTART:  # restart markers carry no file data
+            self._recv_exactly(self._left)
+            self._left = 0
+        if not self._left and self._desc & BLOCK_EOF:
+            self._eof = True
+
+    def recv_into(self, buffer, nbytes=0):
+        view = memoryview(buffer).cast('B')
+        nbytes = nbytes or len(view)
+        while not self._left:
+            if self._eof:
+                return 0
+            self._next_block()
+        n = self.sock.recv_into(view, min(nbytes, self._left))
+        if not n:
+            raise Error('data connection closed inside a block')
+        self._left -= n
+        if not self._left and self._desc & BLOCK_EOF:
+            self._eof = True
+        return n
+
+    def close(self):
+        if self._sending:
+            self._sending = False
+            self.sock.sendall(_BLOCK_HEADER.pack(BLOCK_EOF, 0))
+        elif not self._eof and self.sock.fileno() != -1:
+            # mid-file the connection is out of step with the blocks
+            self.sock.close()
+
+def _fd_writer(fd):
+    def write(data):
+        while data:
+            data = data[os.write(fd, data):]
+    return write
+
+class _MappedFile:
+    '''Bytes [start, end) of an open file, preallocated and mapped
+    shared, to be received into with recv_into.'''
+
+    def __init__(self, mapping, skip, flush_every=MMAP_FLUSH):
+        self._map  = mapping
+        self._view = memoryview(mapping)
+        self._pos  = skip
+        self._synced = skip - skip % mmap.PAGESIZE
+        self._flush_every = flush_every
+
+    @classmethod
+    def create(cls, fd, start, end, flush_every=MMAP_FLUSH):
+        '''Map bytes [start, end) of `fd`, or None when the file can't
+        be mapped.'''
+        if hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, start, end - start)
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    raise
+        if os.fstat(fd).st_size < end:
+            os.ftruncate(fd, end)
+        # mmap offsets must be multiples of the allocation granularity
+        base = start - start % mmap.ALLOCATIONGRANULARITY
+        try:
+            mapping = mmap.mmap(fd, end - base, offset=base)
+        except (OSError, ValueError):
+            return None
+        return cls(mapping, start - base, flush_every)
+
+    @property
+    def left(self):
+        return len(self._map) - self._pos
+
+    def recv_from(self, conn, nbytes):
+        n = conn.recv_into(self._view[self._pos:self._pos + nbytes])
+        self._pos += n
+        if self._flush_every and self._pos - self._synced >= self._flush_every:
+            self._map.flush(self._synced, self._pos - self._synced)
+            self._synced = self._pos - self._pos % mmap.PAGESIZE
+        return n
+
+    def close(self):
+        try:
+            self._view.release()
+            self._map.close()
+        except BufferError:
+            pass  # a traceback still holds a slice; closed when collected
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+
+
+class FTPPool:
+    '''Thread-safe pool of logged-in FTP sessions keyed by (host, port, user).
+
+    At most `max_size` sessions exist per key. Idle sessions are checked
+    with NOOP before being handed out and closed once they have been idle
+    for longer than `idle_timeout` seconds. Sessions keep the working
+    directory their last user left them in.
+
+        pool = FTPPool(max_size=8)
+        with pool.session('127.0.0.1', 8821, 'username', 'password') as ftp:
+            ftp.delete('/tmp/old.log')
+    '''
+    def __init__(self, max_size=4, idle_timeout=60,
+                 timeout=_GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+        self.max_size       = max_size
+        self.idle_timeout   = idle_timeout
+        self.timeout        = timeout
+        self.source_address = source_address
+        self._cond          = threading.Condition()
+        self._idle          = {}  # key -> [(session, released_at), ...]
+        self._size          = {}  # key -> idle + checked out sessions
+        self._closed        = False
+
+    def acquire(self, host, port=FTP_PORT, user='', passwd='', acct='',
+                timeout=None):
+        '''Return a logged-in session, waiting up to `timeout` seconds (None
+        waits forever) when `max_size` sessions are already checked out.
+        '''
+        key = (host, port, user)
+        while True:
+            session = self._checkout(key, timeout)
+            if session is None:
+                try:
+                    session = FTP(timeout=self.timeout,
+                                  source_address=self.source_address)
+                    session.connect(host, port)
+                    session.login(user, passwd, acct)
+                except:
+                    session.close()
+                    self._forget(key)
+                    raise
+                return session
+            try:
+                session.send_noop()
+                return session
+            except all_errors:
+                session.close()
+                self._forget(key)
+
+    def release(self, session, broken=False):
+        '''Give a session back to the pool; `broken` ones are closed.'''
+        key = (session.host, session.port, session.user)
+        if broken or self._closed:
+            _shutdown(session, broken)
+            self._forget(key)
+            return
+        with self._cond:
+            self._idle.setdefault(key, []).append((session, time.monotonic()))
+            self._cond.notify()
+        self.prune()
+
+    def prune(self):
+        '''Close sessions that have been idle for longer than idle_timeout.'''
+        expired = []
+        deadline = time.monotonic() - self.idle_timeout
+        with self._cond:
+            for key, idle in self._idle.items():
+                while idle and idle[0][1] < deadline:
+                    expired.append(idle.pop(0)[0])
+                    self._size[key] -= 1
+            if expired:
+                self._cond.notify_all()
+        for session in expired:
+            _shutdown(session)
+
+    def close(self):
+        '''Close every idle session; sessions released later are closed too.'''
+        with self._cond:
+            self._closed = True
+            sessions = [s for idle in self._idle.values() for s, _ in idle]
+            for key, idle in self._idle.items():
+                self._size[key] -= len(idle)
+            self._idle.clear()
+            self._cond.notify_all()
+        for session in sessions:
+            _shutdown(session)
+
+    def session(self, host, port=FTP_PORT, user='', passwd='', acct='',
+                timeout=None):
+        '''Context manager around acquire() / release(). A session that
+        raised anything but a 4xx/5xx reply is considered broken.
+        '''
+        return _PooledSession(self, (host, port, user, passwd, acct, timeout))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _checkout(self, key, timeout):
+        '''Reserve a slot for `key`. Returns the most recently released
+        idle session, or None when the caller should open a new one.
+        '''
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                if self._closed:
+                    raise Error('pool is closed')
+                idle = self._idle.get(key)
+                while idle:
+                    session, since = idle.pop()
+                    if time.monotonic() - since <= self.idle_timeout:
+                        return session
+                    self._size[key] -= 1
+                    session.close()
+                if self._size.get(key, 0) < self.max_size:
+                    self._size[key] = self._size.get(key, 0) + 1
+                    return None
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise error_temp(f'421 no free session for {key[2]}@{key[0]}:{key[1]}')
+                self._cond.wait(remaining)
+
+    def _forget(self, key):
+        with self._cond:
+            self._size[key] -= 1
+            self._cond.notify()
+
+
+class _PooledSession:
+    def __init__(self, pool, args):
+        self.pool = pool
+        self.args = args
+        self.session = None
+
+    def __enter__(self):
+        self.session = self.pool.acquire(*self.args)
+        return self.session
+
+    def __exit__(self, exc_type, exc, tb):
+        broken = exc_type is not None and not issubclass(
+            exc_type, (error_temp, error_perm))
+        self.pool.release(self.session, broken=broken)
+
+def _shutdown(session, broken=False):
+    '''Say goodbye on a session that is still usable, then close it.'''
+    try:
+        if not broken:
+            session.quit()
+    except all_errors:
+        pass
+    finally:
+        session.close()
+
+
+
+
+class TransferQueue:
+    '''Prioritised downloads and uploads on at most `workers` sessions.
+
+    Sessions come from `pool` (a private FTPPool when None) and log in
+    like `ftp`. Lower priority numbers run first, equal ones in order of
+    submission. A job that fails with anything but a 5xx reply is retried
+    up to `retries` times, after BACKOFF, 2 * BACKOFF, ... seconds (with
+    jitter, at most `max_backoff`), on a fresh connection when the old one
+    broke. Retried transfers resume where the last attempt stopped: a
+    download keeps its `.part` file and continues with REST, an upload
+    asks SIZE and continues with REST + STOR. get() and put() return a
+    Future resolving to the final attempt's TransferStats.
+
+        with TransferQueue(ftp, workers=8) as queue:
+            big = queue.get('/iso/disk.img', 'disk.img', priority=9)
+            queue.put('notes.txt', '/inbox/notes.txt')
+        print(big.result().summary())
+    '''
+    def __init__(self, ftp, workers=4, retries=RETRIES, backoff=BACKOFF,
+                 max_backoff=MAX_BACKOFF, pool=None):
+        self.key            = ftp._pool_key()
+        self.cwd            = ftp.pwd()
+        self.retries        = retries
+        self.backoff        = backoff
+        self.max_backoff    = max_backoff
+        self._own_pool      = pool is None
+        self.pool           = pool or FTPPool(max_size=workers, timeout=ftp.timeout,
+                                              source_address=ftp.source_address)
+        self._cond          = threading.Condition()
+        self._ready         = []  # heap of _Job
+        self._delayed       = []  # heap of (due, seq, _Job) waiting to retry
+        self._seq           = itertools.count()
+        self._closed        = False
+        self._running       = 0
+        self._threads       = [threading.Thread(target=self._work, daemon=True)
+                               for _ in range(workers)]
+        for thread in self._threads:
+            thread.start()
+
+    def get(self, remote, local, priority=0, progress=None):
+        '''Queue a download of `remote` to `local`.'''
+        return self._submit(_Job(_download, posixpath.join(self.cwd, remote),
+                                 local, priority, progress))
+
+    def put(self, local, remote, priority=0, progress=None):
+        '''Queue an upload of `local` to `remote`.'''
+        return self._submit(_Job(_upload, posixpath.join(self.cwd, remote),
+                                 local, priority, progress))
+
+    def close(self, wait=True):
+        '''Accept no more jobs; queued ones still run. With `wait`, block
+        until all of them are done and release the sessions.
+        '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+            if self._own_pool:
+                self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _submit(self, job):
+        with self._cond:
+            if self._closed:
+                raise Error('queue is closed')
+            job.seq = next(self._seq)
+            heapq.heappush(self._ready, job)
+            self._cond.notify()
+        return job.future
+
+    def _next(self):
+        '''The most urgent runnable job; None once closed and drained.'''
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                while self._delayed and self._delayed[0][0] <= now:
+                    heapq.heappush(self._ready, heapq.heappop(self._delayed)[2])
+                if self._ready:
+                    self._running += 1
+                    return heapq.heappop(self._ready)
+                if self._closed and not self._delayed and not self._running:
+                    self._cond.notify_all()
+                    return None
+                self._cond.wait(self._delayed[0][0] - now if self._delayed else None)
+
+    def _work(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            try:
+                job.attempts += 1
+                with self.pool.session(*self.key) as session:
+                    stats = job.func(session, job.remote, job.local, job.progress)
+            except error_perm as e:  # 5xx: trying again will not help
+                job.future.set_exception(e)
+            except (*all_errors, OSError) as e:
+                if job.attempts > self.retries:
+                    job.future.set_exception(e)
+                else:
+                    self._retry(job)
+            except BaseException as e:
+                job.future.set_exception(e)
+            else:
+                job.future.set_result(stats)
+            finally:
+                with self._cond:
+                    self._running -= 1
+                    self._cond.notify_all()
+
+    def _retry(self, job):
+        delay = min(self.max_backoff, self.backoff * 2 ** (job.attempts - 1))
+        delay *= random.uniform(0.5, 1.0)  # keep retries from moving in lockstep
+        with self._cond:
+            heapq.heappush(self._delayed, (time.monotonic() + delay, job.seq, job))
+
+class _Job:
+    __slots__ = ('func', 'remote', 'local', 'priority', 'progress', 'seq',
+                 'attempts', 'future')
+
+    def __init__(self, func, remote, local, priority, progress):
+        self.func = func
+        self.remote = remote
+        self.local = local
+        self.priority = priority
+        self.progress = progress
+        self.seq = 0
+        self.attempts = 0
+        self.future = Future()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+def _download(session, remote, local, progress=None):
+    '''RETR `remote` into `local` through a `.part` file, resuming a
+    partial one left by an earlier attempt.
+    '''
+    partial = local + '.part'
+    size = session.size(remote)
+    try:
+        offset = os.path.getsize(partial)
+    except OSError:
+        offset = 0
+    if size is not None and offset > size:
+        offset = 0
+    report = progress and (lambda n: progress(offset + n))
+    stats = session.retrfile(f'RETR {remote}', partial, size, rest=offset or None,
+                             progress=report)
+    got = os.path.getsize(partial)
+    if size is not None and got != size:
+        raise Error(f'{remote}: got {got} of {size} bytes')
+    os.replace(partial, local)
+    return stats
+
+def _upload(session, remote, local, progress=None):
+    '''STOR `local` to `remote`, continuing after what SIZE says arrived.'''
+    try:
+        offset = session.size(remote) or 0
+    except error_perm:
+        offset = 0
+    if offset > os.path.getsize(local):
+        offset = 0
+    report = progress and (lambda n: progress(offset + n))
+    with open(local, 'rb') as fp:
+        return session.storbinary(f'STOR {remote}', fp, rest=offset or None,
+                                  progress=report)
+
+
+
+
+class AsyncFTP:
+    '''asyncio counterpart of FTP built on streams.
+
+    Mirrors the blocking API with coroutines, so one event loop can drive
+    many control and data connections at once. Only passive mode is
+    supported.
+
+        ftp = AsyncFTP()
+        await ftp.connect('127.0.0.1', 8821)
+        await ftp.login('username', 'password')
+        await ftp.retrbinary('RETR notes.txt', chunks.append)
+    '''
+    def __init__(self, timeout=None, source_address=None):
+        self.host           = ''
+        self.port           = FTP_PORT
+        self.reader         = None
+        self.writer         = None
+        self.welcome        = None
+        self.maxline        = MAXLINE
+        self.source_address = source_address
+        self.encoding       = 'latin-1'
+        self.timeout        = timeout
+        self.user           = ''
+        self.progress_interval = PROGRESS_INTERVAL
+        self._meter         = None
+
+    async def putline(self, cmd):
+        self.writer.write((cmd + CRLF).encode(self.encoding))
+        await self.writer.drain()
+
+    async def getline(self):
+        line = await asyncio.wait_for(self.reader.readline(), self.timeout)
+        if not line:
+            raise EOFError
+        if len(line) > self.maxline:
+            raise Error("got more than %d bytes" % self.maxline)
+        return line.decode(self.encoding).rstrip(CRLF)
+
+    async def getmultiline(self):
+        line = await self.getline()
+        if line[3:4] == '-':
+            code = line[:3]
+            while 1:
+                nextline = await self.getline()
+                line = line + ('\n' + nextline)
+                if nextline[:3] == code and nextline[3:4] != '-':
+                    break
+        return line
+
+    async def getresp(self):
+        resp = await self.getmultiline()
+        self.lastresp = resp[:3]
+        c = resp[:1]
+        if c in {'1','2','3'}:
+            return resp
+        if c == '4':
+            raise error_temp(resp)
+        if c == '5':
+            raise error_perm(resp)
+        raise error_proto(resp)
+
+    async def voidresp(self):
+        resp = await self.getresp()
+        if resp[:1] != '2':
+            raise error_reply(resp)
+        return resp
+
+    async def sendcmd(self, cmd):
+        start = time.monotonic()
+        await self.putline(cmd)
+        resp = await self.getresp()
+        if self._meter is not None:
+            self._meter.command(cmd, start)
+        return resp
+
+    async def voidcmd(self, cmd):
+        resp = await self.sendcmd(cmd)
+        if resp[:1] != '2':
+            raise error_reply(resp)
+        return resp
+
+    async def send_noop(self):
+        return await self.voidcmd('NOOP')
+
+    async def connect(self, host=None, port=None, timeout=None):
+        if host is not None:    self.host = host
+        if port is not None:    self.port = port
+        if timeout is not None: self.timeout = timeout
+        self.reader, self.writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port,
+                                    local_addr=self.source_address,
+                                    limit=self.maxline + 2),
+            self.timeout)
+        self.af = self.writer.get_extra_info('socket').family
+        self.welcome = await self.getresp()
+        return self.welcome
+
+    async def login(self, user='', passwd='', acct=''):
+        if not user: user = 'anonymous'
+        if not passwd: passwd = ''
+        if not acct: acct = ''
+        if user == 'anonymous' and passwd in {'','-'}:
+            passwd = passwd + 'anonymous@'
+        resp = await self.sendcmd('USER ' + user)
+        if resp[0] == '3': resp = await self.sendcmd('PASS ' + passwd)
+        if resp[0] == '3': resp = await self.sendcmd('ACCT ' + acct)
+        if resp[0] != '2': raise error_reply(resp)
+        self.user = user
+        return resp
+
+    async def makepasv(self):
+        if self.af == socket.AF_INET:
+            host, port = parse227(await self.sendcmd('PASV'))
+        else:
+            peer = self.writer.get_extra_info('peername')
+            host, port = parse229(await self.sendcmd('EPSV'), peer)
+        return host, port
+
+    async def ntransfercmd(self, cmd, rest=None):
+        '''Like FTP.ntransfercmd, but the data connection is returned as
+        an asyncio (reader, writer) pair.
+        '''
+        host, port = await self.makepasv()
+        conn = await asyncio.wait_for(
+            asyncio.open_connection(host, port, local_addr=self.source_address),
+            self.timeout)
+        try:
+            if rest is not None:
+                await self.sendcmd("REST %s" % rest)
+            resp = await self.sendcmd(cmd)
+            if resp[0] == '2':
+                resp = await self.getresp()
+            if resp[0] != '1':
+                raise error_reply(resp)
+        except:
+            conn[1].close()
+            raise
+        size = parse150(resp) if resp[:3] == '150' else None
+        return conn, size
+
+    async def transfercmd(self, cmd, rest=None):
+        return (await self.ntransfercmd(cmd, rest))[0]
+
+    def _metered(self, progress=None):
+        return _Meter(self, progress, self.progress_interval)
+
+    async def retrbinary(self, cmd, callback, blocksize=65536, rest=None,
+                         progress=None):
+        received = 0
+        with self._metered(progress) as meter:
+            await self.voidcmd('TYPE I')
+            reader, writer = await self.transfercmd(cmd, rest)
+            try:
+                while True:
+                    data = await asyncio.wait_for(reader.read(blocksize), self.timeout)
+                    if not data:
+                        break
+                    callback(data)
+                    received += len(data)
+                    meter(received)
+            finally:
+                writer.close()
+            return meter.done(await self.voidresp())
+
+    async def retrlines(self, cmd, callback=None, progress=None):
+        if callback is None:
+            callback = print
+        received = 0
+        with self._metered(progress) as meter:
+            await self.voidcmd('TYPE A')
+            reader, writer = await self.transfercmd(cmd)
+            complete = False
+            try:
+                while True:
+                    line = await self._dataline(reader)
+                    if not line:
+                        break
+                    received += len(line)
+                    meter(received)
+                    callback(line.decode(self.encoding).rstrip(CRLF))
+                complete = True
+            finally:
+                writer.close()
+                if not complete:
+                    await self._abandoned()
+            return meter.done(await self.voidresp())
+
+    async def storbinary(self, cmd, fp, blocksize=65536, callback=None, rest=None,
+                         progress=None):
+        sent = 0
+        with self._metered(progress) as meter:
+            await self.voidcmd('TYPE I')
+            reader, writer = await self.transfercmd(cmd, rest)
+            try:
+                while True:
+                    buf = fp.read(blocksize)
+                    if not buf:
+                        break
+                    writer.write(buf)
+                    await writer.drain()
+                    sent += len(buf)
+                    meter(sent)
+                    if callback:
+                        callback(buf)
+            finally:
+                writer.close()
+                await writer.wait_closed()
+            return meter.done(await self.voidresp())
+
+    async def mlsd(self, path="", facts=[]):
+        if facts:
+            await self.sendcmd("OPTS MLST " + ";".join(facts) + ";")
+        cmd = "MLSD %s" % path if path else "MLSD"
+        await self.voidcmd('TYPE A')
+        reader, writer = await self.transfercmd(cmd)
+        complete = False
+        try:
+            # parsed while the listing arrives, like FTP.mlsd()
+            while True:
+                line = await self._dataline(reader)
+                if not line:
+                    break
+                yield parse_mlsd_line(line.decode(self.encoding).rstrip(CRLF))
+            complete = True
+        finally:
+            writer.close()
+            if complete:
+                await self.voidresp()
+            else:
+                await self._abandoned()
+
+    async def _dataline(self, reader):
+        '''The next line of a data connection, b'' at its end.'''
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.timeout)
+        except ValueError:  # longer than the stream's buffer limit
+            line = None
+        if line is None or len(line) > self.maxline:
+            raise error_proto("got more than %d bytes" % self.maxline)
+        return line
+
+    async def _abandoned(self):
+        '''Collect the 226/426 of a transfer given up halfway.'''
+        try:
+            await self.getresp()
+        except (error_temp, error_perm):
+            pass
+
+    async def size(self, filename):
+        await self.voidcmd('TYPE I')
+        resp = await self.sendcmd('SIZE ' + filename)
+        if resp[:3] == '213':
+            return int(resp[3:].strip())
+
+    async def pwd(self):
+        return parse257(await self.voidcmd('PWD'))
+
+    async def cwd(self, dirname):
+        if dirname == '..':
+            try:
+                return await self.voidcmd('CDUP')
+            except Error:
+                pass
+        elif dirname == '':
+            dirname = '.'
+        return await self.voidcmd(f'CWD {dirname}')
+
+    async def quit(self):
+        resp = await self.voidcmd('QUIT')
+        await self.close()
+        return resp
+
+    async def close(self):
+        if self.writer is not None:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except OSError:
+                pass
+            self.reader = self.writer = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+
+
+
+def parse150(resp):
+    if resp[:3] != '150':
+        raise error_reply(resp)
+    global _150_re
+    if _150_re is None:
+        import re
+        _150_re = re.compile(
+            r"150 .* \((\d+) bytes\)", re.IGNORECASE | re.ASCII)
+    m = _150_re.match(resp)
+    if not m:
+        return None
+    return int(m.group(1))
+
+def parse227(resp):
+    if resp[:3] != '227':
+        raise error_reply(resp)
+    global _227_re
+    if _227_re is None:
+        import re
+        _227_re = re.compile(r'(\d+),(\d+),(\d+),(\d+),(\d+),(\d+)', re.ASCII)
+    m = _227_re.search(resp)
+    if not m:
+        raise error_proto(resp)
+    numbers = m.groups()
+    host = '.'.join(numbers[:4])
+    port = (int(numbers[4]) << 8) + int(numbers[5])
+    return host, port
+
+def parse229(resp, peer):
+    if resp[:3] != '229':
+        raise error_reply(resp)
+    left = resp.find('(')
+    if left < 0: raise error_proto(resp)
+    right = resp.find(')', left + 1)
+    if right < 0:
+        raise error_proto(resp)
+    if resp[left + 1] != resp[right - 1]:
+        raise error_proto(resp)
+    parts = resp[left + 1:right].split(resp[left+1])
+    if len(parts) != 5:
+        raise error_proto(resp)
+    host = peer[0]
+    port = int(parts[3])
+    return host, port
+
+def parse_mlsd_time(value):
+    '''Convert an MLSD modify/create fact (YYYYMMDDHHMMSS[.sss], UTC) to
+    a POSIX timestamp.'''
+    seconds = calendar.timegm((int(value[:4]), int(value[4:6]), int(value[6:8]),
+                               int(value[8:10]), int(value[10:12]), int(value[12:14])))
+    return seconds + float('0' + value[14:]) if value[14:15] == '.' else seconds
+
+def parse_mlsd_line(line):
+    '''Parse one MLSD/MLST line ("fact=value;... name") to an MLSDEntry.'''
+    facts, _, name = line.rstrip(CRLF).partition(' ')
+    entry = MLSDEntry(name)
+    for fact in facts.split(';'):
+        key, _, value = fact.partition('=')
+        key = key.lower()
+        if key == 'type':
+            entry.type = value.lower()
+        elif key == 'size':
+            entry.size = int(value)
+        elif key == 'modify':
+            entry.modify = parse_mlsd_time(value)
+        elif key == 'perm':
+            entry.perm = value
+        elif key == 'unique':
+            entry.unique = value
+        elif key:
+            if entry.extra is None:
+                entry.extra = {}
+            entry.extra[key] = value
+    return entry
+
+def parse257(resp):
+    if resp[:3] != '257':
+        raise error_reply(resp)
+    if resp[3:5] != ' "':
+        return '' # Not compliant to RFC 959, but UNIX ftpd does this
+    dirname = ''
+    i = 5
+    n = len(resp)
+    while i < n:
+        c = resp[i]
+        i = i+1
+        if c == '"':
+            if i >= n or resp[i] != '"':
+                break
+            i = i+1
+        dirname = dirname + c
+    return dirname
+
+
+
+
+def print_warning(warning):
+    print(f'{BOLD}{WARNING}{ITALIC}[ERROR] {warning}{ENDC}')
+
+def print_info(info, end=None):
+    if end is not None:
+        print(f'{BOLD}{ITALIC}[INFO]  {info}{ENDC}', end=end)
+    else:
+        print(f'{BOLD}{ITALIC}[INFO]  {info}{ENDC}')
+
+def progress_bar(total, initial=0, quiet=False):
+    if quiet:
+        return _NullBar(initial)
+    from tqdm import tqdm  # only interactive runs need it
+    return tqdm(total=total, initial=initial, unit='B', unit_scale=True,
+                unit_divisor=1024)
+
+class _NullBar:
+    '''Takes a tqdm bar's place where nobody watches, e.g. batch mode.'''
+    def __init__(self, initial=0):
+        self.n = initial
+
+    def update(self, n):
+        self.n += n
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def read_command(prompt):
+    '''Read one command line from stdin; None at end of input.'''
+    try:
+        if prompt:
+            print(prompt)
+        line = sys.stdin.readline()
+        return line.strip() if line else None
+    finally:
+        print(ENDC, end='')
 
 
 
@@ -548,287 +3595,542 @@ def test():
     print(repr(resp))
     ftp.quit()
 
-if __name__ == '__main__':
-    # run_ftp_server.py
-    # - host        =   127.0.0.1:8821 
-    # - home        =   /Users/hatsu3
-    # - username    =   hatsu3
-    # - password    =   password
 
-    host = '127.0.0.1'
-    port = 8822
-    user = 'username'
-    passwd = 'password'
 
 
-    ftp_client = FTP()
+# Shell commands: do_<name>(ftp_client, args, opts) runs one command line.
+# A handler returns False when the command failed; anything else is success.
 
-    ftp_client.connect(host=host, port=port)
-    # -> 220 pyftpdlib 1.5.4 ready.
+def do_ll(ftp_client, args, opts):
+    try:
+        dirname = '.' if not args else args[0]
+        ftp_client.dir(dirname, print)
+    except error_perm:
+        print_warning(f'{dirname}: No such directory')
+        return False
 
-    ftp_client.login(user=user, passwd=passwd)
-    # -> 331 Username ok, send password.
-    # -> 30 Login successful.
+def do_ls(ftp_client, args, opts):
+    try:
+        dirname = '.' if not args else args[0]
+        ftp_client.pretty_mlsd(dirname, short=True)
+    except error_perm:
+        print_warning(f'{dirname}: No such directory')
+        return False
 
-    # ftp_client.dir('.', print)  # ftp_client.dir('./Library')
-    # # -> 200 Type set to: ASCII.
-    # # -> 227 Entering passive mode (127,0,0,1,204,237).
-    # # -> 125 Data connection already open. Transfer starting.
-    # # -> -rw-r--r--   1 hatsu3   staff         267 Jul 18  2018 .489614.padl
-    # # -> -r--------   1 hatsu3   staff           7 Oct 29 12:26 .CFUserTextEncoding
-    # # -> drwx------   2 hatsu3   staff          64 Dec 26 16:19 .CMVolumes
-    # # -> <OMITTED> ...
+def do_lh(ftp_client, args, opts):
+    try:
+        dirname = '.' if not args else args[0]
+        ftp_client.pretty_mlsd(dirname, short=False)
+    except error_perm:
+        print_warning(f'{dirname}: No such directory')
+        return False
 
-    while True:
-        # cmd = input(f'{UNDERLINE}{BOLD}FTP ➜ ').split()
-        print()
-        prompt = f'{UNDERLINE}{BOLD}FTP {OKBLUE}{host}:{port} {OKGREEN}{os.getcwd()} ⌁ {ftp_client.pwd()} ➜{ENDC}{UNDERLINE}{BOLD}'
-        cmd = timeout_input(prompt, timeout=20)
-        while cmd is None:
-            ftp_client.send_noop()
-            cmd = timeout_input('', timeout=20)
-
-        cmd = cmd.split()
-        if not cmd:  # empty input
+def do_cd(ftp_client, args, opts):
+    try:
+        dirname = '.' if not args else args[0]
+        print_info(f'Changing working directory to {dirname}')
+        ftp_client.cwd(dirname)
+    except error_perm:
+        print_warning(f'{dirname}: No such directory')
+        return False
+
+def do_pwd(ftp_client, args, opts):
+    print_info(f'Current working directory: {ftp_client.pwd()}')
+
+def do_download_text(ftp_client, args, opts):
+    try:
+        if len(args) != 1:
+            print('download <FILENAME>')
+            return False
+        filename = args[0]
+        # local_path = Path(filename).name
+        ftp_client.retrlines(f'RETR {filename}', callback=print)
+        remote_path = Path(ftp_client.pwd()) / filename
+        print_info(f'Downloaded text file {remote_path}')
+    except error_perm:
+        print_warning(f'{filename}: No such directory')
+        return False
+
+def do_store_text(ftp_client, args, opts):
+    if len(args) != 1:
+        print('store <FILENAME>')
+        return False
+    filename = args[0]
+    file_path = Path(filename)
+    print_info(f'Checking {file_path}...')
+    if not file_path.is_file():
+        print_warning(f'No such file')
+        return False
+    with file_path.open(mode='rb') as fp:
+        ftp_client.storlines(f'STOR {filename}', fp=fp, callback=None)
+    remote_path = Path(ftp_client.pwd()) / Path(filename).name
+    print_info(f'{filename} saved at {remote_path}')
+
+def do_help(ftp_client, args, opts):
+    print('''
+    - exit
+    - ls </./../DIRNAME>
+    - cd </./../DIRNAME>
+    - pwd
+    - download_text / download <FILENAME>
+    - store_text / store <FILENAME>
+    - help
+    - mkdir <DIRNAME>
+    - rmdir <DIRNAME>
+    - rename <FROM_NAME> <TO_NAME>
+    - sz <FILENAME>
+    - rm <FILENAME>
+    - ccd <PATH>
+    - cpwd
+    - cls
+    - mirror <REMOTE_DIR> [LOCAL_DIR] [WORKERS]
+    - continue_download <FILENAME>
+    - continue_store <FILENAME>
+    - delta_store <FILENAME>
+    - mget <PATTERN>...
+    - mput <PATTERN>...
+    - fxp <[USER[:PASSWORD]@]HOST[:PORT][/DIR]> <PATTERN>...
+    - find [DIR] [PATTERN] [MAXDEPTH]
+    - du [DIR]
+    ''')
+
+def do_download(ftp_client, args, opts):
+    # download binary files
+    try:
+        if len(args) != 1:
+            print('download <FILENAME>')
+            return False
+        filename = args[0]
+        local_path = Path(filename).name
+        sz = ftp_client.size(filename)
+        with progress_bar(sz, quiet=opts.batch) as bar:
+            stats = ftp_client.retrfile(f'RETR {filename}', local_path, sz,
+                                        progress=lambda n: bar.update(n - bar.n))
+        remote_path = Path(ftp_client.pwd()) / filename
+        print_info(f'Downloaded binary file {remote_path}')
+        print_info(stats.summary())
+    except error_perm:
+        print_warning(f'{filename}: No such directory')
+        return False
+
+def do_store(ftp_client, args, opts):
+    # uploas binary files
+    if len(args) != 1:
+        print('store <FILENAME>')
+        return False
+    filename = args[0]
+    file_path = Path(filename)
+    print_info(f'Checking {file_path}...')
+    if not file_path.is_file():
+        print_warning(f'{filename}: No such file')
+        return False
+    sz = os.path.getsize(filename)
+    with file_path.open(mode='rb') as fp, progress_bar(sz, quiet=opts.batch) as bar:
+        stats = ftp_client.storbinary(f'STOR {filename}', fp=fp,
+                                      progress=lambda n: bar.update(n - bar.n))
+    remote_path = Path(ftp_client.pwd()) / Path(filename).name
+    print_info(f'{filename} saved at {remote_path}')
+    print_info(stats.summary())
+
+def do_rm(ftp_client, args, opts):
+    try:
+        if len(args) != 1:
+            print('rm <FILENAME>')
+            return False
+        filename = args[0]
+        ftp_client.delete(filename)
+        remote_path = Path(ftp_client.pwd()) / filename
+        print_info(f'Deleted {remote_path}')
+    except error_perm:
+        print_warning(f'{filename}: No such file')
+        return False
+
+def do_mkdir(ftp_client, args, opts):
+    if len(args) != 1:
+        print('mkdir <DIRNAME>')
+        return False
+    dirname = args[0]
+    ftp_client.mkd(dirname)
+    print_info(f'Created directory {dirname}')
+
+def do_rmdir(ftp_client, args, opts):
+    try:
+        if len(args) != 1:
+            print('rmdir <DIRNAME>')
+            return False
+        dirname = args[0]
+        ftp_client.rmd(dirname)
+        print_info(f'Deleted directory {dirname}')
+    except error_perm:
+        print_warning(f'{dirname}: No such directory')
+        return False
+
+def do_rename(ftp_client, args, opts):
+    try:
+        if len(args) != 2:
+            print('rename <FROM_NAME> <TO_NAME>')
+            return False
+        from_name, to_name = args
+        ftp_client.rename(from_name, to_name)
+        print_info(f'Renamed {from_name} to {to_name}')
+    except error_perm:
+        print_warning(f'{from_name}: No such file or directory')
+        return False
+
+def do_sz(ftp_client, args, opts):
+    try:
+        if len(args) != 1:
+            print('sz <FILENAME>')
+            return False
+        filename = args[0]
+        sz = ftp_client.size(filename)
+        print_info(f'Size of {filename} is {sz} bytes')
+    except error_perm:
+        print_warning(f'{filename}: No such file or directory')
+        return False
+
+def do_ccd(ftp_client, args, opts):
+    try:
+        if len(args) != 1:
+            print('ccd <PATH>')
+            return False
+        new_path = args[0]
+        os.chdir(new_path)
+        print_info(f'[client] Working directory changed to {os.getcwd()}')
+    except FileNotFoundError:
+        print_warning(f'{new_path}: No such directory')
+        return False
+    except:
+        print_warning(f'Failed to cd to {new_path}')
+        return False
+
+def do_cpwd(ftp_client, args, opts):
+    print(f'[client] Current working directory is {os.getcwd()}')
+
+def do_cls(ftp_client, args, opts):
+    for f in os.listdir('.'):
+        if f.startswith('.'):
             continue
-        cmd_type = cmd[0].lower()
-        cmd_args = cmd[1:]
+        sz = os.path.getsize(f)
+        print_info(ftp_client.format_size_(sz) + '\t\t', end='')
+        print(f if os.path.isfile(f) else f'{BOLD}{f}{ENDC}')
 
-        if cmd_type == 'exit' or cmd_type == 'quit':
-            ftp_client.quit()
-            break
+def do_continue_download(ftp_client, args, opts):
+    try:
+        if len(args) != 1:
+            print('download <FILENAME>')
+            return False
+        filename = args[0]
 
-        elif cmd_type == 'll':
-            try:
-                dirname = '.' if not cmd_args else cmd_args[0]
-                ftp_client.dir(dirname, print)
-            except error_perm:
-                print_warning(f'{dirname}: No such directory')
+        print_info(f'Checking {filename}...')
+        if not Path(filename).is_file():
+            print_warning(f'{filename}: No such file')
+            return False
 
-        elif cmd_type == 'ls':
-            try:
-                dirname = '.' if not cmd_args else cmd_args[0]
-                ftp_client.pretty_mlsd(dirname, short=True)
-            except error_perm:
-                print_warning(f'{dirname}: No such directory')
+        local_sz = os.path.getsize(Path(filename).name)
+        remote_sz = ftp_client.size(filename)
+        remain_sz = remote_sz - local_sz
 
-        elif cmd_type == 'lh':
-            try:
-                dirname = '.' if not cmd_args else cmd_args[0]
-                ftp_client.pretty_mlsd(dirname, short=False)
-            except error_perm:
-                print_warning(f'{dirname}: No such directory')
+        if remain_sz <= 0:
+            print_warning('Tranfer completed. Nothing to download')
+            return
 
-        elif cmd_type == 'cd':
-            try:
-                dirname = '.' if not cmd_args else cmd_args[0]
-                print_info(f'Changing working directory to {dirname}')
-                ftp_client.cwd(dirname)
-            except error_perm:
-                print_warning(f'{dirname}: No such directory')
+        print_info(f'Continue downloading {filename}, remaining {ftp_client.format_size_(remain_sz)}')
+        local_path = Path(filename).name
+        remote_path = Path(ftp_client.pwd()) / filename
 
-        elif cmd_type == 'pwd':
-            print_info(f'Current working directory: {ftp_client.pwd()}')
+        with open(local_path, 'ab') as fp, \
+                progress_bar(remote_sz, initial=local_sz, quiet=opts.batch) as bar:
+            ftp_client.retrinto(f'RETR {filename}', fp, rest=local_sz,
+                                progress=lambda n: bar.update(local_sz + n - bar.n))
 
-        elif cmd_type == 'download_text':
-            try:
-                if len(cmd_args) != 1:
-                    print('download <FILENAME>')
-                    continue
-                filename = cmd_args[0]
-                # local_path = Path(filename).name
-                ftp_client.retrlines(f'RETR {filename}', callback=print)
-                remote_path = Path(ftp_client.pwd()) / filename
-                print_info(f'Downloaded text file {remote_path}')
-            except error_perm:
-                print_warning(f'{filename}: No such directory')
+        print_info(f'Downloaded binary file {remote_path}')
+    except error_perm:
+        print_warning(f'{filename}: No such directory')
+        return False
 
-        elif cmd_type == 'store_text':
-            if len(cmd_args) != 1:
-                print('store <FILENAME>')
-                continue
-            filename = cmd_args[0]
-            file_path = Path(filename)
-            print_info(f'Checking {file_path}...')
-            if not file_path.is_file():
-                print_warning(f'No such file')
-                continue
-            fp = file_path.open(mode='rb')
-            ftp_client.storlines(f'STOR {filename}', fp=fp, callback=None)
-            remote_path = Path(ftp_client.pwd()) / Path(filename).name
-            print_info(f'{filename} saved at {remote_path}')
-
-        elif cmd_type == 'help':
-            print('''
-            - exit
-            - ls </./../DIRNAME>
-            - cd </./../DIRNAME>
-            - pwd
-            - download_text / download <FILENAME>
-            - store_text / store <FILENAME>
-            - help
-            - mkdir <DIRNAME>
-            - rmdir <DIRNAME>
-            - rename <FROM_NAME> <TO_NAME>
-            - sz <FILENAME>
-            - rm <FILENAME>
-            - ccd <PATH>
-            - cpwd
-            - cls
-            ''')
-
-        elif cmd_type == 'download':
-            # download binary files
-            try:
-                if len(cmd_args) != 1:
-                    print('download <FILENAME>')
-                    continue
-                filename = cmd_args[0]
-                local_path = Path(filename).name
-                sz = ftp_client.size(filename)
-                blocksize = 8192
-                n_block = sz // blocksize + 1
-                with open(local_path, 'wb') as fp:
-                    ftp_client.retrbinary(f'RETR {filename}', callback=(lambda x: fp.write(x)), \
-                                          blocksize=blocksize, n_block=n_block)
-                remote_path = Path(ftp_client.pwd()) / filename
-                print_info(f'Downloaded binary file {remote_path}')
-            except error_perm:
-                print_warning(f'{filename}: No such directory')
+def do_continue_store(ftp_client, args, opts):
+    if len(args) != 1:
+        print('continue_store <FILENAME>')
+        return False
+    filename = args[0]
+    print_info(f'Checking {filename}...')
+    if not Path(filename).is_file():
+        print_warning(f'{filename}: No such file')
+        return False
+    sz = os.path.getsize(filename)
+    try:
+        with progress_bar(sz, quiet=opts.batch) as bar:
+            stats = ftp_client.store_resumable(
+                filename, filename, chunk_size=64 * 2**20,
+                progress=lambda n: bar.update(n - bar.n))
+    except error_perm as e:
+        print_warning(f'{filename}: {e}')
+        return False
+    remote_path = Path(ftp_client.pwd()) / filename
+    print_info(f'{filename} saved at {remote_path} '
+               f'(resumed at byte {sz - stats.bytes})')
 
-        elif cmd_type == 'store':
-            # uploas binary files
-            if len(cmd_args) != 1:
-                print('store <FILENAME>')
-                continue
-            filename = cmd_args[0]
-            file_path = Path(filename)
-            print_info(f'Checking {file_path}...')
-            if not file_path.is_file():
-                print_warning(f'{filename}: No such file')
-                continue
-            sz = os.path.getsize(filename)
-            blocksize = 8192
-            n_block = sz // blocksize + 1
-            fp = file_path.open(mode='rb')
-            ftp_client.storbinary(f'STOR {filename}', fp=fp, callback=None, \
-                                blocksize=blocksize, n_block=n_block)
-            remote_path = Path(ftp_client.pwd()) / Path(filename).name
-            print_info(f'{filename} saved at {remote_path}')
-
-        elif cmd_type == 'rm':
-            try:
-                if len(cmd_args) != 1:
-                    print('rm <FILENAME>')
-                    continue
-                filename = cmd_args[0]
-                ftp_client.delete(filename)
-                remote_path = Path(ftp_client.pwd()) / filename
-                print_info(f'Deleted {remote_path}')
-            except error_perm:
-                print_warning(f'{filename}: No such file')
+def do_delta_store(ftp_client, args, opts):
+    if len(args) != 1:
+        print('delta_store <FILENAME>')
+        return False
+    filename = args[0]
+    print_info(f'Checking {filename}...')
+    if not Path(filename).is_file():
+        print_warning(f'{filename}: No such file')
+        return False
+    sz = os.path.getsize(filename)
+    try:
+        with progress_bar(sz, quiet=opts.batch) as bar:
+            result = ftp_client.store_delta(
+                filename, filename, progress=lambda n: bar.update(n - bar.n))
+    except Error as e:
+        print_warning(f'{filename}: {e}')
+        return False
+    remote_path = Path(ftp_client.pwd()) / filename
+    print_info(f'{filename} saved at {remote_path} '
+               f'({ftp_client.format_size_(result.sent)} sent in '
+               f'{len(result.ranges)} ranges)')
 
-        elif cmd_type == 'mkdir':
-            if len(cmd_args) != 1:
-                print('mkdir <DIRNAME>')
-                continue
-            dirname = cmd_args[0]
-            ftp_client.mkd(dirname)
-            print_info(f'Created directory {dirname}')
+def do_mirror(ftp_client, args, opts):
+    if not 1 <= len(args) <= 3:
+        print('mirror <REMOTE_DIR> [LOCAL_DIR] [WORKERS]')
+        return False
+    remote_dir = args[0]
+    local_dir = args[1] if len(args) > 1 else Path(remote_dir).name or '.'
+    workers = int(args[2]) if len(args) > 2 else opts.jobs
+    print_info(f'Mirroring {remote_dir} into {local_dir} with {workers} sessions')
+    result = ftp_client.mirror(remote_dir, local_dir, workers=workers)
+    for path, error in result.failed:
+        print_warning(f'{path}: {error}')
+    print_info(f'{len(result.downloaded)} downloaded, {len(result.skipped)} '
+               f'up to date, {len(result.failed)} failed')
+    return not result.failed
 
-        elif cmd_type == 'rmdir':
-            try:
-                if len(cmd_args) != 1:
-                    print('rmdir <DIRNAME>')
-                    continue
-                dirname = cmd_args[0]
-                ftp_client.rmd(dirname)
-                print_info(f'Deleted directory {dirname}')
-            except error_perm:
-                print_warning(f'{dirname}: No such directory')
+def do_mget(ftp_client, args, opts):
+    if not args:
+        print('mget <PATTERN>...')
+        return False
+    return print_batch(ftp_client, ftp_client.mget(args, workers=opts.jobs))
 
-        elif cmd_type == 'rename':
-            try:
-                if len(cmd_args) != 2:
-                    print('rename <FROM_NAME> <TO_NAME>')
-                    continue
-                from_name, to_name = cmd_args
-                ftp_client.rename(from_name, to_name)
-                print_info(f'Renamed {from_name} to {to_name}')
-            except error_perm:
-                print_warning(f'{from_name}: No such file or directory')
+def do_mput(ftp_client, args, opts):
+    if not args:
+        print('mput <PATTERN>...')
+        return False
+    return print_batch(ftp_client, ftp_client.mput(args, workers=opts.jobs))
 
-        elif cmd_type == 'sz':
-            try:
-                if len(cmd_args) != 1:
-                    print('sz <FILENAME>')
-                    continue
-                filename = cmd_args[0]
-                sz = ftp_client.size(filename)
-                print_info(f'Size of {filename} is {sz} bytes')
-            except error_perm:
-                print_warning(f'{filename}: No such file or directory')
+def do_fxp(ftp_client, args, opts):
+    # copy server to server; the other server's login defaults to ours
+    if len(args) < 2:
+        print('fxp <[USER[:PASSWORD]@]HOST[:PORT][/DIR]> <PATTERN>...')
+        return False
+    target = urllib.parse.urlsplit(args[0] if '//' in args[0] else '//' + args[0])
+    dst = FTP(timeout=ftp_client.timeout)
+    dst.connect(target.hostname, target.port or FTP_PORT)
+    try:
+        dst.login(urllib.parse.unquote(target.username or ftp_client.user),
+                  urllib.parse.unquote(target.password or ftp_client.passwd))
+        result = fxp_batch(ftp_client, dst, args[1:], target.path.lstrip('/'),
+                           workers=opts.jobs)
+    finally:
+        _shutdown(dst)
+    return print_batch(ftp_client, result)
 
-        elif cmd_type == 'ccd':
-            try:
-                if len(cmd_args) != 1:
-                    print('ccd <PATH>')
-                    continue
-                new_path = cmd_args[0]
-                os.chdir(new_path)
-                print_info(f'[client] Working directory changed to {os.getcwd()}')
-            except FileNotFoundError:
-                print_warning(f'{new_path}: No such directory')
-            except:
-                print_warning(f'Failed to cd to {new_path}')
+def do_find(ftp_client, args, opts):
+    # print the paths below DIR whose name matches PATTERN, as they are listed
+    if len(args) > 3:
+        print('find [DIR] [PATTERN] [MAXDEPTH]')
+        return False
+    top = args[0] if args else ''
+    pattern = args[1] if len(args) > 1 else '*'
+    maxdepth = int(args[2]) if len(args) > 2 else None
+    failed = []
+    for dirpath, dirs, files in ftp_client.walk(
+            top, workers=opts.jobs, maxdepth=maxdepth,
+            onerror=lambda path, e: failed.append((path, e))):
+        for entry in dirs + files:
+            if fnmatch.fnmatchcase(entry.name, pattern):
+                print(posixpath.join(dirpath, entry.name), flush=True)
+    for path, error in failed:
+        print_warning(f'{path}: {error}')
+    return not failed
 
-        elif cmd_type == 'cpwd':
-            print(f'[client] Current working directory is {os.getcwd()}')
+def do_du(ftp_client, args, opts):
+    # total size of the files below DIR
+    if len(args) > 1:
+        print('du [DIR]')
+        return False
+    top = args[0] if args else ''
+    n_dirs = n_files = total = 0
+    failed = []
+    for dirpath, dirs, files in ftp_client.walk(
+            top, workers=opts.jobs,
+            onerror=lambda path, e: failed.append((path, e))):
+        n_dirs += 1
+        n_files += len(files)
+        total += sum(entry.size or 0 for entry in files)
+    for path, error in failed:
+        print_warning(f'{path}: {error}')
+    print_info(f'{ftp_client.format_size_(total).strip()} in {n_files} files, '
+               f'{n_dirs} directories')
+    return not failed
 
-        elif cmd_type == 'cls':
-            for f in os.listdir('.'):
-                if f.startswith('.'):
-                    continue
-                sz = os.path.getsize(f)
-                print_info(ftp_client.format_size_(sz) + '\t\t', end='')
-                print(f if os.path.isfile(f) else f'{BOLD}{f}{ENDC}')
+def print_batch(ftp_client, result):
+    '''Per-file summary of a BatchResult; True when nothing failed.'''
+    for name, stats in result.done:
+        print_info(f'{"ok":<8}{name}  {stats.summary()}')
+    for name, error in result.failed:
+        print_warning(f'{"failed":<8}{name}  {error}')
+    total = sum(stats.bytes for _, stats in result.done)
+    print_info(f'{len(result.done)} transferred ({ftp_client.format_size_(total).strip()}), '
+               f'{len(result.failed)} failed')
+    return not result.failed
 
-        elif cmd_type == 'continue_download':
-            try:
-                if len(cmd_args) != 1:
-                    print('download <FILENAME>')
-                    continue
-                filename = cmd_args[0]
-
-                print_info(f'Checking {filename}...')
-                if not Path(filename).is_file():
-                    print_warning(f'{filename}: No such file')
-                    continue
-
-                local_sz = os.path.getsize(Path(filename).name)
-                remote_sz = ftp_client.size(filename)
-                remain_sz = remote_sz - local_sz
-                blocksize = 8192
-                n_block = remain_sz // blocksize + 1
-
-                if n_block == 0:
-                    print_warning('Tranfer completed. Nothing to download')
-                    continue
-
-                print_info(f'Continue downloading {filename}, remaining {ftp_client.format_size_(remain_sz)}')
-                local_path = Path(filename).name
-                remote_path = Path(ftp_client.pwd()) / filename
-
-                with open(local_path, 'ab') as fp:
-                    ftp_client.retrbinary(f'RETR {filename}', callback=(lambda x: fp.write(x)), \
-                                          blocksize=blocksize, n_block=n_block, rest=local_sz)
-
-                print_info(f'Downloaded binary file {remote_path}')
-            except error_perm:
-                print_warning(f'{filename}: No such directory')
+SHELL_COMMANDS = {
+    'll': do_ll,
+    'ls': do_ls,
+    'lh': do_lh,
+    'cd': do_cd,
+    'pwd': do_pwd,
+    'download_text': do_download_text,
+    'store_text': do_store_text,
+    'help': do_help,
+    'download': do_download,
+    'store': do_store,
+    'rm': do_rm,
+    'mkdir': do_mkdir,
+    'rmdir': do_rmdir,
+    'rename': do_rename,
+    'sz': do_sz,
+    'ccd': do_ccd,
+    'cpwd': do_cpwd,
+    'cls': do_cls,
+    'continue_download': do_continue_download,
+    'continue_store': do_continue_store,
+    'delta_store': do_delta_store,
+    'mirror': do_mirror,
+    'mget': do_mget,
+    'mput': do_mput,
+    'fxp': do_fxp,
+    'find': do_find,
+    'du': do_du,
+}
 
-        else:
-            print_warning('Invalid command. Try help')
+def dispatch(ftp_client, line, opts):
+    '''Run one shell command line. Returns True when it succeeded, False
+    when it failed and None when it asks to quit.
+    '''
+    cmd = line.split()
+    if not cmd:  # empty input
+        return True
+    cmd_type = cmd[0].lower()
+    cmd_args = cmd[1:]
+    if cmd_type == 'exit' or cmd_type == 'quit':
+        return None
+    handler = SHELL_COMMANDS.get(cmd_type)
+    if handler is None:
+        print_warning('Invalid command. Try help')
+        return False
+    try:
+        return handler(ftp_client, cmd_args, opts) is not False
+    except all_errors as e:  # unexpected reply or lost connection
+        print_warning(f'{cmd_type}: {e}')
+        return False
+
+def run_batch(ftp_client, script, opts):
+    '''Run every line of `script`, a file object, as a shell command.
+
+    Blank lines and lines starting with # are skipped. Unless
+    `opts.keep_going` is set the first failed command stops the run.
+    Returns the exit status: 0 when every command succeeded, else 1.
+    '''
+    status = 0
+    for number, line in enumerate(script, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        print_info(f'{number}: {line}')
+        ok = dispatch(ftp_client, line, opts)
+        if ok is None:
+            break
+        if not ok:
+            status = 1
+            if not opts.keep_going:
+                print_warning(f'{number}: stopping after failed command')
+                break
+    return status
+
+def main(argv=None):
+    # run_ftp_server.py
+    # - host        =   127.0.0.1:8821 
+    # - home        =   /Users/hatsu3
+    # - username    =   hatsu3
+    # - password    =   password
+    parser = argparse.ArgumentParser(description='FTP client shell')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', '-P', type=int, default=8822)
+    parser.add_argument('--username', '-u', default='username')
+    parser.add_argument('--password', '-p', default='password')
+    parser.add_argument('--batch', '-b', metavar='SCRIPT',
+                        help="run the commands in SCRIPT ('-' for stdin) and exit")
+    parser.add_argument('--keep-going', '-k', action='store_true',
+                        help='in batch mode, carry on after a failed command')
+    parser.add_argument('--jobs', '-j', type=int, default=4,
+                        help='parallel sessions for mget, mput, mirror, fxp, find and du')
+    opts = parser.parse_args(argv)
+
+    host = opts.host
+    port = opts.port
+
+    ftp_client = FTP()
+    try:
+        ftp_client.connect(host=host, port=port)
+        # -> 220 pyftpdlib 1.5.4 ready.
+
+        ftp_client.login(user=opts.username, passwd=opts.password)
+        # -> 331 Username ok, send password.
+        # -> 30 Login successful.
+    except (OSError, *all_errors) as e:
+        print_warning(f'{host}:{port}: {e}')
+        return 2
+
+    # NOOP after 20 idle seconds, also while waiting for user input
+    ftp_client.start_keepalive(interval=20, tcp_idle=60)
+    # repeated ls / lh / sz within 10 seconds skip the network
+    ftp_client.enable_cache(ttl=10)
+
+    # ftp_client.dir('.', print)  # ftp_client.dir('./Library')
+    # # -> 200 Type set to: ASCII.
+    # # -> 227 Entering passive mode (127,0,0,1,204,237).
+    # # -> 125 Data connection already open. Transfer starting.
+    # # -> -rw-r--r--   1 hatsu3   staff         267 Jul 18  2018 .489614.padl
+    # # -> -r--------   1 hatsu3   staff           7 Oct 29 12:26 .CFUserTextEncoding
+    # # -> drwx------   2 hatsu3   staff          64 Dec 26 16:19 .CMVolumes
+    # # -> <OMITTED> ...
+
+    try:
+        if opts.batch == '-':
+            return run_batch(ftp_client, sys.stdin, opts)
+        if opts.batch:
+            with open(opts.batch) as script:
+                return run_batch(ftp_client, script, opts)
+
+        while True:
+            # cmd = input(f'{UNDERLINE}{BOLD}FTP ➜ ').split()
+            print()
+            prompt = f'{UNDERLINE}{BOLD}FTP {OKBLUE}{host}:{port} {OKGREEN}{os.getcwd()} ⌁ {ftp_client.pwd()} ➜{ENDC}{UNDERLINE}{BOLD}'
+            cmd = read_command(prompt)
+            if cmd is None:  # end of input
+                break
+            if dispatch(ftp_client, cmd, opts) is None:
+                break
+        return 0
+    finally:
+        try:
+            ftp_client.quit()
+        except all_errors:
+            ftp_client.close()
 
     # filename = input('Which file to retrieve: ')
     # # <- Users/hatsu3/Documents/GitHub/ftpclient/ftp.py
@@ -842,3 +4144,6 @@ if __name__ == '__main__':
 
     # ftp_client.quit()
     # # -> 21 Goodbye.
+
+if __name__ == '__main__':
+    sys.exit(main())
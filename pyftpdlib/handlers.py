@@ -6,10 +6,12 @@ import asynchat
 import contextlib
 import errno
 import glob
+import hashlib
 import logging
 import os
 import random
 import socket
+import struct
 import sys
 import time
 import traceback
@@ -32,6 +34,11 @@ try:
 except ImportError:
     OrderedDict = dict
 
+try:
+    import zlib  # MODE Z
+except ImportError:
+    zlib = None
+
 from . import __ver__
 from ._compat import b
 from ._compat import getcwdu
@@ -126,7 +133,7 @@ proto_cmds = {
         help='Syntax: MLST [<SP> path] (show information about path).'),
     'MODE': dict(
         perm=None, auth=True, arg=True,
-        help='Syntax: MODE <SP> mode (noop; set data transfer mode).'),
+        help='Syntax: MODE <SP> mode (set data transfer mode).'),
     'MKD': dict(
         perm='m', auth=True, arg=True,
         help='Syntax: MKD <SP> path (create directory).'),
@@ -181,6 +188,10 @@ proto_cmds = {
     'SITE CHMOD': dict(
         perm='M', auth=True, arg=True,
         help='Syntax: SITE CHMOD <SP> mode path (change file mode).'),
+    'SITE BLKHASH': dict(
+        perm='r', auth=True, arg=True,
+        help='Syntax: SITE BLKHASH <SP> block-size path (SHA-256 of each '
+             'block and of the whole file).'),
     'SIZE': dict(
         perm='l', auth=True, arg=True,
         help='Syntax: SIZE <SP> file-name (get file size).'),
@@ -265,6 +276,18 @@ class _FileReadWriteError(OSError):
     """Exception raised when reading or writing a file during a transfer."""
 
 
+class _InflateError(Exception):
+    """Exception raised when a MODE Z upload is not valid zlib data."""
+
+
+# MODE B block header (RFC-959, 3.4.2): a descriptor byte and a 16 bit
+# byte count.
+_BLOCK_HEADER = struct.Struct('!BH')
+_BLOCK_EOF = 64
+_BLOCK_RESTART = 16
+_BLOCK_MAXSIZE = 65535
+
+
 class _GiveUpOnSendfile(Exception):
     """Exception raised in case use of sendfile() fails on first try,
     in which case send() will be used.
@@ -562,6 +585,10 @@ class DTPHandler(AsyncChat):
      - (int) ac_in_buffer_size: incoming data buffer size (defaults 65536)
 
      - (int) ac_out_buffer_size: outgoing data buffer size (defaults 65536)
+
+    In MODE B the end of a file is marked by a block descriptor instead
+    of closing the connection, so the channel outlives the transfer and
+    is reused by the next one.
     """
 
     timeout = 300
@@ -585,6 +612,12 @@ class DTPHandler(AsyncChat):
         self.log = cmd_channel.log
         self.log_exception = cmd_channel.log_exception
         self._data_wrapper = None
+        self._inflater = None
+        self._keep_open = False
+        self._idle = False
+        self._block_buf = b''
+        self._block_left = 0
+        self._block_desc = 0
         self._lastdata = 0
         self._had_cr = False
         self._start_time = timer()
@@ -633,15 +666,31 @@ class DTPHandler(AsyncChat):
         if self.cmd_channel._current_type != 'i':
             # text file transfer (need to transform file content on the fly)
             return False
+        if self.cmd_channel._current_mode != 's':
+            # MODE B and Z transform the file content on the fly
+            return False
         return True
 
+    def _begin_transfer(self):
+        if self._idle:
+            # a MODE B channel is reused: as in _on_dtp_connection()
+            # the control connection can't time out during the transfer
+            self._idle = False
+            self._start_time = timer()
+            idler = self.cmd_channel._idler
+            if idler is not None and not idler.cancelled:
+                idler.cancel()
+        self._keep_open = self.cmd_channel._current_mode == 'b'
+
     def push(self, data):
+        self._begin_transfer()
         self._initialized = True
         self.modify_ioloop_events(self.ioloop.WRITE)
         self._wanted_io_events = self.ioloop.WRITE
         AsyncChat.push(self, data)
 
     def push_with_producer(self, producer):
+        self._begin_transfer()
         self._initialized = True
         self.modify_ioloop_events(self.ioloop.WRITE)
         self._wanted_io_events = self.ioloop.WRITE
@@ -715,6 +764,7 @@ class DTPHandler(AsyncChat):
 
          - (str) type: current transfer type, 'a' (ASCII) or 'i' (binary).
         """
+        self._begin_transfer()
         self._initialized = True
         self.modify_ioloop_events(self.ioloop.READ)
         self._wanted_io_events = self.ioloop.READ
@@ -728,6 +778,8 @@ class DTPHandler(AsyncChat):
             self._data_wrapper = None
         else:
             raise TypeError("unsupported type")
+        if self.cmd_channel._current_mode == 'z':
+            self._inflater = zlib.decompressobj()
         self.receive = True
 
     def get_transmitted_bytes(self):
@@ -792,15 +844,70 @@ class DTPHandler(AsyncChat):
                 self.transfer_finished = True
                 # self.close()  # <-- asyncore.recv() already do that...
                 return
-            if self._data_wrapper is not None:
-                chunk = self._data_wrapper(chunk)
-            try:
-                self.file_obj.write(chunk)
-            except OSError as err:
-                raise _FileReadWriteError(err)
+            if self._idle:
+                # nothing is expected between MODE B transfers
+                debug("unexpected data on idle data channel", self)
+                self.close()
+                return
+            if self._keep_open:
+                self._read_blocks(chunk)
+                return
+            if self._inflater is not None:
+                try:
+                    chunk = self._inflater.decompress(chunk)
+                except zlib.error as err:
+                    raise _InflateError(err)
+            self._write_chunk(chunk)
 
     handle_read_event = handle_read  # small speedup
 
+    def _read_blocks(self, chunk):
+        """Unpack MODE B blocks, writing their data to file, and end
+        the transfer on the block marked EOF.
+        """
+        buf = self._block_buf + chunk if self._block_buf else chunk
+        self._block_buf = b''
+        pos = 0
+        while pos < len(buf):
+            if self._block_left:
+                n = min(self._block_left, len(buf) - pos)
+                # restart markers carry no file data
+                if not self._block_desc & _BLOCK_RESTART:
+                    self._write_chunk(buf[pos:pos + n])
+                self._block_left -= n
+                pos += n
+            elif len(buf) - pos < _BLOCK_HEADER.size:
+                self._block_buf = buf[pos:]
+                return
+            else:
+                self._block_desc, self._block_left = \
+                    _BLOCK_HEADER.unpack_from(buf, pos)
+                pos += _BLOCK_HEADER.size
+            if not self._block_left and self._block_desc & _BLOCK_EOF:
+                self._end_transfer()
+                return
+
+    def _write_chunk(self, chunk):
+        if self._data_wrapper is not None:
+            chunk = self._data_wrapper(chunk)
+        try:
+            self.file_obj.write(chunk)
+        except OSError as err:
+            raise _FileReadWriteError(err)
+
+    def _flush_inflater(self):
+        """Write out what the MODE Z decompressor still holds. Return
+        False if the compressed stream was cut short.
+        """
+        if self._inflater is None:
+            return True
+        inflater, self._inflater = self._inflater, None
+        try:
+            self._write_chunk(inflater.flush())
+        except (zlib.error, _FileReadWriteError):
+            return False
+        return inflater.eof
+
     def readable(self):
         """Predicate for inclusion in the readable for select()."""
         # It the channel is not supposed to be receiving but yet it's
@@ -811,8 +918,27 @@ class DTPHandler(AsyncChat):
         # upper IOLoop might end up calling readable() repeatedly,
         # hogging CPU resources.
         if not self.receive and not self._initialized:
-            return self.close()
-        return self.receive
+            if not self._data_pending():
+                return self.close()
+            # the client started sending before the STOR command got
+            # here (e.g. a server to server copy): stop polling until
+            # enable_receiving() registers the channel again
+            self.del_channel()
+            return False
+        # an idle MODE B channel watches for the client closing it
+        return self.receive or self._idle
+
+    def _data_pending(self):
+        """Return True if the peer has sent data which is waiting to be
+        read, False if it closed the connection.
+        """
+        if not isinstance(self.socket, socket.socket):
+            # SSL connection: can't peek without reading TLS records
+            return False
+        try:
+            return bool(self.socket.recv(1, socket.MSG_PEEK))
+        except socket.error as err:
+            return err.errno in _ERRNOS_RETRY
 
     def writable(self):
         """Predicate for inclusion in the writable for select()."""
@@ -822,7 +948,9 @@ class DTPHandler(AsyncChat):
         """Called cyclically to check if data trasfer is stalling with
         no progress in which case the client is kicked off.
         """
-        if self.get_transmitted_bytes() > self._lastdata:
+        if self._idle:
+            self.close()
+        elif self.get_transmitted_bytes() > self._lastdata:
             self._lastdata = self.get_transmitted_bytes()
         else:
             msg = "Data connection timed out."
@@ -838,6 +966,8 @@ class DTPHandler(AsyncChat):
         # from / to file (e.g. file system gets full)
         except _FileReadWriteError as err:
             error = _strerror(err.errno)
+        except _InflateError:
+            error = "Invalid compressed data"
         except Exception:
             # some other exception occurred;  we don't want to provide
             # confidential error messages
@@ -858,10 +988,21 @@ class DTPHandler(AsyncChat):
         # In both cases handle_close() is automatically called by the
         # underlying asynchat module.
         if not self._closed:
+            if self._idle:
+                self.close()
+                return
             if self.receive:
-                self.transfer_finished = True
+                if self._keep_open:
+                    # MODE B marks the end of file with a block
+                    # descriptor: the connection should not go away
+                    self.transfer_finished = False
+                else:
+                    self.transfer_finished = self._flush_inflater()
             else:
                 self.transfer_finished = len(self.producer_fifo) == 0
+                if self.transfer_finished and self._keep_open:
+                    self._end_transfer()
+                    return
             try:
                 if self.transfer_finished:
                     self._resp = ("226 Transfer complete.", logger.debug)
@@ -879,38 +1020,66 @@ class DTPHandler(AsyncChat):
         if not self._closed:
             # RFC-959 says we must close the connection before replying
             AsyncChat.close(self)
-
-            # Close file object before responding successfully to client
-            if self.file_obj is not None and not self.file_obj.closed:
-                self.file_obj.close()
-
-            if self._resp:
-                self.cmd_channel.respond(self._resp[0], logfun=self._resp[1])
-
             if self._idler is not None and not self._idler.cancelled:
                 self._idler.cancel()
-            if self.file_obj is not None:
-                filename = self.file_obj.name
-                elapsed_time = round(self.get_elapsed_time(), 3)
-                self.cmd_channel.log_transfer(
-                    cmd=self.cmd,
-                    filename=self.file_obj.name,
-                    receive=self.receive,
-                    completed=self.transfer_finished,
-                    elapsed=elapsed_time,
-                    bytes=self.get_transmitted_bytes())
-                if self.transfer_finished:
-                    if self.receive:
-                        self.cmd_channel.on_file_received(filename)
-                    else:
-                        self.cmd_channel.on_file_sent(filename)
-                else:
-                    if self.receive:
-                        self.cmd_channel.on_incomplete_file_received(filename)
-                    else:
-                        self.cmd_channel.on_incomplete_file_sent(filename)
+            self._finish_transfer()
             self.cmd_channel._on_dtp_close()
 
+    def _finish_transfer(self):
+        """Close the file, send the final reply and log the transfer."""
+        # Close file object before responding successfully to client
+        if self.file_obj is not None and not self.file_obj.closed:
+            self.file_obj.close()
+
+        if self._resp:
+            self.cmd_channel.respond(self._resp[0], logfun=self._resp[1])
+
+        if self.file_obj is not None:
+            filename = self.file_obj.name
+            elapsed_time = round(self.get_elapsed_time(), 3)
+            self.cmd_channel.log_transfer(
+                cmd=self.cmd,
+                filename=self.file_obj.name,
+                receive=self.receive,
+                completed=self.transfer_finished,
+                elapsed=elapsed_time,
+                bytes=self.get_transmitted_bytes())
+            if self.transfer_finished:
+                if self.receive:
+                    self.cmd_channel.on_file_received(filename)
+                else:
+                    self.cmd_channel.on_file_sent(filename)
+            else:
+                if self.receive:
+                    self.cmd_channel.on_incomplete_file_received(filename)
+                else:
+                    self.cmd_channel.on_incomplete_file_sent(filename)
+
+    def _end_transfer(self):
+        """Complete a MODE B transfer, keeping the connection open for
+        the next one.
+        """
+        self.transfer_finished = True
+        self._resp = ("250 Transfer complete.", logger.debug)
+        self._finish_transfer()
+        self.file_obj = None
+        self.receive = False
+        self.cmd = None
+        self._resp = ()
+        self._closing = False
+        self._data_wrapper = None
+        self._had_cr = False
+        self._block_buf = b''
+        self._block_left = 0
+        self._block_desc = 0
+        self.tot_bytes_sent = 0
+        self.tot_bytes_received = 0
+        self._lastdata = 0
+        self._idle = True
+        self.modify_ioloop_events(self.ioloop.READ)
+        self._wanted_io_events = self.ioloop.READ
+        self.cmd_channel._on_dtp_idle()
+
 
 # dirty hack in order to turn AsyncChat into a new style class in
 # python 2.x so that we can use super()
@@ -1045,6 +1214,95 @@ class FileProducer(object):
             return data
 
 
+class DeflateProducer(object):
+    """Producer wrapper compressing the output of another producer into
+    one zlib stream, as MODE Z transfers require.
+
+    Data which is already compressed is sent in stored (level 0)
+    deflate blocks: it would not shrink, only cost CPU time. Such data
+    is recognized by the file name suffix or by a test compression of
+    the first chunk.
+    """
+    incompressible_suffixes = (
+        '.gz', '.tgz', '.bz2', '.xz', '.lz', '.lzma', '.zst', '.z', '.zip',
+        '.7z', '.rar', '.jar', '.apk', '.jpg', '.jpeg', '.png', '.gif',
+        '.webp', '.mp3', '.ogg', '.flac', '.mp4', '.m4a', '.mkv', '.avi',
+        '.mov', '.webm')
+
+    def __init__(self, producer, level=6):
+        """Initialize the producer.
+
+         - (instance) producer: the producer whose output to compress.
+         - (int) level: zlib compression level, 0-9.
+        """
+        self.producer = producer
+        self.level = level
+        self._deflater = None
+        self._done = False
+        name = getattr(getattr(producer, 'file', None), 'name', None)
+        if isinstance(name, (str, unicode)) and \
+                name.lower().endswith(self.incompressible_suffixes):
+            self.level = 0
+
+    def _choose_level(self, sample):
+        sample = sample[:65536]
+        if self.level and len(sample) >= 4096 and \
+                len(zlib.compress(sample, 1)) > len(sample) * 0.95:
+            return 0
+        return self.level
+
+    def more(self):
+        """Return the next piece of the zlib stream."""
+        while not self._done:
+            data = self.producer.more()
+            if self._deflater is None:
+                self._deflater = zlib.compressobj(self._choose_level(data))
+            if not data:
+                self._done = True
+                return self._deflater.flush()
+            data = self._deflater.compress(data)
+            if data:
+                return data
+        return b''
+
+
+def _pack_blocks(data, eof=False):
+    """Frame data as MODE B blocks, ending with an EOF block if `eof`."""
+    blocks = []
+    for i in xrange(0, len(data), _BLOCK_MAXSIZE):
+        chunk = data[i:i + _BLOCK_MAXSIZE]
+        blocks.append(_BLOCK_HEADER.pack(0, len(chunk)))
+        blocks.append(chunk)
+    if eof:
+        blocks.append(_BLOCK_HEADER.pack(_BLOCK_EOF, 0))
+    return b''.join(blocks)
+
+
+class BlockProducer(object):
+    """Producer wrapper framing the output of another producer as
+    MODE B blocks, the last one marked EOF.
+
+    It reads one chunk ahead so that the EOF block goes out together
+    with the last data instead of as a tiny segment of its own.
+    """
+
+    def __init__(self, producer):
+        self.producer = producer
+        self._next = None
+        self._done = False
+
+    def more(self):
+        """Return the next blocks."""
+        if self._done:
+            return b''
+        data = self._next
+        if data is None:
+            data = self.producer.more()
+        self._next = self.producer.more() if data else b''
+        self._done = not self._next
+        return _pack_blocks(data, eof=self._done)
+
+
 class BufferedIteratorProducer(object):
     """Producer for iterator objects with buffer capabilities."""
     # how many times iterator.next() will be called before
@@ -1146,6 +1404,14 @@ class FTPHandler(AsyncChat):
        the prefix string preceding any log line; all instance
        attributes can be used as arguments.
 
+     - (int) zlib_level:
+       the compression level of MODE Z transfers until the client
+       changes it with OPTS MODE Z LEVEL (default 6).
+
+     - (int) blkhash_min_blocksize:
+       the smallest block size SITE BLKHASH accepts, which bounds the
+       length of its reply (default 4096).
+
 
     All relevant instance attributes initialized when client connects
     are reproduced below.  You may be interested in them in case you
@@ -1155,6 +1421,8 @@ class FTPHandler(AsyncChat):
      - (str) username: the name of the connected user (if any).
      - (int) attempted_logins: number of currently attempted logins.
      - (str) current_type: the current transfer type (default "a")
+     - (str) current_mode: the current transfer mode, "s", "b" or "z"
+       (default "s")
      - (int) af: the connection's address family (IPv4/IPv6)
      - (instance) server: the FTPServer class instance.
      - (instance) data_channel: the data channel instance (if any).
@@ -1184,6 +1452,8 @@ class FTPHandler(AsyncChat):
     unicode_errors = 'replace'
     log_prefix = '%(remote_ip)s:%(remote_port)s-[%(username)s]'
     auth_failed_timeout = 3
+    zlib_level = 6
+    blkhash_min_blocksize = 4096
 
     def __init__(self, conn, server, ioloop=None):
         """Initialize the command channel.
@@ -1207,6 +1477,9 @@ class FTPHandler(AsyncChat):
         # private session attributes
         self._last_response = ""
         self._current_type = 'a'
+        self._current_mode = 's'
+        self._zlib_level = self.zlib_level
+        self._stor_in_place = False
         self._restart_position = 0
         self._quit_pending = False
         self._in_buffer = []
@@ -1496,6 +1769,16 @@ class FTPHandler(AsyncChat):
                         mode, arg = arg.split(' ', 1)
                         arg = self.fs.ftp2fs(arg)
                         kwargs = dict(mode=mode)
+                elif cmd == 'SITE BLKHASH':
+                    if ' ' not in arg:
+                        msg = "Syntax error: command needs two arguments."
+                        self.respond("501 " + msg)
+                        self.log_cmd(cmd, "", 501, msg)
+                        return
+                    else:
+                        blocksize, arg = arg.split(' ', 1)
+                        arg = self.fs.ftp2fs(arg)
+                        kwargs = dict(blocksize=blocksize)
                 elif cmd == 'MFMT':
                     if ' ' not in arg:
                         msg = "Syntax error: command needs two arguments."
@@ -1674,6 +1957,10 @@ class FTPHandler(AsyncChat):
         if self._dtp_acceptor is not None:
             self._dtp_acceptor.close()
             self._dtp_acceptor = None
+        # ActiveDTP handed its socket over: forget it, or closing it on
+        # the next PORT/ABOR would unregister whatever channel reuses
+        # the same fd number by then
+        self._dtp_connector = None
 
         # stop the idle timer as long as the data transfer is not finished
         if self._idler is not None and not self._idler.cancelled:
@@ -1709,7 +1996,20 @@ class FTPHandler(AsyncChat):
         self.data_channel = None
         if self._quit_pending:
             self.close()
-        elif self.timeout:
+        else:
+            self._restart_idler()
+
+    def _on_dtp_idle(self):
+        """Called when a MODE B transfer completes and the data channel
+        stays open.
+        """
+        if self._quit_pending:
+            self.data_channel.close()
+        else:
+            self._restart_idler()
+
+    def _restart_idler(self):
+        if self.timeout:
             # data transfer finished, restart the idle timer
             if self._idler is not None and not self._idler.cancelled:
                 self._idler.cancel()
@@ -1747,6 +2047,16 @@ class FTPHandler(AsyncChat):
          - (bool) isproducer: whether treat data as a producer.
          - (file) file: the file[-like] object to send (if any).
         """
+        if self._current_mode == 'z':
+            if isproducer:
+                data = DeflateProducer(data, self._zlib_level)
+            else:
+                data = zlib.compress(data, self._zlib_level)
+        elif self._current_mode == 'b':
+            if isproducer:
+                data = BlockProducer(data)
+            else:
+                data = _pack_blocks(data, eof=True)
         if self.data_channel is not None:
             self.respond(
                 "125 Data connection already open. Transfer starting.")
@@ -1788,6 +2098,9 @@ class FTPHandler(AsyncChat):
         self.password = ""
         self.attempted_logins = 0
         self._current_type = 'a'
+        self._current_mode = 's'
+        self._zlib_level = self.zlib_level
+        self._stor_in_place = False
         self._restart_position = 0
         self._quit_pending = False
         self._in_dtp_queue = None
@@ -2105,7 +2418,7 @@ class FTPHandler(AsyncChat):
         # If file transfer is in progress, the connection must remain
         # open for result response and the server will then close it.
         # We also stop responding to any further command.
-        if self.data_channel:
+        if self.data_channel and not self.data_channel._idle:
             self._quit_pending = True
             self.del_channel()
         else:
@@ -2300,7 +2613,10 @@ class FTPHandler(AsyncChat):
             cmd = 'STOR'
         rest_pos = self._restart_position
         self._restart_position = 0
-        if rest_pos:
+        if rest_pos or (self._stor_in_place and cmd == 'STOR' and
+                        self.fs.isfile(self.fs.realpath(file))):
+            # after OPTS STOR INPLACE ON an existing file is overwritten
+            # without being truncated first
             mode = 'r+'
         try:
             fd = self.run_as_current_user(self.fs.open, file, mode + 'b')
@@ -2841,14 +3157,21 @@ class FTPHandler(AsyncChat):
             self.respond('501 Unrecognized STRU type.')
 
     def ftp_MODE(self, line):
-        """Set data transfer mode ("S" is the only one supported (noop))."""
+        """Set data transfer mode ("S", "B" or, if zlib is available,
+        "Z").
+        """
         mode = line.upper()
-        if mode == 'S':
-            self.respond('200 Transfer mode set to: S')
-        elif mode in ('B', 'C'):
+        if mode == 'C' or (mode == 'Z' and zlib is None):
             self.respond('504 Unimplemented MODE type.')
-        else:
+        elif mode not in ('S', 'B', 'Z'):
             self.respond('501 Unrecognized MODE type.')
+        else:
+            # a data connection left open by MODE B can't be reused by
+            # another mode
+            if self.data_channel is not None and self.data_channel._idle:
+                self.data_channel.close()
+            self._current_mode = mode.lower()
+            self.respond('200 Transfer mode set to: %s' % mode)
 
     def ftp_STAT(self, path):
         """Return statistics about current ftp session. If an argument
@@ -2881,9 +3204,13 @@ class FTPHandler(AsyncChat):
                 type = 'ASCII'
             else:
                 type = 'Binary'
-            s.append("TYPE: %s; STRUcture: File; MODE: Stream" % type)
+            mode = {'s': 'Stream', 'b': 'Block',
+                    'z': 'Deflate'}[self._current_mode]
+            s.append("TYPE: %s; STRUcture: File; MODE: %s" % (type, mode))
             if self._dtp_acceptor is not None:
                 s.append('Passive data channel waiting for connection.')
+            elif self.data_channel is not None and self.data_channel._idle:
+                s.append('Data connection open, idle.')
             elif self.data_channel is not None:
                 bytes_sent = self.data_channel.tot_bytes_sent
                 bytes_recv = self.data_channel.tot_bytes_received
@@ -2947,6 +3274,8 @@ class FTPHandler(AsyncChat):
             features.add('MLST ' + facts)
         if 'REST' in self.proto_cmds:
             features.add('REST STREAM')
+        if 'MODE' in self.proto_cmds and zlib is not None:
+            features.add('MODE Z')
         features = sorted(features)
         self.push("211-Features supported:\r\n")
         self.push("".join([" %s\r\n" % x for x in features]))
@@ -2954,6 +3283,10 @@ class FTPHandler(AsyncChat):
 
     def ftp_OPTS(self, line):
         """Specify options for FTP commands as specified in RFC-2389."""
+        if line.upper().startswith('MODE '):
+            return self._opts_mode(line[5:])
+        if line.upper().startswith('STOR '):
+            return self._opts_stor(line[5:])
         try:
             if line.count(' ') > 1:
                 raise ValueError('Invalid number of arguments')
@@ -2975,6 +3308,31 @@ class FTPHandler(AsyncChat):
             f = ''.join([x + ';' for x in self._current_facts])
             self.respond('200 MLST OPTS ' + f)
 
+    def _opts_mode(self, arg):
+        """OPTS MODE Z LEVEL <0-9>: set the MODE Z compression level."""
+        words = arg.upper().split()
+        if zlib is None or 'MODE' not in self.proto_cmds or \
+                words[:1] != ['Z']:
+            self.respond('501 Unsupported command "MODE %s".' % arg)
+        elif len(words) != 3 or words[1] != 'LEVEL' or \
+                not words[2].isdigit() or int(words[2]) > 9:
+            self.respond('501 Invalid argument.')
+        else:
+            self._zlib_level = int(words[2])
+            self.respond('200 MODE Z LEVEL set to %d.' % self._zlib_level)
+
+    def _opts_stor(self, arg):
+        """OPTS STOR INPLACE ON|OFF: whether STOR truncates a file."""
+        words = arg.upper().split()
+        if 'STOR' not in self.proto_cmds:
+            self.respond('501 Unsupported command "STOR".')
+        elif len(words) != 2 or words[0] != 'INPLACE' or \
+                words[1] not in ('ON', 'OFF'):
+            self.respond('501 Invalid argument.')
+        else:
+            self._stor_in_place = words[1] == 'ON'
+            self.respond('200 STOR INPLACE set to %s.' % words[1])
+
     def ftp_NOOP(self, line):
         """Do nothing."""
         self.respond("200 I successfully done nothin'.")
@@ -3046,6 +3404,63 @@ class FTPHandler(AsyncChat):
                 self.respond('200 SITE CHMOD successful.')
                 return (path, mode)
 
+    def ftp_SITE_BLKHASH(self, path, blocksize):
+        """Return the SHA-256 of every block-size bytes of a file, one
+        per line, and that of the whole file in the last line.
+        Together with REST + STOR this lets a client send only the
+        blocks of a file that changed, then check the result.
+        On success return the file path, else None.
+        """
+        # Note: the file is read block by block as the reply goes out,
+        # so that other sessions get their turn between blocks; big
+        # blocks still hold up the IO loop for as long as one takes.
+        try:
+            blocksize = int(blocksize)
+            if blocksize < self.blkhash_min_blocksize:
+                raise ValueError
+        except (ValueError, OverflowError):
+            self.respond("501 Invalid SITE BLKHASH block size.")
+            return
+        line = self.fs.fs2ftp(path)
+        if not self.fs.isfile(self.fs.realpath(path)):
+            self.respond("550 %s is not retrievable." % line)
+            return
+        try:
+            size = self.run_as_current_user(self.fs.getsize, path)
+            fd = self.run_as_current_user(self.fs.open, path, 'rb')
+        except (EnvironmentError, FilesystemError) as err:
+            why = _strerror(err)
+            self.respond('550 %s.' % why)
+            return
+        self.push('213-SHA-256 %s %s\r\n' % (blocksize, size))
+        producer = BufferedIteratorProducer(
+            self._iter_block_hashes(fd, blocksize))
+        producer.loops = 1  # one block per write event
+        self.push_with_producer(producer)
+        self._last_response = '213 SHA-256 %s %s' % (blocksize, size)
+        return path
+
+    def _iter_block_hashes(self, fd, blocksize):
+        """Yield the SITE BLKHASH reply lines for file object `fd`."""
+        whole = hashlib.sha256()
+        blocks = 0
+        with fd:
+            while True:
+                block = fd.read(blocksize)
+                if not block and blocks:
+                    break
+                blocks += 1
+                digest = hashlib.sha256(block).hexdigest()
+                if len(block) < blocksize and blocks == 1:
+                    # the whole file is a single block
+                    yield b(' %s\r\n213 %s\r\n' % (digest, digest))
+                    return
+                whole.update(block)
+                yield b(' %s\r\n' % digest)
+                if len(block) < blocksize:
+                    break
+        yield b('213 %s\r\n' % whole.hexdigest())
+
     def ftp_SITE_HELP(self, line):
         """Return help text to the client for a given SITE command."""
         if line:
@@ -0,0 +1,1580 @@
+#!/usr/bin/env python
+
+# Copyright (C) 2007 Giampaolo Rodola' <g.rodola@gmail.com>.
+# Use of this source code is governed by MIT license that can be
+# found in the LICENSE file.
+
+"""Tests for the ftp.py client, run against a pyftpdlib server."""
+
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import io
+import json
+import mmap
+import os
+import shutil
+import socket
+import tempfile
+import time
+import zlib
+
+from pyftpdlib.test import close_client
+from pyftpdlib.test import configure_logging
+from pyftpdlib.test import HOME
+from pyftpdlib.test import mock
+from pyftpdlib.test import MProcessTestFTPd
+from pyftpdlib.test import PASSWD
+from pyftpdlib.test import remove_test_files
+from pyftpdlib.test import TIMEOUT
+from pyftpdlib.test import unittest
+from pyftpdlib.test import USER
+from pyftpdlib.test import VERBOSITY
+
+import ftp
+
+
+class ClientTestCase(unittest.TestCase):
+    """Base class: a server in a subprocess, a logged in ftp.FTP
+    client placed in a scratch directory below the server's root and
+    a local scratch directory.
+    """
+    server_class = MProcessTestFTPd
+
+    def setUp(self):
+        self.server = self.server_class()
+        self.server.start()
+        self.tempdir = tempfile.mkdtemp(dir=HOME)
+        self.remote = '/' + os.path.basename(self.tempdir)
+        self.localdir = tempfile.mkdtemp()
+        self.client = self.connect()
+        self.client.cwd(self.remote)
+
+    def tearDown(self):
+        close_client(self.client)
+        self.server.stop()
+        shutil.rmtree(self.tempdir)
+        shutil.rmtree(self.localdir)
+
+    def connect(self, server=None):
+        server = server or self.server
+        client = ftp.FTP(timeout=TIMEOUT)
+        client.connect(server.host, server.port)
+        client.login(USER, PASSWD)
+        return client
+
+    def remote_file(self, name, data):
+        """Create a file in the remote scratch directory."""
+        with open(os.path.join(self.tempdir, name), 'wb') as f:
+            f.write(data)
+
+    def read_remote(self, name):
+        with open(os.path.join(self.tempdir, name), 'rb') as f:
+            return f.read()
+
+    def local(self, name, data=None):
+        """Path of a local scratch file, created with `data` if given."""
+        path = os.path.join(self.localdir, name)
+        if data is not None:
+            with open(path, 'wb') as f:
+                f.write(data)
+        return path
+
+    def read_local(self, name):
+        with open(self.local(name), 'rb') as f:
+            return f.read()
+
+
+class TestSegmented(ClientTestCase):
+    """Test FTP.retrsegmented()."""
+
+    def test_segments(self):
+        data = os.urandom(100000)
+        self.remote_file('blob', data)
+        with mock.patch.object(ftp, 'MIN_SEGMENT', 4096):
+            stats = self.client.retrsegmented('blob', self.local('blob'),
+                                              segments=4)
+        self.assertEqual(stats.bytes, len(data))
+        self.assertGreater(stats.elapsed, 0)
+        self.assertEqual(stats[:3], '226')
+        self.assertEqual([verb for verb, t in stats.commands].count('RETR'), 4)
+        self.assertEqual(self.read_local('blob'), data)
+        # the main session is still usable
+        self.assertEqual(self.client.size('blob'), len(data))
+
+    def test_small_and_empty_files(self):
+        # below MIN_SEGMENT the file comes over one connection
+        self.remote_file('small', b'x' * 1000)
+        self.assertEqual(self.client.retrsegmented(
+            'small', self.local('small')).bytes, 1000)
+        self.assertEqual(self.read_local('small'), b'x' * 1000)
+        self.remote_file('empty', b'')
+        self.assertEqual(self.client.retrsegmented(
+            'empty', self.local('empty', b'old')).bytes, 0)
+        self.assertEqual(self.read_local('empty'), b'')
+
+
+class TestFTPPool(ClientTestCase):
+    """Test FTPPool."""
+
+    def setUp(self):
+        super(TestFTPPool, self).setUp()
+        self.pool = ftp.FTPPool(max_size=2, timeout=TIMEOUT)
+        self.key = (self.server.host, self.server.port, USER, PASSWD)
+
+    def tearDown(self):
+        self.pool.close()
+        super(TestFTPPool, self).tearDown()
+
+    def test_reuse(self):
+        with self.pool.session(*self.key) as session:
+            session.cwd(self.remote)
+        with self.pool.session(*self.key) as again:
+            self.assertIs(again, session)
+            # sessions keep the directory their last user left them in
+            self.assertEqual(again.pwd(), self.remote)
+
+    def test_max_size(self):
+        first = self.pool.acquire(*self.key)
+        second = self.pool.acquire(*self.key)
+        self.assertIsNot(first, second)
+        self.assertRaises(ftp.error_temp, self.pool.acquire, *self.key,
+                          timeout=0.01)
+        self.pool.release(first)
+        self.assertIs(self.pool.acquire(*self.key, timeout=0.01), first)
+        self.pool.release(first)
+        self.pool.release(second)
+
+    def test_broken_session(self):
+        with self.assertRaises(OSError):
+            with self.pool.session(*self.key) as session:
+                raise OSError
+        self.assertIsNone(session.sock)
+        # a 5xx reply doesn't break the session
+        with self.assertRaises(ftp.error_perm):
+            with self.pool.session(*self.key) as other:
+                other.size('nosuchfile')
+        with self.pool.session(*self.key) as again:
+            self.assertIs(again, other)
+
+    def test_dead_idle_session(self):
+        with self.pool.session(*self.key) as session:
+            pass
+        # as if the server had timed it out
+        session.sock.shutdown(socket.SHUT_RDWR)
+        with self.pool.session(*self.key) as again:
+            self.assertIsNot(again, session)
+            again.pwd()
+
+    def test_close(self):
+        with self.pool.session(*self.key) as session:
+            pass
+        self.pool.close()
+        self.assertIsNone(session.sock)
+        self.assertRaises(ftp.Error, self.pool.acquire, *self.key)
+
+
+class TestAsyncFTP(ClientTestCase):
+    """Test AsyncFTP."""
+
+    def run_async(self, coro):
+        return asyncio.run(asyncio.wait_for(coro, 10))
+
+    async def connect_async(self):
+        client = ftp.AsyncFTP(timeout=TIMEOUT)
+        await client.connect(self.server.host, self.server.port)
+        await client.login(USER, PASSWD)
+        await client.cwd(self.remote)
+        return client
+
+    def test_store_and_retrieve(self):
+        data = os.urandom(200000)
+
+        async def main():
+            client = await self.connect_async()
+            try:
+                self.assertEqual(await client.pwd(), self.remote)
+                await client.storbinary('STOR blob', io.BytesIO(data))
+                self.assertEqual(await client.size('blob'), len(data))
+                chunks = []
+                stats = await client.retrbinary('RETR blob', chunks.append)
+                self.assertEqual(b''.join(chunks), data)
+                self.assertEqual(stats.bytes, len(data))
+                lines = []
+                await client.retrlines('NLST', lines.append)
+                self.assertEqual(lines, ['blob'])
+            finally:
+                await client.quit()
+
+        self.run_async(main())
+        self.assertEqual(self.read_remote('blob'), data)
+
+    def test_concurrent_sessions(self):
+        async def fetch(name):
+            client = await self.connect_async()
+            try:
+                chunks = []
+                await client.retrbinary('RETR ' + name, chunks.append)
+                return b''.join(chunks)
+            finally:
+                await client.quit()
+
+        async def main():
+            return await asyncio.gather(*[fetch('f%d' % i)
+                                          for i in range(8)])
+
+        for i in range(8):
+            self.remote_file('f%d' % i, b'%d' % i * 5000)
+        got = self.run_async(main())
+        self.assertEqual(got, [b'%d' % i * 5000 for i in range(8)])
+
+    def test_error_reply(self):
+        async def main():
+            client = await self.connect_async()
+            try:
+                with self.assertRaises(ftp.error_perm):
+                    await client.retrbinary('RETR nosuchfile', print)
+                # the session is still in sync
+                self.assertEqual(await client.pwd(), self.remote)
+            finally:
+                await client.quit()
+
+        self.run_async(main())
+
+    def test_long_line(self):
+        # beyond maxline, and beyond the stream's 64K buffer limit
+        self.remote_file('medium', b'm' * 10000 + b'\nnext\n')
+        self.remote_file('long', b'l' * 200000 + b'\nnext\n')
+
+        async def main():
+            client = await self.connect_async()
+            try:
+                for name in ('medium', 'long'):
+                    with self.assertRaises(ftp.error_proto):
+                        await client.retrlines('RETR ' + name, lambda l: None)
+                    self.assertEqual(await client.pwd(), self.remote)
+                lines = []
+                await client.retrlines('NLST', lines.append)
+                self.assertEqual(sorted(lines), ['long', 'medium'])
+            finally:
+                await client.quit()
+
+        self.run_async(main())
+
+
+class TestRetrinto(ClientTestCase):
+    """Test FTP.retrinto()."""
+
+    def setUp(self):
+        super(TestRetrinto, self).setUp()
+        self.data = os.urandom(300000)
+        self.remote_file('blob', self.data)
+
+    def test_sinks(self):
+        # file object
+        buf = io.BytesIO()
+        stats = self.client.retrinto('RETR blob', buf)
+        self.assertEqual(buf.getvalue(), self.data)
+        self.assertEqual(stats.bytes, len(self.data))
+        # file descriptor
+        with open(self.local('blob'), 'wb') as f:
+            self.client.retrinto('RETR blob', f.fileno())
+        self.assertEqual(self.read_local('blob'), self.data)
+        # callable, getting memoryviews only valid during the call
+        chunks = []
+        self.client.retrinto('RETR blob', lambda view: chunks.append(
+            bytes(view)))
+        self.assertEqual(b''.join(chunks), self.data)
+
+    def test_growing_buffer_and_rest(self):
+        sizes = []
+
+        def sink(view):
+            sizes.append(len(view))
+            buf.write(view)
+
+        buf = io.BytesIO()
+        self.client.retrinto('RETR blob', sink, rest=1000, blocksize=512,
+                             max_blocksize=8192)
+        self.assertEqual(buf.getvalue(), self.data[1000:])
+        self.assertLessEqual(max(sizes), 8192)
+
+
+class TestStorbinary(ClientTestCase):
+    """Test FTP.storbinary() with and without sendfile()."""
+
+    def setUp(self):
+        super(TestStorbinary, self).setUp()
+        self.data = os.urandom(300000)
+
+    def test_regular_file(self):
+        path = self.local('blob', self.data)
+        with open(path, 'rb') as f:
+            with mock.patch.object(socket.socket, 'sendfile',
+                                   autospec=True,
+                                   side_effect=socket.socket.sendfile) as m:
+                stats = self.client.storbinary('STOR blob', f)
+            self.assertTrue(m.called)
+        self.assertEqual(stats.bytes, len(self.data))
+        self.assertEqual(self.read_remote('blob'), self.data)
+
+    def test_rest(self):
+        self.remote_file('blob', self.data[:1000])
+        with open(self.local('blob', self.data), 'rb') as f:
+            self.client.storbinary('STOR blob', f, rest=1000)
+        self.assertEqual(self.read_remote('blob'), self.data)
+
+    def test_other_sources(self):
+        self.client.storbinary('STOR blob', io.BytesIO(self.data))
+        self.assertEqual(self.read_remote('blob'), self.data)
+        # with a callback every block goes through Python
+        blocks = []
+        self.client.storbinary('STOR blob2', io.BytesIO(self.data),
+                               blocksize=4096, callback=blocks.append)
+        self.assertEqual(b''.join(blocks), self.data)
+        self.assertEqual(self.read_remote('blob2'), self.data)
+
+
+class TestKeepAlive(ClientTestCase):
+    """Test KeepAlive and FTP.start_keepalive()."""
+
+    def setUp(self):
+        super(TestKeepAlive, self).setUp()
+        self.scheduler = ftp.KeepAlive(interval=0.05)
+        self.noop = mock.patch.object(self.client, 'send_noop',
+                                      wraps=self.client.send_noop).start()
+        self.client.start_keepalive(scheduler=self.scheduler)
+        self.thread = self.scheduler._thread
+
+    def tearDown(self):
+        self.client.stop_keepalive()
+        self.thread.join(TIMEOUT)
+        mock.patch.stopall()
+        super(TestKeepAlive, self).tearDown()
+
+    def test_idle(self):
+        time.sleep(0.3)
+        self.assertGreater(self.noop.call_count, 1)
+        self.assertEqual(self.client.pwd(), self.remote)
+
+    def test_no_noop_during_transfer(self):
+        self.remote_file('blob', b'x' * 10000)
+        conn = self.client.transfercmd('RETR blob')
+        calls = self.noop.call_count
+        time.sleep(0.3)
+        self.assertEqual(self.noop.call_count, calls)
+        while conn.recv(4096):
+            pass
+        conn.close()
+        # the final reply is the transfer's, not a NOOP's
+        self.assertEqual(self.client.voidresp()[:3], '226')
+        time.sleep(0.3)
+        self.assertGreater(self.noop.call_count, calls)
+        self.assertEqual(self.client.pwd(), self.remote)
+
+    def test_stop(self):
+        self.client.stop_keepalive()
+        self.thread.join(TIMEOUT)
+        self.assertFalse(self.thread.is_alive())
+        calls = self.noop.call_count
+        time.sleep(0.2)
+        self.assertEqual(self.noop.call_count, calls)
+
+
+class TestPipeline(ClientTestCase):
+    """Test FTP.pipeline()."""
+
+    def test_bulk_commands(self):
+        for i in range(150):
+            self.remote_file('f%d' % i, b'x' * i)
+        with self.client.pipeline(window=16) as p:
+            sizes = [p.size('f%d' % i) for i in range(150)]
+            missing = p.size('nosuchfile')
+            p.mkd('sub')
+            renamed = p.rename('f0', 'sub/f0')
+            deleted = [p.delete('f%d' % i) for i in range(1, 150)]
+        self.assertEqual([r.value for r in sizes], list(range(150)))
+        self.assertFalse(missing.ok)
+        self.assertIsInstance(missing.error, ftp.error_perm)
+        self.assertTrue(renamed.ok)
+        self.assertTrue(all(r.ok for r in deleted))
+        self.assertEqual(os.listdir(self.tempdir), ['sub'])
+        self.assertEqual(os.listdir(os.path.join(self.tempdir, 'sub')),
+                         ['f0'])
+        # the replies were all read
+        self.assertEqual(self.client.pwd(), self.remote)
+
+    def test_multiline_reply(self):
+        with self.client.pipeline() as p:
+            feat = p.send('FEAT')
+            pwd = p.send('PWD', parse=ftp.parse257)
+        self.assertIn('MLST', feat.resp)
+        self.assertEqual(pwd.value, self.remote)
+
+
+class TestMirror(ClientTestCase):
+    """Test FTP.mirror()."""
+
+    def test_mirror(self):
+        os.makedirs(os.path.join(self.tempdir, 'a', 'b'))
+        self.remote_file('top', b'top')
+        self.remote_file('a/one', b'one' * 1000)
+        self.remote_file('a/b/two', b'')
+        result = self.client.mirror('', self.localdir, workers=3)
+        self.assertEqual(result.failed, [])
+        self.assertEqual(len(result.downloaded), 3)
+        self.assertEqual(self.read_local('top'), b'top')
+        self.assertEqual(self.read_local('a/one'), b'one' * 1000)
+        self.assertEqual(self.read_local('a/b/two'), b'')
+        # the local copies carry the remote modification times
+        self.assertEqual(int(os.path.getmtime(self.local('a/one'))),
+                         int(os.path.getmtime(
+                             os.path.join(self.tempdir, 'a', 'one'))))
+
+        # only what changed is fetched again
+        self.remote_file('a/one', b'changed')
+        result = self.client.mirror('', self.localdir, workers=3)
+        self.assertEqual(result.downloaded, [self.remote + '/a/one'])
+        self.assertEqual(sorted(result.skipped),
+                         [self.remote + '/a/b/two', self.remote + '/top'])
+        self.assertEqual(self.read_local('a/one'), b'changed')
+        self.assertFalse([name for name in os.listdir(self.localdir)
+                          if name.endswith('.part')])
+
+
+class TestMetadataCache(ClientTestCase):
+    """Test FTP.enable_cache() and MetadataCache."""
+
+    def setUp(self):
+        super(TestMetadataCache, self).setUp()
+        self.client.enable_cache(ttl=60)
+
+    def test_size(self):
+        self.remote_file('blob', b'x' * 10)
+        self.assertEqual(self.client.size('blob'), 10)
+        self.remote_file('blob', b'x' * 20)  # behind the client's back
+        self.assertEqual(self.client.size('blob'), 10)
+        self.assertEqual(self.client.size(self.remote + '/blob'), 10)
+        # writes through the session invalidate
+        self.client.storbinary('STOR blob', io.BytesIO(b'x' * 30))
+        self.assertEqual(self.client.size('blob'), 30)
+
+    def test_mlsd(self):
+        self.remote_file('one', b'')
+        names = lambda: sorted(e.name for e in self.client.mlsd())
+        self.assertEqual(names(), ['one'])
+        self.remote_file('two', b'')
+        self.assertEqual(names(), ['one'])
+        self.client.mkd('sub')
+        self.assertEqual(names(), ['one', 'sub', 'two'])
+        self.client.rename('one', 'uno')
+        self.assertEqual(names(), ['sub', 'two', 'uno'])
+        self.client.delete('two')
+        self.assertEqual(names(), ['sub', 'uno'])
+
+    def test_ttl_and_lru(self):
+        cache = ftp.MetadataCache(ttl=0.05, maxsize=2)
+        cache.put(('size', '/a'), 1)
+        cache.put(('size', '/b'), 2)
+        cache.get(('size', '/a'))
+        cache.put(('size', '/c'), 3)
+        self.assertIsNone(cache.get(('size', '/b')))
+        self.assertEqual(cache.get(('size', '/a')), 1)
+        time.sleep(0.1)
+        self.assertIsNone(cache.get(('size', '/a')))
+        cache.put(('mlsd', '/d', ()), [])
+        cache.put(('size', '/d/e/f'), 1)
+        cache.invalidate('/d/e')
+        self.assertIsNone(cache.get(('size', '/d/e/f')))
+        self.assertIsNone(cache.get(('mlsd', '/d', ())))
+
+
+class TestMLSD(ClientTestCase):
+    """Test streamed MLSD listings and MLSDEntry."""
+
+    def setUp(self):
+        super(TestMLSD, self).setUp()
+        for i in range(300):
+            self.remote_file('f%03d' % i, b'x' * i)
+        os.mkdir(os.path.join(self.tempdir, 'sub'))
+
+    def test_entries(self):
+        entries = {e.name: e for e in self.client.mlsd(
+            facts=['type', 'size', 'modify'])}
+        self.assertEqual(len(entries), 301)
+        entry = entries['f010']
+        self.assertEqual((entry.type, entry.size), ('file', 10))
+        mtime = os.path.getmtime(os.path.join(self.tempdir, 'f010'))
+        self.assertEqual(int(entry.modify), int(mtime))
+        self.assertEqual(entries['sub'].type, 'dir')
+        # entries still unpack like the (name, facts) tuples of old
+        name, facts = entry
+        self.assertEqual((name, facts['size'], facts.get('perm', '-')),
+                         ('f010', 10, '-'))
+        self.assertIn('type', facts)
+
+    def test_parse_line(self):
+        entry = ftp.parse_mlsd_line(
+            'type=file;size=3;modify=20200102030405;x.owner=me; a b\r\n')
+        self.assertEqual((entry.name, entry.size), ('a b', 3))
+        self.assertEqual(entry.modify, 1577934245)
+        self.assertEqual(entry['x.owner'], 'me')
+        self.assertRaises(KeyError, entry.__getitem__, 'unique')
+
+    def test_streamed(self):
+        # entries come out before the listing's final reply is read
+        events = []
+        voidresp = self.client.voidresp
+
+        def record():
+            events.append('226')
+            return voidresp()
+
+        with mock.patch.object(self.client, 'voidresp', side_effect=record):
+            for entry in self.client.mlsd():
+                events.append(entry.name)
+        self.assertEqual(len(events), 302)
+        self.assertEqual(events[-1], '226')
+
+    def test_abandoned_listing(self):
+        listing = self.client.mlsd()
+        next(listing)
+        listing.close()
+        self.assertEqual(self.client.pwd(), self.remote)
+        self.assertEqual(len(list(self.client.mlsd())), 301)
+
+    def test_async_listing(self):
+        async def main():
+            client = ftp.AsyncFTP(timeout=TIMEOUT)
+            await client.connect(self.server.host, self.server.port)
+            await client.login(USER, PASSWD)
+            try:
+                await client.cwd(self.remote)
+                names = [e.name async for e in client.mlsd(
+                    '', ['type', 'size'])]
+                self.assertEqual(len(names), 301)
+                events = []
+                voidresp = client.voidresp
+
+                async def record():
+                    resp = await voidresp()
+                    if resp[:3] == '226':  # not the reply to TYPE A
+                        events.append('226')
+                    return resp
+
+                client.voidresp = record
+                async for entry in client.mlsd():
+                    events.append(entry.name)
+                del client.voidresp
+                self.assertEqual(len(events), 302)
+                self.assertEqual(events[-1], '226')
+                # stopping early leaves the session in sync
+                listing = client.mlsd()
+                async for entry in listing:
+                    self.assertIsInstance(entry, ftp.MLSDEntry)
+                    break
+                await listing.aclose()
+                self.assertEqual(await client.pwd(), self.remote)
+            finally:
+                await client.quit()
+
+        asyncio.run(asyncio.wait_for(main(), 10))
+
+
+class TestDownloadResumable(ClientTestCase):
+    """Test FTP.download_resumable()."""
+
+    def setUp(self):
+        super(TestDownloadResumable, self).setUp()
+        self.data = os.urandom(300000)
+        self.remote_file('blob', self.data)
+        self.path = self.local('blob')
+        self.journal = self.path + ftp.JOURNAL_SUFFIX
+
+    def interrupt(self, after):
+        """Download until `after` bytes arrived, then fail."""
+        def retrinto(cmd, sink, **kwargs):
+            def write(data):
+                if received[0] >= after:
+                    raise KeyboardInterrupt
+                received[0] += len(data)
+                sink(data)
+            return real_retrinto(cmd, write, **kwargs)
+
+        received = [0]
+        client = self.connect()
+        client.cwd(self.remote)
+        real_retrinto = client.retrinto
+        try:
+            with mock.patch.object(client, 'retrinto', side_effect=retrinto):
+                self.assertRaises(KeyboardInterrupt,
+                                  client.download_resumable,
+                                  'blob', self.path,
+                                  checkpoint=4096)
+        finally:
+            client.close()
+
+    def test_complete(self):
+        result = self.client.download_resumable('blob', self.path)
+        self.assertEqual(result, (len(self.data), 0, False))
+        self.assertEqual(self.read_local('blob'), self.data)
+        self.assertFalse(os.path.exists(self.journal))
+
+    def test_resume(self):
+        self.interrupt(100000)
+        with open(self.journal) as f:
+            offset = json.load(f)['offset']
+        self.assertGreaterEqual(offset, 100000)
+        self.assertEqual(self.read_local('blob')[:offset],
+                         self.data[:offset])
+        progress = []
+        result = self.client.download_resumable('blob', self.path,
+                                                progress=progress.append)
+        self.assertEqual(result.resumed_from, offset)
+        self.assertFalse(result.remote_changed)
+        self.assertEqual(progress[-1], len(self.data))
+        self.assertEqual(self.read_local('blob'), self.data)
+        self.assertFalse(os.path.exists(self.journal))
+
+    def test_remote_changed(self):
+        self.interrupt(100000)
+        self.data = os.urandom(200000)
+        self.remote_file('blob', self.data)
+        result = self.client.download_resumable('blob', self.path)
+        self.assertEqual(result, (len(self.data), 0, True))
+        self.assertEqual(self.read_local('blob'), self.data)
+
+    def test_no_mdtm(self):
+        # without MDTM a download still resumes, on the size alone
+        self.interrupt(100000)
+        with mock.patch.object(self.client, 'mdtm',
+                               side_effect=ftp.error_perm('502 no MDTM')):
+            result = self.client.download_resumable('blob', self.path)
+        self.assertGreaterEqual(result.resumed_from, 100000)
+        self.assertEqual(self.read_local('blob'), self.data)
+
+    def test_stale_cached_size(self):
+        self.client.enable_cache()
+        self.assertEqual(self.client.size('blob'), len(self.data))
+        self.interrupt(100000)
+        # same mtime, other size: only SIZE shows the change
+        st = os.stat(os.path.join(self.tempdir, 'blob'))
+        self.data = os.urandom(200000)
+        self.remote_file('blob', self.data)
+        os.utime(os.path.join(self.tempdir, 'blob'),
+                 (st.st_atime, st.st_mtime))
+        result = self.client.download_resumable('blob', self.path)
+        self.assertEqual(result, (len(self.data), 0, True))
+        self.assertEqual(self.read_local('blob'), self.data)
+
+    def test_no_journal(self):
+        # local bytes without a journal to vouch for them aren't trusted
+        self.local('blob', b'y' * 1000)
+        result = self.client.download_resumable('blob', self.path)
+        self.assertEqual(result.resumed_from, 0)
+        self.assertEqual(self.read_local('blob'), self.data)
+
+
+class TestStoreResumable(ClientTestCase):
+    """Test FTP.store_resumable()."""
+
+    def setUp(self):
+        super(TestStoreResumable, self).setUp()
+        self.data = os.urandom(300000)
+        self.path = self.local('blob', self.data)
+
+    def test_new_file(self):
+        stats = self.client.store_resumable(self.path, 'blob')
+        self.assertEqual(stats.bytes, len(self.data))
+        self.assertEqual(self.read_remote('blob'), self.data)
+
+    def test_resume(self):
+        for appe in (False, True):
+            self.remote_file('blob', self.data[:123456])
+            stats = self.client.store_resumable(self.path, 'blob', appe=appe)
+            self.assertEqual(stats.bytes, len(self.data) - 123456)
+            self.assertEqual(self.read_remote('blob'), self.data)
+
+    def test_chunks(self):
+        self.remote_file('blob', self.data[:1000])
+        progress = []
+        stats = self.client.store_resumable(self.path, 'blob',
+                                            chunk_size=65536,
+                                            progress=progress.append)
+        self.assertEqual(progress, [1000 + 65536 * i for i in range(1, 5)] +
+                         [len(self.data)])
+        # one TransferStats for all five chunks
+        self.assertEqual(stats.bytes, len(self.data) - 1000)
+        self.assertEqual([verb for verb, t in stats.commands].count('STOR'), 5)
+        self.assertEqual(stats[:3], '226')
+        self.assertEqual(self.read_remote('blob'), self.data)
+
+    def test_remote_larger(self):
+        self.remote_file('blob', self.data + b'junk')
+        stats = self.client.store_resumable(self.path, 'blob')
+        self.assertEqual(stats.bytes, len(self.data))
+        self.assertEqual(self.read_remote('blob'), self.data)
+
+    def test_complete_and_empty(self):
+        self.remote_file('blob', self.data)
+        self.assertEqual(self.client.store_resumable(self.path, 'blob').bytes,
+                         0)
+        self.assertEqual(self.read_remote('blob'), self.data)
+        self.client.store_resumable(self.local('empty', b''), 'empty')
+        self.assertEqual(self.read_remote('empty'), b'')
+
+
+class TestAdaptive(ClientTestCase):
+    """Test adaptive block and socket buffer sizing."""
+
+    def test_transfers(self):
+        data = os.urandom(2 ** 21)
+        self.client.adaptive = True
+        self.client.storbinary('STOR blob', io.BytesIO(data), blocksize=8192)
+        self.assertEqual(self.read_remote('blob'), data)
+        chunks = []
+        self.client.retrbinary('RETR blob', chunks.append, blocksize=8192)
+        self.assertEqual(b''.join(chunks), data)
+        buf = io.BytesIO()
+        self.client.retrinto('RETR blob', buf, blocksize=8192)
+        self.assertEqual(buf.getvalue(), data)
+        # the PASV round trip and the rate are remembered for next time
+        self.assertIsNotNone(self.client.rtt)
+        self.assertGreater(self.client.rate, 0)
+
+    def test_tuner(self):
+        with contextlib.closing(socket.socket()) as sock:
+            before = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            tuner = ftp._Tuner(sock, socket.SO_RCVBUF, rtt=0.01,
+                               blocksize=8192, max_blocksize=2 ** 19)
+            # 100 MB/s over 10 ms: a bandwidth-delay product of 1 MB
+            tuner._resize(100 * 10 ** 6)
+            self.assertEqual(tuner.blocksize, 2 ** 19)
+            after = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            self.assertTrue(after > before or tuner.capped)
+            # a slow link doesn't shrink anything
+            tuner._resize(1000)
+            self.assertEqual(tuner.blocksize, 2 ** 19)
+
+
+class TestTransferStats(ClientTestCase):
+    """Test the TransferStats returned by transfers."""
+
+    def test_stats(self):
+        data = os.urandom(300000)
+        self.remote_file('blob', data)
+        progress = []
+        stats = self.client.retrbinary('RETR blob', lambda d: None,
+                                       progress=progress.append)
+        # it is the final reply, too
+        self.assertIsInstance(stats, str)
+        self.assertEqual(stats[:3], '226')
+        self.assertEqual(stats.bytes, len(data))
+        self.assertEqual(progress[-1], len(data))
+        verbs = [verb for verb, seconds in stats.commands]
+        self.assertEqual(verbs, ['TYPE', 'PASV', 'RETR'])
+        self.assertIsNotNone(stats.pasv)
+        self.assertLessEqual(stats.ttfb, stats.elapsed)
+        self.assertGreater(stats.average, 0)
+        self.assertGreaterEqual(stats.peak, stats.average)
+        self.assertIn('300000 bytes', stats.summary())
+
+        stats = self.client.storbinary('STOR up', io.BytesIO(data))
+        self.assertEqual(stats.bytes, len(data))
+        stats = self.client.retrlines('LIST', lambda line: None)
+        self.assertGreater(stats.bytes, 0)
+
+    def test_empty_transfer(self):
+        self.remote_file('empty', b'')
+        stats = self.client.retrbinary('RETR empty', lambda d: None)
+        self.assertEqual(stats.bytes, 0)
+        self.assertIsNone(stats.ttfb)
+        self.assertIn('ttfb -', stats.summary())
+
+    def test_every_chunk(self):
+        self.remote_file('blob', b'x' * 100000)
+        self.client.progress_interval = 0
+        progress = []
+        self.client.retrbinary('RETR blob', lambda d: None, blocksize=1024,
+                               progress=progress.append)
+        self.assertGreater(len(progress), 10)
+        self.assertEqual(progress, sorted(progress))
+        self.assertEqual(progress[-1], 100000)
+
+
+class TestBatch(ClientTestCase):
+    """Test mget(), mput() and the shell's batch mode."""
+
+    def test_mget(self):
+        os.mkdir(os.path.join(self.tempdir, 'sub'))
+        for name in ('a.txt', 'b.txt', 'c.bin', 'sub/d.txt'):
+            self.remote_file(name, name.encode())
+        result = self.client.mget(['*.txt', 'sub/*', 'nomatch*'],
+                                  local_dir=self.localdir, workers=2)
+        self.assertEqual([name for name, stats in result.done],
+                         [self.remote + '/' + name
+                          for name in ('a.txt', 'b.txt', 'sub/d.txt')])
+        self.assertEqual([name for name, error in result.failed],
+                         ['nomatch*'])
+        self.assertEqual(sorted(os.listdir(self.localdir)),
+                         ['a.txt', 'b.txt', 'd.txt'])
+        self.assertEqual(self.read_local('d.txt'), b'sub/d.txt')
+
+    def test_mput(self):
+        os.mkdir(os.path.join(self.tempdir, 'in'))
+        for name in ('a.txt', 'b.txt', 'c.bin'):
+            self.local(name, name.encode())
+        result = self.client.mput([self.local('*.txt'), self.local('x*')],
+                                  remote_dir='in', workers=2)
+        self.assertEqual(len(result.done), 2)
+        self.assertEqual(len(result.failed), 1)
+        self.assertEqual(sorted(os.listdir(os.path.join(self.tempdir, 'in'))),
+                         ['a.txt', 'b.txt'])
+        self.assertEqual(self.read_remote('in/b.txt'), b'b.txt')
+
+    def run_script(self, script, keep_going=False):
+        opts = argparse.Namespace(batch=True, keep_going=keep_going, jobs=2)
+        cwd = os.getcwd()
+        os.chdir(self.localdir)
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                return ftp.run_batch(self.client, io.StringIO(script), opts)
+        finally:
+            os.chdir(cwd)
+
+    def test_run_batch(self):
+        self.local('a.txt', b'a')
+        self.local('b.txt', b'b')
+        script = '# upload\n\nmkdir out\ncd out\nmput *.txt\nsz a.txt\n'
+        self.assertEqual(self.run_script(script), 0)
+        self.assertEqual(self.read_remote('out/a.txt'), b'a')
+        self.assertEqual(self.client.pwd(), self.remote + '/out')
+
+    def test_failed_command(self):
+        script = 'mkdir one\nbogus\nmkdir two\n'
+        self.assertEqual(self.run_script(script), 1)
+        self.assertEqual(os.listdir(self.tempdir), ['one'])
+        self.assertEqual(self.run_script('mget nomatch\n' + script,
+                                         keep_going=True), 1)
+        self.assertEqual(sorted(os.listdir(self.tempdir)), ['one', 'two'])
+        # exit ends the script with the status so far
+        self.assertEqual(self.run_script('exit\nbogus\n'), 0)
+
+
+class TestTransferQueue(ClientTestCase):
+    """Test TransferQueue."""
+
+    def test_get_put(self):
+        self.remote_file('down', b'd' * 5000)
+        self.local('up', b'u' * 3000)
+        with ftp.TransferQueue(self.client, workers=2) as queue:
+            down = queue.get('down', self.local('down'))
+            up = queue.put(self.local('up'), 'up')
+            self.assertEqual(down.result(TIMEOUT).bytes, 5000)
+            self.assertEqual(up.result(TIMEOUT).bytes, 3000)
+        self.assertEqual(self.read_local('down'), b'd' * 5000)
+        self.assertFalse(os.path.exists(self.local('down.part')))
+        self.assertEqual(self.read_remote('up'), b'u' * 3000)
+
+    def test_priority(self):
+        order = []
+        queue = ftp.TransferQueue(self.client, workers=1)
+        try:
+            # hold the worker back until every job is queued
+            with queue._cond:
+                for name, priority in (('a', 5), ('b', 1), ('c', 5), ('d', 0)):
+                    self.remote_file(name, name.encode())
+                    queue.get(name, self.local(name), priority=priority,
+                              progress=lambda n, name=name: order.append(name))
+        finally:
+            queue.close(wait=True)
+        self.assertEqual(order, ['d', 'b', 'a', 'c'])
+
+    def test_resume(self):
+        data = os.urandom(20000)
+        self.remote_file('down', data)
+        self.local('down.part', data[:7000])
+        self.local('up', data)
+        self.remote_file('up', data[:9000])
+        with ftp.TransferQueue(self.client, workers=2) as queue:
+            down = queue.get('down', self.local('down'))
+            up = queue.put(self.local('up'), 'up')
+            self.assertEqual(down.result(TIMEOUT).bytes, 13000)
+            self.assertEqual(up.result(TIMEOUT).bytes, 11000)
+        self.assertEqual(self.read_local('down'), data)
+        self.assertEqual(self.read_remote('up'), data)
+
+    def test_permanent_error(self):
+        calls = []
+        download = ftp._download
+
+        def counted(*args, **kwargs):
+            calls.append(args[1])
+            return download(*args, **kwargs)
+
+        with mock.patch.object(ftp, '_download', counted):
+            with ftp.TransferQueue(self.client, workers=1,
+                                   backoff=0.01) as queue:
+                future = queue.get('missing', self.local('missing'))
+                self.assertRaises(ftp.error_perm, future.result, TIMEOUT)
+        self.assertEqual(len(calls), 1)
+
+    def test_transient_error(self):
+        self.remote_file('blob', b'x' * 1000)
+        failures = [1]
+        calls = []
+        download = ftp._download
+
+        def flaky(*args, **kwargs):
+            calls.append(args[1])
+            if failures[0]:
+                failures[0] -= 1
+                raise OSError('connection reset')
+            return download(*args, **kwargs)
+
+        with mock.patch.object(ftp, '_download', flaky):
+            with ftp.TransferQueue(self.client, workers=1,
+                                   backoff=0.01) as queue:
+                future = queue.get('blob', self.local('blob'))
+                self.assertEqual(future.result(TIMEOUT).bytes, 1000)
+            self.assertEqual(len(calls), 2)
+            # give up after the first attempt and `retries` more
+            failures[0] = 10
+            with ftp.TransferQueue(self.client, workers=1, retries=1,
+                                   backoff=0.01) as queue:
+                future = queue.get('blob', self.local('other'))
+                self.assertRaises(OSError, future.result, TIMEOUT)
+        self.assertEqual(len(calls), 4)
+        self.assertEqual(self.read_local('blob'), b'x' * 1000)
+
+
+class TestModeZ(ClientTestCase):
+    """Test transfers in MODE Z."""
+
+    def setUp(self):
+        super(TestModeZ, self).setUp()
+        self.assertTrue(self.client.set_mode('Z', level=9))
+        self.data = b''.join(b'line %d\r\n' % i for i in range(20000))
+
+    def test_binary(self):
+        self.remote_file('down', self.data)
+        chunks = []
+        stats = self.client.retrbinary('RETR down', chunks.append)
+        self.assertEqual(b''.join(chunks), self.data)
+        self.assertEqual(stats.bytes, len(self.data))
+        with open(self.local('up', self.data), 'rb') as f:
+            self.client.storbinary('STOR up', f)
+        self.assertEqual(self.read_remote('up'), self.data)
+        # the data in between compresses, the file content is unchanged
+        self.assertTrue(self.client.set_mode('S'))
+        chunks = []
+        self.client.retrbinary('RETR up', chunks.append)
+        self.assertEqual(b''.join(chunks), self.data)
+
+    def test_ascii(self):
+        text = self.data.replace(b'\r\n', b'\n')
+        self.remote_file('down', text)
+        lines = []
+        self.client.retrlines('RETR down', lines.append)
+        self.assertEqual(len(lines), 20000)
+        self.assertEqual(lines[-1], 'line 19999')
+        with open(self.local('up', text), 'rb') as f:
+            self.client.storlines('STOR up', f)
+        self.assertEqual(self.read_remote('up').replace(b'\r\n', b'\n'),
+                         text)
+
+    def test_rest_and_empty(self):
+        self.remote_file('down', self.data)
+        chunks = []
+        self.client.retrbinary('RETR down', chunks.append, rest=1000)
+        self.assertEqual(b''.join(chunks), self.data[1000:])
+        self.remote_file('empty', b'')
+        chunks = []
+        self.client.retrbinary('RETR empty', chunks.append)
+        self.assertEqual(chunks, [])
+
+    def test_unsupported(self):
+        self.assertTrue(self.client.set_mode('S'))
+        with mock.patch.object(self.client, 'feat', return_value=set()):
+            self.assertFalse(self.client.set_mode('Z'))
+        self.assertEqual(self.client.mode, 'S')
+
+
+class TestModeB(ClientTestCase):
+    """Test transfers in MODE B over one persistent data connection."""
+
+    def setUp(self):
+        super(TestModeB, self).setUp()
+        self.assertTrue(self.client.set_mode('B'))
+
+    def retr(self, name):
+        chunks = []
+        self.client.retrbinary('RETR ' + name, chunks.append)
+        return b''.join(chunks)
+
+    def test_reuse(self):
+        data = os.urandom(70000)  # more than one 64K block
+        self.remote_file('blob', data)
+        with mock.patch.object(self.client, 'makepasv',
+                               wraps=self.client.makepasv) as makepasv:
+            self.assertEqual(self.retr('blob'), data)
+            sock = self.client._block_sock
+            self.assertIsNotNone(sock)
+            with open(self.local('up', data[:5000]), 'rb') as f:
+                self.client.storbinary('STOR up', f)
+            self.remote_file('empty', b'')
+            self.assertEqual(self.retr('empty'), b'')
+            self.assertEqual(self.retr('up'), data[:5000])
+            self.assertEqual(self.retr('blob'), data)
+        self.assertEqual(makepasv.call_count, 1)
+        self.assertIs(self.client._block_sock, sock)
+        self.assertEqual(self.read_remote('up'), data[:5000])
+
+    def test_error_keeps_connection(self):
+        self.remote_file('blob', b'x' * 100)
+        self.assertEqual(self.retr('blob'), b'x' * 100)
+        sock = self.client._block_sock
+        self.assertRaises(ftp.error_perm, self.retr, 'missing')
+        self.assertEqual(self.retr('blob'), b'x' * 100)
+        self.assertIs(self.client._block_sock, sock)
+
+    def test_reconnect(self):
+        self.remote_file('blob', b'x' * 100)
+        self.assertEqual(self.retr('blob'), b'x' * 100)
+        # a connection closed in between is replaced by a new one
+        self.client._block_sock.close()
+        self.assertEqual(self.retr('blob'), b'x' * 100)
+        self.assertIsNotNone(self.client._block_sock)
+        self.assertTrue(self.client.set_mode('S'))
+        self.assertIsNone(self.client._block_sock)
+        self.assertEqual(self.retr('blob'), b'x' * 100)
+
+
+class TestPrefetch(ClientTestCase):
+    """Test prefetched passive data connections and EPSV ALL."""
+
+    def setUp(self):
+        super(TestPrefetch, self).setUp()
+        self.client.prefetch = True
+        self.data = os.urandom(30000)
+        self.remote_file('blob', self.data)
+
+    def retr(self, name='blob'):
+        chunks = []
+        self.client.retrbinary('RETR ' + name, chunks.append)
+        return b''.join(chunks)
+
+    def test_successive_transfers(self):
+        with mock.patch.object(self.client, 'makepasv',
+                               wraps=self.client.makepasv) as makepasv:
+            for i in range(4):
+                self.assertEqual(self.retr(), self.data)
+                # commands in between read the pending PASV reply first
+                self.assertEqual(self.client.size('blob'), len(self.data))
+        self.assertEqual(makepasv.call_count, 1)
+        self.assertIsNotNone(self.client._prefetched)
+
+    def test_error_keeps_connection(self):
+        self.assertEqual(self.retr(), self.data)
+        self.client._collect_prefetch()
+        sock = self.client._prefetched
+        self.assertRaises(ftp.error_perm, self.retr, 'missing')
+        self.assertIs(self.client._prefetched, sock)
+        self.assertEqual(self.retr(), self.data)
+
+    def test_preliminary_2xx_reply(self):
+        self.assertEqual(self.retr(), self.data)
+        sendcmd = self.client.sendcmd
+
+        def fake(cmd):
+            if cmd.startswith('RETR'):
+                # the real 1xx reply is left for getresp() to read
+                self.client.putline(cmd)
+                return '200 fake'
+            return sendcmd(cmd)
+
+        with mock.patch.object(self.client, 'sendcmd', fake):
+            self.assertEqual(self.retr(), self.data)
+        self.assertEqual(self.client.size('blob'), len(self.data))
+
+    def test_oserror_closes_connection(self):
+        self.assertEqual(self.retr(), self.data)
+        self.client._collect_prefetch()
+        sock = self.client._prefetched
+        sendcmd = self.client.sendcmd
+
+        def fail(cmd):
+            if cmd.startswith('RETR'):
+                raise OSError('connection reset')
+            return sendcmd(cmd)
+
+        with mock.patch.object(self.client, 'sendcmd', fail):
+            self.assertRaises(OSError, self.retr)
+        self.assertEqual(sock.fileno(), -1)
+        self.assertIsNone(self.client._prefetched)
+        self.assertEqual(self.retr(), self.data)
+
+    def test_epsv_all(self):
+        self.client.use_epsv_all()
+        self.assertEqual(self.client._pasv_cmd(), 'EPSV')
+        for i in range(2):
+            self.assertEqual(self.retr(), self.data)
+
+
+class TestRetrfile(ClientTestCase):
+    """Test FTP.retrfile()."""
+
+    def setUp(self):
+        super(TestRetrfile, self).setUp()
+        self.data = os.urandom(300000)
+        self.remote_file('blob', self.data)
+
+    def test_known_size(self):
+        with mock.patch.object(ftp._MappedFile, 'create',
+                               wraps=ftp._MappedFile.create) as create:
+            stats = self.client.retrfile('RETR blob', self.local('blob'),
+                                         len(self.data), flush_every=65536)
+        self.assertEqual(create.call_args[0][3:], (65536,))
+        self.assertEqual(stats.bytes, len(self.data))
+        self.assertEqual(self.read_local('blob'), self.data)
+
+    def test_flush(self):
+        # dirty pages are flushed every MMAP_FLUSH bytes unless disabled
+        for flush_every in (ftp.MMAP_FLUSH, None):
+            with mock.patch.object(ftp._MappedFile, 'create',
+                                   wraps=ftp._MappedFile.create) as create:
+                kwargs = {} if flush_every else {'flush_every': None}
+                self.client.retrfile('RETR blob', self.local('blob'),
+                                     len(self.data), **kwargs)
+            self.assertEqual(create.call_args[0][3:], (flush_every,))
+            self.assertEqual(self.read_local('blob'), self.data)
+        # the mapping is msync'ed as the data arrives
+        page = mmap.PAGESIZE
+        fd = os.open(self.local('mapped', b''), os.O_RDWR)
+        sender, receiver = socket.socketpair()
+        try:
+            with ftp._MappedFile.create(fd, 0, 4 * page, page) as mapped:
+                sender.sendall(b'm' * 4 * page)
+                synced = []
+                while mapped.left:
+                    mapped.recv_from(receiver, page)
+                    synced.append(mapped._synced)
+            self.assertEqual(synced[-1], 4 * page)
+        finally:
+            sender.close()
+            receiver.close()
+            os.close(fd)
+        self.assertEqual(self.read_local('mapped'), b'm' * 4 * page)
+
+    def test_announced_size(self):
+        # pyftpdlib announces no size: pretend the 150 reply had one
+        self.local('blob', b'x' * 500000)
+        ntransfercmd = self.client.ntransfercmd
+
+        def announce(cmd, rest=None):
+            return ntransfercmd(cmd, rest)[0], len(self.data)
+
+        with mock.patch.object(self.client, 'ntransfercmd', announce):
+            with mock.patch.object(ftp._MappedFile, 'create',
+                                   wraps=ftp._MappedFile.create) as create:
+                self.client.retrfile('RETR blob', self.local('blob'))
+        self.assertTrue(create.called)
+        self.assertEqual(self.read_local('blob'), self.data)
+
+    def test_unknown_size(self):
+        with mock.patch.object(ftp._MappedFile, 'create') as create:
+            stats = self.client.retrfile('RETR blob', self.local('blob'),
+                                         blocksize=4096)
+        self.assertFalse(create.called)
+        self.assertEqual(stats.bytes, len(self.data))
+        self.assertEqual(self.read_local('blob'), self.data)
+
+    def test_wrong_size(self):
+        # more data than expected is appended, less leaves the file short
+        self.client.retrfile('RETR blob', self.local('short'), 1000)
+        self.assertEqual(self.read_local('short'), self.data)
+        self.client.retrfile('RETR blob', self.local('long'),
+                             len(self.data) + 1000)
+        self.assertEqual(self.read_local('long'), self.data)
+
+    def test_rest(self):
+        self.local('blob', self.data[:1000] + b'junk' * 1000)
+        stats = self.client.retrfile('RETR blob', self.local('blob'),
+                                     len(self.data), rest=1000)
+        self.assertEqual(stats.bytes, len(self.data) - 1000)
+        self.assertEqual(self.read_local('blob'), self.data)
+        self.local('again', self.data[:1000])
+        self.client.retrfile('RETR blob', self.local('again'), rest=1000)
+        self.assertEqual(self.read_local('again'), self.data)
+
+    def test_empty(self):
+        self.remote_file('empty', b'')
+        stats = self.client.retrfile('RETR empty', self.local('empty', b'old'))
+        self.assertEqual(stats.bytes, 0)
+        self.assertEqual(self.read_local('empty'), b'')
+
+
+class TestDigest(ClientTestCase):
+    """Test hashing transfers with `digest`."""
+
+    def setUp(self):
+        super(TestDigest, self).setUp()
+        self.data = os.urandom(200000)
+        self.remote_file('blob', self.data)
+
+    def expected(self, name, data):
+        if name == 'crc32':
+            return '%08x' % zlib.crc32(data)
+        return hashlib.new(name, data).hexdigest()
+
+    def test_downloads(self):
+        for name in ('sha256', 'md5', 'crc32'):
+            stats = self.client.retrbinary('RETR blob', lambda data: None,
+                                           digest=name)
+            self.assertEqual(stats.digest, self.expected(name, self.data))
+            stats = self.client.retrinto('RETR blob', io.BytesIO(),
+                                         digest=name)
+            self.assertEqual(stats.digest, self.expected(name, self.data))
+            stats = self.client.retrfile('RETR blob', self.local('blob'),
+                                         len(self.data), digest=name)
+            self.assertEqual(stats.digest, self.expected(name, self.data))
+        # only what was transferred is hashed
+        stats = self.client.retrbinary('RETR blob', lambda data: None,
+                                       rest=1000, digest='sha256')
+        self.assertEqual(stats.digest, self.expected('sha256',
+                                                     self.data[1000:]))
+        stats = self.client.retrfile('RETR blob', self.local('blob'),
+                                     len(self.data), rest=1000,
+                                     digest='sha256')
+        self.assertEqual(stats.digest, self.expected('sha256',
+                                                     self.data[1000:]))
+        self.assertIsNone(self.client.retrbinary('RETR blob',
+                                                 lambda data: None).digest)
+
+    def test_uploads(self):
+        for name in ('sha256', 'md5', 'crc32'):
+            # sendfile(), a buffer and a per-block callback
+            with open(self.local('up', self.data), 'rb') as f:
+                stats = self.client.storbinary('STOR up', f, digest=name)
+            self.assertEqual(stats.digest, self.expected(name, self.data))
+            stats = self.client.storbinary('STOR up', io.BytesIO(self.data),
+                                           digest=name)
+            self.assertEqual(stats.digest, self.expected(name, self.data))
+            stats = self.client.storbinary('STOR up', io.BytesIO(self.data),
+                                           callback=lambda buf: None,
+                                           digest=name)
+            self.assertEqual(stats.digest, self.expected(name, self.data))
+        with open(self.local('up'), 'rb') as f:
+            stats = self.client.storbinary('STOR up', f, rest=1000,
+                                           digest='md5')
+        self.assertEqual(stats.digest, self.expected('md5', self.data[1000:]))
+        self.assertEqual(self.read_remote('up'), self.data)
+
+
+class TestAsciiBlocks(ClientTestCase):
+    """Test retrlines() and storlines() moving ASCII data in blocks."""
+
+    lines = ['first', '', 'x' * 300, 'caf\xe9', 'last']
+
+    def test_retrlines(self):
+        # the server sends CR LF, so small blocks split line endings
+        self.remote_file('text', '\n'.join(self.lines).encode('latin-1'))
+        self.client.encoding = 'latin-1'
+        for blocksize in (1, 2, 3, 7, 8192):
+            got = []
+            self.client.retrlines('RETR text', got.append,
+                                  blocksize=blocksize)
+            self.assertEqual(got, self.lines)
+            batches = []
+            self.client.retrlines('RETR text', batches.append, batch=True,
+                                  blocksize=blocksize)
+            self.assertTrue(all(isinstance(b, list) for b in batches))
+            self.assertEqual(sum(batches, []), self.lines)
+
+    def test_retrlines_maxline(self):
+        self.remote_file('text', b'y' * 100 + b'\n')
+        self.client.maxline = 50
+        self.assertRaises(ftp.Error, self.client.retrlines, 'RETR text',
+                          lambda line: None, blocksize=16)
+        # the session is unusable after the error
+        self.client.close()
+        self.client = self.connect()
+
+    def test_line_splitter(self):
+        splitter = ftp._LineSplitter('ascii')
+        self.assertEqual(splitter.feed(b'a\r'), [])
+        self.assertEqual(splitter.feed(b'\nb\rc\n'), ['a', 'b', 'c'])
+        self.assertEqual(splitter.feed(b'd\r'), [])
+        self.assertEqual(splitter.feed(b'e'), ['d'])
+        self.assertEqual(splitter.close(), ['e'])
+        self.assertEqual(splitter.close(), [])
+
+    def test_storlines(self):
+        text = b'one\r\ntwo\nthree\r\n\r\nfour'
+        expected = b'one\ntwo\nthree\n\nfour\n'
+        for blocksize in (1, 2, 3, 5, 8192):
+            self.client.storlines('STOR text', io.BytesIO(text),
+                                  blocksize=blocksize)
+            self.assertEqual(self.read_remote('text'), expected)
+        blocks = []
+        self.client.storlines('STOR text', io.BytesIO(text), blocks.append,
+                              batch=True, blocksize=4)
+        self.assertEqual(b''.join(blocks), expected.replace(b'\n', b'\r\n'))
+        lines = []
+        self.client.storlines('STOR text', io.BytesIO(text), lines.append)
+        self.assertEqual(lines, [b'one\r\n', b'two\r\n', b'three\r\n',
+                                 b'\r\n', b'four\r\n'])
+        self.assertEqual(self.read_remote('text'), expected)
+
+
+class TestFXP(ClientTestCase):
+    """Test server to server copies between two servers."""
+
+    def setUp(self):
+        super(TestFXP, self).setUp()
+        self.server2 = self.server_class()
+        self.server2.start()
+        self.dstdir = tempfile.mkdtemp(dir=HOME)
+        self.dst = self.connect(self.server2)
+        self.dst.cwd('/' + os.path.basename(self.dstdir))
+
+    def tearDown(self):
+        close_client(self.dst)
+        # stop() wants no server process left: end this one without it
+        # and let the first server's stop() check for both
+        self.server2.server.close_all()
+        self.server2.terminate()
+        self.server2.join()
+        shutil.rmtree(self.dstdir)
+        super(TestFXP, self).tearDown()
+
+    def read_dst(self, name):
+        with open(os.path.join(self.dstdir, name), 'rb') as f:
+            return f.read()
+
+    def test_copy(self):
+        data = os.urandom(100000)
+        self.remote_file('blob', data)
+        stats = ftp.fxp_copy(self.client, self.dst, 'blob', 'copy')
+        self.assertEqual(stats.bytes, len(data))
+        self.assertEqual(self.read_dst('copy'), data)
+        # both sessions are usable afterwards
+        self.assertEqual(self.dst.size('copy'), len(data))
+        self.assertEqual(self.client.size('blob'), len(data))
+
+    def test_missing(self):
+        self.assertRaises(ftp.error_perm, ftp.fxp_copy, self.client,
+                          self.dst, 'missing')
+        self.assertEqual(os.listdir(self.dstdir), [])
+        self.assertEqual(self.dst.pwd(), '/' + os.path.basename(self.dstdir))
+
+    def test_stream_mode_only(self):
+        self.assertTrue(self.dst.set_mode('Z'))
+        self.remote_file('blob', b'x')
+        self.assertRaises(ftp.Error, ftp.fxp_copy, self.client, self.dst,
+                          'blob')
+
+    def test_batch(self):
+        for name in ('a.txt', 'b.txt', 'c.txt', 'd.bin'):
+            self.remote_file(name, name.encode() * 1000)
+        os.mkdir(os.path.join(self.dstdir, 'in'))
+        result = ftp.fxp_batch(self.client, self.dst, ['*.txt', 'none*'],
+                               'in', workers=2)
+        self.assertEqual(sorted(name for name, stats in result.done),
+                         [self.remote + '/' + name
+                          for name in ('a.txt', 'b.txt', 'c.txt')])
+        self.assertEqual([name for name, error in result.failed], ['none*'])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.dstdir, 'in'))),
+                         ['a.txt', 'b.txt', 'c.txt'])
+        self.assertEqual(self.read_dst('in/b.txt'), b'b.txt' * 1000)
+
+
+class TestWalk(ClientTestCase):
+    """Test FTP.walk()."""
+
+    def setUp(self):
+        super(TestWalk, self).setUp()
+        for path in ('d1/d3', 'd2', 'd2/skip'):
+            os.makedirs(os.path.join(self.tempdir, path))
+        for path in ('a.txt', 'd1/b.txt', 'd1/d3/c.txt', 'd2/e.bin',
+                     'd2/skip/f.txt'):
+            self.remote_file(path, path.encode())
+
+    def tree(self, *args, **kwargs):
+        return [(path[len(self.remote):] or '/',
+                 sorted(d.name for d in dirs), sorted(f.name for f in files))
+                for path, dirs, files in self.client.walk(*args, **kwargs)]
+
+    def test_breadth_first(self):
+        expected = [('/', ['d1', 'd2'], ['a.txt']),
+                    ('/d1', ['d3'], ['b.txt']),
+                    ('/d2', ['skip'], ['e.bin']),
+                    ('/d1/d3', [], ['c.txt']),
+                    ('/d2/skip', [], ['f.txt'])]
+        got = self.tree(workers=1)
+        self.assertEqual(got[0], expected[0])
+        self.assertEqual(sorted(got[1:3]), expected[1:3])
+        self.assertEqual(sorted(got[3:]), expected[3:])
+        self.assertEqual(sorted(self.tree(workers=4)), sorted(expected))
+        # sizes come with the listing
+        path, dirs, files = next(self.client.walk('d1'))
+        self.assertEqual(files[0].size, len(b'd1/b.txt'))
+
+    def test_top(self):
+        # the top directory is made absolute and canonical
+        for top in ('', '.', './', self.remote + '/d1/..'):
+            self.assertEqual(next(self.client.walk(top))[0], self.remote)
+        self.client.cwd('d1')
+        self.assertEqual([path for path, dirs, files in self.client.walk()],
+                         [self.remote + '/d1', self.remote + '/d1/d3'])
+
+    def test_prune(self):
+        got = []
+        for path, dirs, files in self.client.walk(workers=2):
+            got.append(path)
+            dirs[:] = [d for d in dirs if d.name != 'd2']
+        self.assertEqual(sorted(got), [self.remote + p
+                                       for p in ('', '/d1', '/d1/d3')])
+
+    def test_maxdepth_and_filter(self):
+        self.assertEqual([path for path, dirs, files in
+                          self.client.walk(maxdepth=0)], [self.remote])
+        self.assertEqual(len(self.tree(maxdepth=1)), 3)
+
+        def keep(dirpath, entry):
+            return entry.name != 'skip' and not entry.name.endswith('.bin')
+
+        got = dict((path, files) for path, dirs, files in
+                   self.tree(filter=keep))
+        self.assertNotIn('/d2/skip', got)
+        self.assertEqual(got['/d2'], [])
+
+    def test_onerror(self):
+        errors = []
+        self.assertEqual(list(self.client.walk(
+            'missing', onerror=lambda path, e: errors.append((path, e)))), [])
+        self.assertEqual(errors[0][0], self.remote + '/missing')
+        self.assertIsInstance(errors[0][1], ftp.error_perm)
+
+    def test_small_shared_pool(self):
+        # more workers than the pool has sessions to spare
+        expected = sorted(self.tree(workers=1))
+        with ftp.FTPPool(max_size=2, timeout=TIMEOUT) as pool:
+            self.assertEqual(sorted(self.tree(workers=4, pool=pool)),
+                             expected)
+            key = (self.server.host, self.server.port, USER, PASSWD)
+            with pool.session(*key):
+                self.assertEqual(sorted(self.tree(workers=4, pool=pool)),
+                                 expected)
+                # the walk gave its session back
+                with pool.session(*key, timeout=0):
+                    pass
+
+    def test_early_exit(self):
+        # leaving the loop early releases the sessions of the walk
+        for path, dirs, files in self.client.walk(workers=2):
+            break
+        self.assertEqual(path, self.remote)
+
+
+class TestStoreDelta(ClientTestCase):
+    """Test FTP.store_delta() and FTP.block_hashes()."""
+
+    blocksize = 4096
+
+    def setUp(self):
+        super(TestStoreDelta, self).setUp()
+        self.data = os.urandom(10 * self.blocksize + 100)
+
+    def store(self, data, **kwargs):
+        result = self.client.store_delta(self.local('file', data), 'file',
+                                         self.blocksize, **kwargs)
+        self.assertEqual(self.read_remote('file'), data)
+        return result
+
+    def test_block_hashes(self):
+        self.remote_file('file', self.data)
+        self.local('file', self.data)
+        size, blocks, whole = self.client.block_hashes('file', self.blocksize)
+        self.assertEqual(size, len(self.data))
+        self.assertEqual((blocks, whole),
+                         ftp._block_hashes(self.local('file'), self.blocksize))
+        self.assertEqual(len(blocks), 11)
+        self.assertEqual(whole, hashlib.sha256(self.data).hexdigest())
+        self.assertRaises(ftp.error_perm, self.client.block_hashes,
+                          'missing', self.blocksize)
+
+    def test_new_and_unchanged(self):
+        result = self.store(self.data)
+        self.assertEqual(result, (len(self.data), len(self.data),
+                                  [(0, len(self.data))]))
+        self.assertEqual(self.store(self.data), (len(self.data), 0, []))
+
+    def test_changed_blocks(self):
+        self.remote_file('file', self.data)
+        data = bytearray(self.data)
+        data[10] ^= 0xff
+        data[3 * self.blocksize] ^= 0xff
+        data[4 * self.blocksize] ^= 0xff
+        sent = []
+        result = self.store(bytes(data), progress=sent.append)
+        self.assertEqual(result.ranges, [(0, self.blocksize),
+                                         (3 * self.blocksize,
+                                          2 * self.blocksize)])
+        self.assertEqual(result.sent, 3 * self.blocksize)
+        self.assertEqual(sent[-1], result.sent)
+
+    def test_grown_and_shrunk(self):
+        self.remote_file('file', self.data[:2 * self.blocksize + 10])
+        result = self.store(self.data)
+        self.assertEqual(result.ranges, [(2 * self.blocksize,
+                                          len(self.data) - 2 * self.blocksize)])
+        # a shorter file can't be written in place: it is sent in full
+        result = self.store(self.data[:100])
+        self.assertEqual(result.ranges, [(0, 100)])
+
+    def test_stor_truncates_afterwards(self):
+        self.remote_file('file', self.data)
+        data = b'x' + self.data[1:]
+        self.store(data)
+        self.client.storbinary('STOR file', io.BytesIO(b'short'))
+        self.assertEqual(self.read_remote('file'), b'short')
+
+    def test_no_in_place(self):
+        self.remote_file('file', self.data)
+        voidcmd = self.client.voidcmd
+
+        def refuse(cmd):
+            if cmd.startswith('OPTS STOR'):
+                raise ftp.error_perm('501 Invalid argument.')
+            return voidcmd(cmd)
+
+        with mock.patch.object(self.client, 'voidcmd', refuse):
+            result = self.store(b'x' + self.data[1:])
+        self.assertEqual(result.ranges, [(0, len(self.data))])
+
+    def test_failed_verify(self):
+        # a delta that did not land makes the file go in full
+        self.remote_file('file', self.data)
+        storrange = self.client._storrange
+        calls = []
+
+        def lose_first(remote, fp, offset, count):
+            calls.append((offset, count))
+            if len(calls) > 1:
+                return storrange(remote, fp, offset, count)
+
+        with mock.patch.object(self.client, '_storrange', lose_first):
+            result = self.store(b'x' + self.data[1:])
+        self.assertEqual(calls, [(0, self.blocksize), (0, len(self.data))])
+        self.assertEqual(result.ranges, [(0, len(self.data))])
+        self.assertEqual(result.sent, self.blocksize + len(self.data))
+
+
+configure_logging()
+remove_test_files()
+
+
+if __name__ == '__main__':
+    unittest.main(verbosity=VERBOSITY)
@@ -7,6 +7,7 @@
 import contextlib
 import errno
 import ftplib
+import hashlib
 import logging
 import os
 import random
@@ -15,9 +16,11 @@ import select
 import shutil
 import socket
 import stat
+import struct
 import sys
 import tempfile
 import time
+import zlib
 
 from pyftpdlib._compat import b
 from pyftpdlib._compat import PY3
@@ -281,7 +284,8 @@ class TestFtpDummyCmds(unittest.TestCase):
     def test_mode(self):
         self.client.sendcmd('mode s')
         self.client.sendcmd('mode S')
-        self.assertRaises(ftplib.error_perm, self.client.sendcmd, 'mode b')
+        self.client.sendcmd('mode b')
+        self.client.sendcmd('mode B')
         self.assertRaises(ftplib.error_perm, self.client.sendcmd, 'mode c')
         self.assertRaises(ftplib.error_perm, self.client.sendcmd, 'mode ?!?')
 
@@ -374,7 +378,8 @@ class TestFtpCmdsSemantic(unittest.TestCase):
     arg_cmds = \
         ['allo', 'appe', 'dele', 'eprt', 'mdtm', 'mfmt', 'mode', 'mkd', 'opts',
          'port', 'rest', 'retr', 'rmd', 'rnfr', 'rnto', 'site', 'size', 'stor',
-         'stru', 'type', 'user', 'xmkd', 'xrmd', 'site chmod']
+         'stru', 'type', 'user', 'xmkd', 'xrmd', 'site chmod',
+         'site blkhash']
 
     def setUp(self):
         self.server = self.server_class()
@@ -640,6 +645,33 @@ class TestFtpFsOperations(unittest.TestCase):
                 self.client.sendcmd('site chmod 555 ' + self.tempfile)
                 self.assertEqual(getmode(), '0555')
 
+    def test_site_blkhash(self):
+        data = os.urandom(10000)
+        with open(self.tempfile, 'wb') as f:
+            f.write(data)
+        resp = self.client.sendcmd('site blkhash 4096 ' + self.tempfile)
+        lines = resp.splitlines()
+        self.assertEqual(lines[0], '213-SHA-256 4096 10000')
+        blocks = [data[i:i + 4096] for i in range(0, len(data), 4096)]
+        self.assertEqual([x.strip() for x in lines[1:-1]],
+                         [hashlib.sha256(x).hexdigest() for x in blocks])
+        self.assertEqual(lines[-1],
+                         '213 ' + hashlib.sha256(data).hexdigest())
+        # a block size covering the whole file yields a single block
+        resp = self.client.sendcmd('site blkhash 65536 ' + self.tempfile)
+        self.assertEqual(len(resp.splitlines()), 3)
+        # bad args
+        self.assertRaises(ftplib.error_perm, self.client.sendcmd,
+                          'site blkhash 4096')
+        self.assertRaises(ftplib.error_perm, self.client.sendcmd,
+                          'site blkhash foo ' + self.tempfile)
+        self.assertRaises(ftplib.error_perm, self.client.sendcmd,
+                          'site blkhash 512 ' + self.tempfile)
+        self.assertRaises(ftplib.error_perm, self.client.sendcmd,
+                          'site blkhash 4096 ' + self.tempdir)
+        self.assertRaises(ftplib.error_perm, self.client.sendcmd,
+                          'site blkhash 4096 ' + TESTFN + 'x')
+
 
 class TestFtpStoreData(unittest.TestCase):
     """Test STOR, STOU, APPE, REST, TYPE."""
@@ -927,6 +959,37 @@ class TestFtpStoreData(unittest.TestCase):
         self.dummy_sendfile.seek(0)
         self.client.storbinary('stor ' + TESTFN, self.dummy_sendfile)
 
+    def test_stor_in_place(self):
+        # After OPTS STOR INPLACE ON, STOR overwrites an existing file
+        # without truncating it; REST 0 alone still truncates.
+        self.dummy_sendfile.write(b'x' * 8192)
+        self.dummy_sendfile.seek(0)
+        self.client.storbinary('stor ' + TESTFN, self.dummy_sendfile)
+        self.client.sendcmd('rest 0')
+        self.client.storbinary('stor ' + TESTFN, BytesIO(b'y' * 100))
+        self.assertEqual(self.client.size(TESTFN), 100)
+
+        self.client.storbinary('stor ' + TESTFN, BytesIO(b'x' * 8192))
+        self.client.sendcmd('opts stor inplace on')
+        self.client.storbinary('stor ' + TESTFN, BytesIO(b'y' * 100))
+        self.client.sendcmd('rest 8000')
+        self.client.storbinary('stor ' + TESTFN, BytesIO(b'z' * 100))
+        self.client.retrbinary('retr ' + TESTFN, self.dummy_recvfile.write)
+        self.dummy_recvfile.seek(0)
+        self.assertEqual(self.dummy_recvfile.read(),
+                         b'y' * 100 + b'x' * 7900 + b'z' * 100 + b'x' * 92)
+        # APPE still appends
+        self.client.storbinary('appe ' + TESTFN, BytesIO(b'z' * 8))
+        self.assertEqual(self.client.size(TESTFN), 8200)
+
+        self.client.sendcmd('opts stor inplace off')
+        self.client.storbinary('stor ' + TESTFN, BytesIO(b'z' * 100))
+        self.assertEqual(self.client.size(TESTFN), 100)
+        self.assertRaises(ftplib.error_perm, self.client.sendcmd,
+                          'opts stor inplace')
+        self.assertRaises(ftplib.error_perm, self.client.sendcmd,
+                          'opts stor inplace maybe')
+
     def test_quit_during_transfer(self):
         # RFC-959 states that if QUIT is sent while a transfer is in
         # progress, the connection must remain open for result response
@@ -1083,6 +1146,281 @@ class TestFtpRetrieveDataNoSendfile(TestFtpRetrieveData):
     use_sendfile = False
 
 
+def pack_blocks(data, desc=64):
+    """Frame data as MODE B blocks, the last one with descriptor desc."""
+    blocks = []
+    for i in range(0, len(data), 65535):
+        chunk = data[i:i + 65535]
+        blocks.append(struct.pack('!BH', 0, len(chunk)) + chunk)
+    blocks.append(struct.pack('!BH', desc, 0))
+    return b''.join(blocks)
+
+
+class TestFtpModeB(unittest.TestCase):
+    "test: MODE B"
+    server_class = MProcessTestFTPd
+    client_class = ftplib.FTP
+
+    def setUp(self):
+        self.server = self.server_class()
+        self.server.start()
+        self.client = self.client_class(timeout=TIMEOUT)
+        self.client.connect(self.server.host, self.server.port)
+        self.client.login(USER, PASSWD)
+        self.client.voidcmd('type i')
+        self.client.voidcmd('mode b')
+        self.conn = None
+
+    def tearDown(self):
+        if self.conn is not None:
+            self.conn.close()
+        close_client(self.client)
+        self.server.stop()
+        safe_remove(TESTFN)
+        safe_remove(TESTFN + '2')
+
+    def recv_exactly(self, n):
+        data = b''
+        while len(data) < n:
+            chunk = self.conn.recv(n - len(data))
+            self.assertTrue(chunk, "connection closed")
+            data += chunk
+        return data
+
+    def command(self, cmd):
+        # the first transfer opens the data connection, the next ones
+        # reuse it
+        if self.conn is None:
+            self.conn = self.client.transfercmd(cmd)
+            self.conn.settimeout(TIMEOUT)
+        else:
+            self.assertEqual(self.client.sendcmd(cmd)[:3], '125')
+
+    def retrieve(self, cmd):
+        self.command(cmd)
+        data = b''
+        while True:
+            desc, count = struct.unpack('!BH', self.recv_exactly(3))
+            data += self.recv_exactly(count)
+            if desc & 64:
+                break
+        self.assertEqual(self.client.voidresp()[:3], '250')
+        return data
+
+    def store(self, cmd, blocks):
+        self.command(cmd)
+        self.conn.sendall(blocks)
+        return self.client.getresp()
+
+    def test_retr(self):
+        data = b'abcde12345' * 100000
+        with open(TESTFN, 'wb') as f:
+            f.write(data)
+        for x in range(3):
+            self.assertEqual(self.retrieve('retr ' + TESTFN), data)
+
+    def test_retr_empty_file(self):
+        touch(TESTFN)
+        self.assertEqual(self.retrieve('retr ' + TESTFN), b'')
+        self.assertEqual(self.retrieve('retr ' + TESTFN), b'')
+
+    def test_stor(self):
+        data = b'abcde12345' * 100000
+        resp = self.store('stor ' + TESTFN, pack_blocks(data))
+        self.assertEqual(resp[:3], '250')
+        resp = self.store('stor ' + TESTFN + '2', pack_blocks(data[:10]))
+        self.assertEqual(resp[:3], '250')
+        with open(TESTFN, 'rb') as f:
+            self.assertEqual(f.read(), data)
+        with open(TESTFN + '2', 'rb') as f:
+            self.assertEqual(f.read(), data[:10])
+        self.assertEqual(self.retrieve('retr ' + TESTFN + '2'),
+                         data[:10])
+
+    def test_stor_restart_marker(self):
+        # restart markers are not file data
+        blocks = struct.pack('!BH', 16, 3) + b'123' + pack_blocks(b'data')
+        self.store('stor ' + TESTFN, blocks)
+        with open(TESTFN, 'rb') as f:
+            self.assertEqual(f.read(), b'data')
+
+    def test_stor_truncated(self):
+        self.command('stor ' + TESTFN)
+        self.conn.sendall(pack_blocks(b'x' * 1000)[:-3])
+        self.conn.close()
+        self.conn = None
+        self.assertRaisesRegex(ftplib.error_temp, '^426',
+                               self.client.voidresp)
+
+    def test_list(self):
+        touch(TESTFN)
+        self.assertIn(TESTFN.encode(), self.retrieve('list'))
+        self.assertIn(TESTFN.encode(), self.retrieve('nlst'))
+        self.assertIn(TESTFN.encode(), self.retrieve('mlsd'))
+
+    def test_stat(self):
+        touch(TESTFN)
+        self.assertIn('MODE: Block', self.client.sendcmd('stat'))
+        self.retrieve('retr ' + TESTFN)
+        self.assertIn('Data connection open, idle.',
+                      self.client.sendcmd('stat'))
+
+    def test_mode_change_closes(self):
+        touch(TESTFN)
+        self.retrieve('retr ' + TESTFN)
+        self.client.sendcmd('mode s')
+        self.assertEqual(self.conn.recv(1024), b'')
+        self.assertIn('Data connection closed.', self.client.sendcmd('stat'))
+
+    def test_client_closes(self):
+        touch(TESTFN)
+        self.retrieve('retr ' + TESTFN)
+        self.conn.close()
+        self.conn = None
+        # a new data connection is opened; no reply about the old one
+        self.assertEqual(self.retrieve('retr ' + TESTFN), b'')
+        self.client.sendcmd('noop')
+
+    def test_quit(self):
+        touch(TESTFN)
+        self.retrieve('retr ' + TESTFN)
+        self.assertEqual(self.client.sendcmd('quit')[:3], '221')
+        self.assertEqual(self.conn.recv(1024), b'')
+
+
+class TestFtpModeZ(unittest.TestCase):
+    "test: MODE Z, OPTS MODE Z"
+    server_class = MProcessTestFTPd
+    client_class = ftplib.FTP
+
+    def setUp(self):
+        self.server = self.server_class()
+        self.server.start()
+        self.client = self.client_class(timeout=TIMEOUT)
+        self.client.connect(self.server.host, self.server.port)
+        self.client.login(USER, PASSWD)
+        self.client.voidcmd('type i')
+        self.client.voidcmd('mode z')
+
+    def tearDown(self):
+        close_client(self.client)
+        self.server.stop()
+        safe_remove(TESTFN)
+        safe_remove(TESTFN + '.gz')
+
+    def retrieve(self, cmd):
+        # return the raw (compressed) bytes sent over the data channel
+        chunks = []
+        with contextlib.closing(self.client.transfercmd(cmd)) as conn:
+            conn.settimeout(TIMEOUT)
+            while True:
+                chunk = conn.recv(BUFSIZE)
+                if not chunk:
+                    break
+                chunks.append(chunk)
+        self.client.voidresp()
+        return b''.join(chunks)
+
+    def store(self, cmd, data):
+        with contextlib.closing(self.client.transfercmd(cmd)) as conn:
+            conn.sendall(data)
+        return self.client.getresp()
+
+    def test_feat(self):
+        self.assertIn('MODE Z', self.client.sendcmd('feat'))
+
+    def test_mode(self):
+        self.assertIn('MODE: Deflate', self.client.sendcmd('stat'))
+        self.client.sendcmd('mode s')
+        self.assertIn('MODE: Stream', self.client.sendcmd('stat'))
+
+    def test_opts_level(self):
+        self.assertEqual(self.client.sendcmd('opts mode z level 9'),
+                         '200 MODE Z LEVEL set to 9.')
+        self.client.sendcmd('opts mode z level 0')
+        for arg in ('level 10', 'level -1', 'level x', 'level', 'foo 1'):
+            self.assertRaises(ftplib.error_perm, self.client.sendcmd,
+                              'opts mode z ' + arg)
+        self.assertRaises(ftplib.error_perm, self.client.sendcmd,
+                          'opts mode b level 1')
+
+    def test_retr(self):
+        data = b'abcde12345' * 100000
+        with open(TESTFN, 'wb') as f:
+            f.write(data)
+        compressed = self.retrieve('retr ' + TESTFN)
+        self.assertLess(len(compressed), len(data) // 10)
+        self.assertEqual(zlib.decompress(compressed), data)
+
+    def test_retr_level(self):
+        data = b'abcde12345' * 100000
+        with open(TESTFN, 'wb') as f:
+            f.write(data)
+        self.client.sendcmd('opts mode z level 0')
+        compressed = self.retrieve('retr ' + TESTFN)
+        self.assertGreater(len(compressed), len(data))
+        self.assertEqual(zlib.decompress(compressed), data)
+
+    def test_retr_incompressible(self):
+        # already compressed data is sent in stored blocks
+        data = os.urandom(BUFSIZE * 4)
+        with open(TESTFN, 'wb') as f:
+            f.write(data)
+        compressed = self.retrieve('retr ' + TESTFN)
+        self.assertEqual(zlib.decompress(compressed), data)
+        # same for a compressible file carrying a compressed suffix
+        data = b'abcde12345' * 10000
+        with open(TESTFN + '.gz', 'wb') as f:
+            f.write(data)
+        compressed = self.retrieve('retr ' + TESTFN + '.gz')
+        self.assertGreater(len(compressed), len(data))
+        self.assertEqual(zlib.decompress(compressed), data)
+
+    def test_retr_empty_file(self):
+        touch(TESTFN)
+        self.assertEqual(zlib.decompress(self.retrieve('retr ' + TESTFN)),
+                         b'')
+
+    def test_list(self):
+        touch(TESTFN)
+        listing = zlib.decompress(self.retrieve('list'))
+        self.assertIn(TESTFN.encode(), listing)
+        listing = zlib.decompress(self.retrieve('nlst'))
+        self.assertIn(TESTFN.encode(), listing)
+
+    def test_stor(self):
+        data = b'abcde12345' * 100000
+        resp = self.store('stor ' + TESTFN, zlib.compress(data))
+        self.assertEqual(resp[:3], '226')
+        with open(TESTFN, 'rb') as f:
+            self.assertEqual(f.read(), data)
+
+    def test_stor_ascii(self):
+        self.client.voidcmd('type a')
+        data = b'abcde12345\r\n' * 1000
+        self.store('stor ' + TESTFN, zlib.compress(data))
+        with open(TESTFN, 'rb') as f:
+            self.assertEqual(f.read(), data.replace(b'\r\n', b(os.linesep)))
+
+    def test_stor_truncated(self):
+        compressed = zlib.compress(os.urandom(BUFSIZE * 4))
+        self.assertRaisesRegex(ftplib.error_temp, '^426',
+                               self.store, 'stor ' + TESTFN, compressed[:-10])
+
+    def test_stor_invalid(self):
+        self.assertRaisesRegex(ftplib.error_temp,
+                               '^426 Invalid compressed data',
+                               self.store, 'stor ' + TESTFN,
+                               b'not zlib data' * 100)
+
+    def test_mode_s(self):
+        self.client.sendcmd('mode s')
+        data = b'abcde12345' * 1000
+        with open(TESTFN, 'wb') as f:
+            f.write(data)
+        self.assertEqual(self.retrieve('retr ' + TESTFN), data)
+
+
 class TestFtpListingCmds(unittest.TestCase):
     """Test LIST, NLST, argumented STAT."""
     server_class = MProcessTestFTPd
@@ -2321,6 +2659,24 @@ class TestCornerCases(unittest.TestCase):
                 repr(inst)
                 str(inst)
 
+    def test_data_sent_before_stor(self):
+        # a server to server copy may deliver the file on the passive
+        # data connection before STOR arrives: it must not be dropped
+        data = b'abcde12345' * 100000
+        self.client.voidcmd('TYPE I')
+        try:
+            with contextlib.closing(socket.create_connection(
+                    self.client.makepasv(), timeout=TIMEOUT)) as sock:
+                sock.sendall(data)
+            time.sleep(0.1)
+            resp = self.client.sendcmd('stor ' + TESTFN)
+            self.assertEqual(resp[:3], '125')
+            self.assertEqual(self.client.voidresp()[:3], '226')
+            with open(TESTFN, 'rb') as f:
+                self.assertEqual(f.read(), data)
+        finally:
+            safe_remove(TESTFN)
+
     if hasattr(os, 'sendfile'):
         def test_sendfile(self):
             # make sure that on python >= 3.3 we're using os.sendfile
@@ -2607,6 +2963,14 @@ class ThreadedFTPTests(unittest.TestCase):
             with self.server.lock:
                 self.server.handler.timeout = 0.1
 
+    def test_active_connector_released(self):
+        # once connected, ActiveDTP must not be close()d again by the
+        # next PORT as by then its fd may belong to another channel
+        self.client.set_pasv(False)
+        self.client.retrlines('list', lambda x: x)
+        with self.server.lock:
+            self.assertIsNone(get_server_handler()._dtp_connector)
+
     @unittest.skipUnless(hasattr(socket, 'TCP_NODELAY'),
                          'TCP_NODELAY not available')
     def test_tcp_no_delay(self):
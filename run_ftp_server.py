@@ -10,6 +10,11 @@ parser.add_argument('--username', '-u', default='username')
 parser.add_argument('--password', '-p', default='password')
 parser.add_argument('--root', '-r', default='/')
 parser.add_argument('--port', '-P', default=8821)
+parser.add_argument('--max-cons', type=int, default=512,
+                    help='maximum number of simultaneous connections')
+parser.add_argument('--permit-foreign-addresses', action='store_true',
+                    help='allow data connections to and from other hosts '
+                         'than the client, as server to server (FXP) copies need')
 args = parser.parse_args()
 
 authorizer = DummyAuthorizer()
@@ -18,6 +23,8 @@ authorizer.add_user(args.username, args.password, args.root, perm="elradfmwMT")
 
 handler = FTPHandler
 handler.authorizer = authorizer
+handler.permit_foreign_addresses = args.permit_foreign_addresses
 
-server = FTPServer(('127.0.0.1', args.port), handler)
+server = FTPServer(('127.0.0.1', args.port), handler, backlog=args.max_cons)
+server.max_cons = args.max_cons
 server.serve_forever()